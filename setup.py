@@ -67,12 +67,14 @@ setup(
                       'setuptools'],
     entry_points="""
     [zc.buildout]
-    testrunner = schooltool.devtools.selenium_recipe:SeleniumRunnerRecipe
+    testrunner = schooltool.devtools.recipe:SeleniumRunnerRecipe
 
     [console_scripts]
     i18nextract = schooltool.devtools.i18nextract:i18nextract
     runfdoctests = schooltool.devtools.runfdoctests:main
     debugdb = schooltool.devtools.database:main
+    mergetesthistory = schooltool.devtools.scheduling:main
+    webdriverdispatcher = schooltool.devtools.dispatcher:main
     """,
     include_package_data=True,
     zip_safe=False,
@@ -0,0 +1,303 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Browser spawn, page load and quit benchmarks
+
+Every configured browser factory is spawned a number of times under each
+display backend, loading a local static page.  The benchmark needs the
+browsers of a selenium test runner, so it is run from a project that has
+one: add schooltool.devtools to the eggs of the selenium test part, then
+
+    SCHOOLTOOL_BENCHMARK_RUNS=10 \\
+    SCHOOLTOOL_BENCHMARK_DISPLAYS=xvfb,xephyr,native \\
+    SCHOOLTOOL_BENCHMARK_OUTPUT=benchmark.json \\
+    bin/test-selenium --at-level 3 -s schooltool.devtools -t BrowserBenchmark
+
+SCHOOLTOOL_BENCHMARK_FACTORIES limits the benchmark to some factories.
+The results are shown in the report of the test runner, and saved to
+SCHOOLTOOL_BENCHMARK_OUTPUT as JSON.
+"""
+import BaseHTTPServer
+import SocketServer
+import json
+import math
+import os
+import threading
+import time
+import traceback
+import unittest
+
+from schooltool.devtools import selenium_recipe
+from schooltool.devtools.browserpool import browser_rss
+
+
+PERCENTILES = (50, 90, 99)
+PHASES = ('spawn', 'load', 'quit')
+
+# Display backends besides pyvirtualdisplay ones
+CURRENT_DISPLAY = 'current'
+NATIVE_HEADLESS = 'native'
+
+PAGE = """\
+<html>
+  <head><title>Benchmark</title></head>
+  <body><h1>Benchmark</h1><p>A static page.</p></body>
+</html>
+"""
+
+
+def percentile(values, percent):
+    """Nearest rank percentile, None for no values."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class PageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=UTF-8')
+        self.send_header('Content-Length', str(len(PAGE)))
+        self.end_headers()
+        self.wfile.write(PAGE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves the static page on a free local port."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           PageHandler)
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       name='benchmark-page-server')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def measure(factory, url, config=None):
+    """Spawn a browser, load the page and quit, return the times."""
+    start = time.time()
+    browser = factory(config=config)
+    sample = {'spawn': time.time() - start, 'rss': None}
+    try:
+        start = time.time()
+        browser.get(url)
+        sample['load'] = time.time() - start
+        sample['rss'] = browser_rss(browser)
+    finally:
+        start = time.time()
+        browser.quit()
+        sample['quit'] = time.time() - start
+    return sample
+
+
+class BenchmarkResult(object):
+
+    def __init__(self, factory, display):
+        self.factory = factory
+        self.display = display
+        self.samples = []
+        self.errors = []
+
+    def times(self, phase):
+        return [sample[phase] for sample in self.samples
+                if sample.get(phase) is not None]
+
+    @property
+    def peak_rss(self):
+        sizes = [sample['rss'] for sample in self.samples
+                 if sample['rss'] is not None]
+        if not sizes:
+            return None
+        return max(sizes)
+
+    def summary(self):
+        return dict([(phase, dict([('p%d' % percent,
+                                    percentile(self.times(phase), percent))
+                                   for percent in PERCENTILES]))
+                     for phase in PHASES])
+
+    def as_dict(self):
+        return {
+            'factory': self.factory,
+            'display': self.display,
+            'runs': len(self.samples),
+            'errors': self.errors,
+            'samples': self.samples,
+            'percentiles': self.summary(),
+            'peak_rss': self.peak_rss,
+            }
+
+    def format(self):
+        summary = self.summary()
+        cells = []
+        for phase in PHASES:
+            cells.extend([format_seconds(summary[phase]['p%d' % percent])
+                          for percent in PERCENTILES])
+        peak = self.peak_rss
+        cells.append(peak is None and '-' or '%d' % (peak / 2**20))
+        line = '%-16s %-8s %4d ' % (self.factory, self.display,
+                                    len(self.samples))
+        line += ' '.join(['%6s' % cell for cell in cells])
+        if self.errors:
+            line += '  (%d errors)' % len(self.errors)
+        return line
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return '-'
+    return '%.2f' % seconds
+
+
+class Benchmark(object):
+    """Spawns each browser factory runs times under each display."""
+
+    def __init__(self, factories, runs=5, displays=(CURRENT_DISPLAY,),
+                 config=None):
+        self.factories = factories
+        self.runs = runs
+        self.displays = displays
+        if config is None:
+            config = selenium_recipe.default_browser_config
+        self.config = config
+        self.results = []
+
+    def display_config(self, display):
+        config = selenium_recipe.BrowserConfig()
+        config.update(self.config)
+        config.reuse_browsers = False
+        config.headless = (display == NATIVE_HEADLESS or
+                           (display == CURRENT_DISPLAY and
+                            self.config.headless))
+        return config
+
+    def start_display(self, display):
+        if display == CURRENT_DISPLAY:
+            if selenium_recipe.virtual_display is not None:
+                selenium_recipe.virtual_display.ensure()
+            return None
+        if display == NATIVE_HEADLESS:
+            return None
+        return selenium_recipe.start_virtual_display(
+            backend=display, visible=False, size=self.config.window_size)
+
+    def run(self, url):
+        for display in self.displays:
+            config = self.display_config(display)
+            virtual_display = self.start_display(display)
+            try:
+                for name in sorted(self.factories):
+                    result = BenchmarkResult(name, display)
+                    for n in range(self.runs):
+                        try:
+                            result.samples.append(
+                                measure(self.factories[name], url, config))
+                        except Exception:
+                            result.errors.append(traceback.format_exc())
+                    self.results.append(result)
+            finally:
+                if virtual_display is not None:
+                    virtual_display.stop()
+        return self.results
+
+    def report(self):
+        header = '%-16s %-8s %4s ' % ('factory', 'display', 'runs')
+        header += ' '.join(['%6s' % ('%s%d' % (phase[0], percent))
+                            for phase in PHASES
+                            for percent in PERCENTILES])
+        header += ' %6s' % 'MB'
+        lines = ['Browser benchmark (s=spawn, l=load, q=quit seconds,'
+                 ' peak memory of browser and driver):', header]
+        for result in self.results:
+            lines.append(result.format())
+        return '\n'.join(lines)
+
+    def as_dict(self):
+        return {
+            'runs': self.runs,
+            'percentiles': list(PERCENTILES),
+            'results': [result.as_dict() for result in self.results],
+            }
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+
+
+def environment_list(name, default=()):
+    value = os.environ.get(name, '').strip()
+    if not value:
+        return list(default)
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+class BrowserBenchmark(unittest.TestCase):
+    """Benchmark of the configured selenium browser factories."""
+
+    level = 3
+
+    def test_spawn_load_quit(self):
+        factories = selenium_recipe.factories
+        names = environment_list('SCHOOLTOOL_BENCHMARK_FACTORIES',
+                                 sorted(factories))
+        missing = [name for name in names if name not in factories]
+        self.assertFalse(missing, 'Browsers not configured: %s' % (
+            ', '.join(missing)))
+        if not names:
+            selenium_recipe.reports.append(
+                'No selenium browsers configured, nothing to benchmark.')
+            return
+        benchmark = Benchmark(
+            dict([(name, factories[name]) for name in names]),
+            runs=int(os.environ.get('SCHOOLTOOL_BENCHMARK_RUNS', 5)),
+            displays=environment_list('SCHOOLTOOL_BENCHMARK_DISPLAYS',
+                                      [CURRENT_DISPLAY]))
+        server = PageServer()
+        server.start()
+        try:
+            benchmark.run(server.url)
+        finally:
+            server.stop()
+        selenium_recipe.reports.append(benchmark.report())
+        output = os.environ.get('SCHOOLTOOL_BENCHMARK_OUTPUT')
+        if output:
+            benchmark.save(output)
+        failed = [result for result in benchmark.results
+                  if not result.samples]
+        self.assertFalse(failed, 'Browsers failed to start:\n%s' % (
+            '\n'.join([result.errors[-1] for result in failed])))
@@ -0,0 +1,497 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Pool of reusable selenium browsers
+"""
+import os
+import resource
+import sys
+import threading
+import urlparse
+
+
+reset_storage_script = '''
+try { window.localStorage.clear(); } catch (e) {}
+try { window.sessionStorage.clear(); } catch (e) {}
+'''
+
+
+def url_origin(url):
+    """Scheme, host and port of a web page URL, None for other URLs."""
+    parts = urlparse.urlsplit(url or '')
+    if parts.scheme not in ('http', 'https'):
+        return None
+    return '%s://%s' % (parts.scheme, parts.netloc)
+
+
+# Called with browsers that quit for real, for trackers that wrapped quit()
+quit_listeners = []
+
+
+def real_quit(browser):
+    """Quit the browser for real, bypassing the pool."""
+    for listener in quit_listeners:
+        listener(browser)
+    if 'quit' in browser.__dict__:
+        del browser.quit
+    try:
+        browser.quit()
+    except Exception:
+        pass
+
+
+def child_processes():
+    """Map process ids to their children, from /proc."""
+    children = {}
+    try:
+        pids = [int(name) for name in os.listdir('/proc') if name.isdigit()]
+    except OSError:
+        return children
+    for pid in pids:
+        try:
+            with open('/proc/%d/stat' % pid) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # The command name may contain spaces, ppid follows it.
+        ppid = int(stat[stat.rfind(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(pid)
+    return children
+
+
+def process_tree(pids, children=None):
+    if children is None:
+        children = child_processes()
+    result = set()
+    pending = list(pids)
+    while pending:
+        pid = pending.pop()
+        if pid not in result:
+            result.add(pid)
+            pending.extend(children.get(pid, ()))
+    return result
+
+
+def process_rss(pid):
+    """Resident memory of the process in bytes, None if unknown."""
+    try:
+        with open('/proc/%d/statm' % pid) as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+def find_processes(text):
+    """Ids of processes with the text in their command line."""
+    pids = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/cmdline' % name) as f:
+                if text in f.read():
+                    pids.append(int(name))
+        except IOError:
+            continue
+    return pids
+
+
+def browser_processes(browser):
+    """Ids of the browser and driver processes of a WebDriver."""
+    pids = []
+    service = getattr(browser, 'service', None)
+    process = getattr(service, 'process', None)
+    shared = getattr(browser, 'shared_service', False)
+    capabilities = getattr(browser, 'capabilities', None) or {}
+    chrome = capabilities.get('chrome') or {}
+    if chrome.get('userDataDir'):
+        # Tell Chrome instances of a shared chromedriver apart
+        pids.extend(find_processes(
+            '--user-data-dir=%s' % chrome['userDataDir']))
+        if process is not None and not shared:
+            pids.append(process.pid)
+    elif process is not None and not shared:
+        pids.append(process.pid)
+    binary = getattr(browser, 'binary', None)
+    process = getattr(binary, 'process', None)
+    if process is not None:
+        pids.append(process.pid)
+    return pids
+
+
+def browser_rss(browser):
+    """Resident memory of browser and driver processes in bytes.
+
+    Returns None where processes cannot be found (not Linux, remote
+    browsers).
+    """
+    try:
+        pids = browser_processes(browser)
+    except OSError:
+        return None
+    if not pids:
+        return None
+    sizes = [process_rss(pid) for pid in process_tree(pids)]
+    return sum([size for size in sizes if size is not None])
+
+
+class BrowserWatchdog(object):
+    """Decides when pooled browsers should be replaced with fresh ones.
+
+    Browsers are recycled after serving max_tests tests, or when their
+    browser and driver processes use more than max_rss bytes.
+    """
+
+    def __init__(self, max_tests=None, max_rss=None):
+        self.max_tests = max_tests
+        self.max_rss = max_rss
+        self.tests = {}
+        self.recycled = []
+        self.peak_rss = 0
+        self.lock = threading.Lock()
+
+    def served(self, browser):
+        with self.lock:
+            self.tests[id(browser)] = self.tests.get(id(browser), 0) + 1
+            return self.tests[id(browser)]
+
+    def rss(self, browser):
+        return browser_rss(browser)
+
+    def check(self, browser):
+        """Count a served test, return why to recycle the browser or None."""
+        tests = self.served(browser)
+        reason = None
+        if self.max_tests and tests >= self.max_tests:
+            reason = 'tests'
+        elif self.max_rss:
+            rss = self.rss(browser)
+            if rss is not None:
+                self.peak_rss = max(self.peak_rss, rss)
+                if rss > self.max_rss:
+                    reason = 'memory'
+        if reason is not None:
+            self.recycle(browser, reason)
+        return reason
+
+    def recycle(self, browser, reason):
+        with self.lock:
+            tests = self.tests.pop(id(browser), 0)
+            self.recycled.append((reason, tests))
+
+    def forget(self, browser):
+        with self.lock:
+            self.tests.pop(id(browser), None)
+
+    def report(self):
+        """Summary of recycled browsers, None if none were."""
+        if not self.recycled:
+            return None
+        after_tests = len([reason for reason, tests in self.recycled
+                           if reason == 'tests'])
+        over_memory = len(self.recycled) - after_tests
+        reasons = []
+        if after_tests:
+            reasons.append('%d after %d tests' % (after_tests, self.max_tests))
+        if over_memory:
+            reasons.append('%d over %d MB' % (over_memory,
+                                              self.max_rss / 2**20))
+        summary = 'Recycled %d browsers: %s' % (
+            len(self.recycled), ', '.join(reasons))
+        if self.peak_rss:
+            summary += ' (peak %d MB)' % (self.peak_rss / 2**20)
+        return summary
+
+
+def browser_key(factory_name, config):
+    return (factory_name,
+            tuple([(attr, repr(getattr(config, attr)))
+                   for attr in sorted(config._settings())]))
+
+
+class SpareBrowsers(object):
+    """Fresh browsers spawned ahead of time in a background thread.
+
+    Keeps count spare browsers for every factory and config that was
+    asked for, so that tests do not wait for browsers to start.  Spares
+    are kept with the X display they were spawned on, and dropped when
+    the display changes.  stop() waits for a browser being spawned at
+    most timeout seconds.
+    """
+
+    def __init__(self, factories, count=1, timeout=30):
+        self.factories = factories
+        self.count = count
+        self.timeout = timeout
+        self.wanted = {}
+        self.spares = {}
+        self.spawning = {}
+        self.thread = None
+        self.stopped = False
+        self.condition = threading.Condition()
+
+    def start(self):
+        with self.condition:
+            if self.thread is not None:
+                return
+            self.stopped = False
+            self.thread = threading.Thread(target=self.run,
+                                           name='spare-browsers')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def want(self, factory_name, config):
+        """Start keeping spares of the factory and config."""
+        self.start()
+        key = browser_key(factory_name, config)
+        with self.condition:
+            self.wanted[key] = (factory_name, config)
+            self.condition.notify_all()
+        return key
+
+    def take(self, factory_name, config):
+        """Return a spare browser, None if none is ready."""
+        key = self.want(factory_name, config)
+        display = os.environ.get('DISPLAY')
+        stale = []
+        browser = None
+        with self.condition:
+            spares = self.spares.get(key, [])
+            while spares and browser is None:
+                spare, spare_display = spares.pop(0)
+                if spare_display == display:
+                    browser = spare
+                else:
+                    stale.append(spare)
+            self.condition.notify_all()
+        for spare in stale:
+            real_quit(spare)
+        return browser
+
+    def missing(self):
+        """A key that needs another spare, None if none does."""
+        for key in sorted(self.wanted):
+            if (len(self.spares.get(key, ())) + self.spawning.get(key, 0) <
+                self.count):
+                return key
+        return None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and self.missing() is None:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                key = self.missing()
+                factory_name, config = self.wanted[key]
+                self.spawning[key] = self.spawning.get(key, 0) + 1
+            display = os.environ.get('DISPLAY')
+            browser = None
+            try:
+                browser = self.factories[factory_name](config=config)
+            except Exception, e:
+                print >> sys.stderr, (
+                    'warning: could not spawn a spare %s browser: %s' % (
+                        factory_name, e))
+            with self.condition:
+                self.spawning[key] -= 1
+                if browser is None:
+                    # Let tests spawn it and see the error, try again
+                    # when asked next time.
+                    self.wanted.pop(key, None)
+                    continue
+                if self.stopped or key not in self.wanted:
+                    real_quit(browser)
+                    continue
+                self.spares.setdefault(key, []).append((browser, display))
+
+    def clear(self):
+        """Quit the spare browsers, keep spawning new ones."""
+        with self.condition:
+            browsers = [browser
+                        for spares in self.spares.values()
+                        for browser, display in spares]
+            self.spares.clear()
+            self.condition.notify_all()
+        for browser in browsers:
+            real_quit(browser)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.wanted.clear()
+            thread, self.thread = self.thread, None
+            self.condition.notify_all()
+        if thread is not None:
+            # A hung factory must not hang the test run, the thread
+            # quits the browser if it ever gets one.
+            thread.join(self.timeout)
+            if thread.isAlive():
+                print >> sys.stderr, (
+                    'warning: gave up waiting for a spare browser to spawn')
+        self.clear()
+
+
+class BrowserPool(object):
+    """Hands out warm browsers, keyed by factory name and browser config.
+
+    Pooled browsers return to the pool when the test calls quit(), or
+    when the test ends, whichever comes first.
+
+    WebDriver can only clear cookies and storage of the page it is on, so
+    browsers that visited more than one origin during the test are quit
+    instead of reused.  Origins are those of the URLs passed to get(),
+    and of the pages the windows are on at the end of the test.
+    """
+
+    def __init__(self, factories, watchdog=None, spares=None):
+        self.factories = factories
+        self.watchdog = watchdog
+        self.spares = spares
+        self.idle = {}
+        self.in_use = {}
+        self.origins = {}
+        self.test_browsers = None
+        self.lock = threading.RLock()
+
+    def key(self, factory_name, config):
+        return browser_key(factory_name, config)
+
+    def new_browser(self, factory_name, config):
+        """A spare browser if one is ready, a newly spawned one otherwise."""
+        browser = None
+        if self.spares is not None:
+            browser = self.spares.take(factory_name, config)
+        if browser is None:
+            browser = self.factories[factory_name](config=config)
+        return browser
+
+    def spawn(self, factory_name, config):
+        browser = self.new_browser(factory_name, config)
+        browser.quit = lambda: self.release(browser)
+        get = browser.get
+
+        def tracking_get(url):
+            self.visit(browser, url)
+            return get(url)
+
+        browser.get = tracking_get
+        return browser
+
+    def visit(self, browser, url):
+        origin = url_origin(url)
+        if origin is None:
+            return
+        with self.lock:
+            self.origins.setdefault(id(browser), set()).add(origin)
+
+    def acquire(self, factory_name, config):
+        key = self.key(factory_name, config)
+        browser = None
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                browser = idle.pop()
+        if browser is None:
+            browser = self.spawn(factory_name, config)
+        with self.lock:
+            self.in_use[id(browser)] = (key, browser)
+            if self.test_browsers is not None:
+                self.test_browsers.append(browser)
+        return browser
+
+    def release(self, browser):
+        with self.lock:
+            key, browser = self.in_use.pop(id(browser), (None, browser))
+            origins = self.origins.pop(id(browser), set())
+            if (self.test_browsers is not None and
+                browser in self.test_browsers):
+                self.test_browsers.remove(browser)
+            if key is None and self.is_idle(browser):
+                # Quit twice, the browser is already back in the pool.
+                return
+        if (key is None or
+            self.watchdog is not None and self.watchdog.check(browser) or
+            not self.reset(browser, origins)):
+            if self.watchdog is not None:
+                self.watchdog.forget(browser)
+            real_quit(browser)
+            return
+        with self.lock:
+            self.idle.setdefault(key, []).append(browser)
+
+    def is_idle(self, browser):
+        for idle in self.idle.values():
+            if browser in idle:
+                return True
+        return False
+
+    def reset(self, browser, origins=()):
+        """Close extra windows and forget cookies, storage and location.
+
+        Returns False if the browser cannot be reset, say because it
+        visited other origins than the one it is on.
+        """
+        origins = set(origins)
+        try:
+            handles = browser.window_handles
+            for handle in handles[1:]:
+                browser.switch_to_window(handle)
+                origins.add(url_origin(browser.current_url))
+                browser.close()
+            browser.switch_to_window(handles[0])
+            origins.add(url_origin(browser.current_url))
+            origins.discard(None)
+            if len(origins) > 1:
+                return False
+            browser.delete_all_cookies()
+            browser.execute_script(reset_storage_script)
+            browser.get('about:blank')
+        except Exception, e:
+            print >> sys.stderr, (
+                'warning: discarding browser that failed to reset: %s' % e)
+            return False
+        return True
+
+    def start_test(self):
+        with self.lock:
+            self.test_browsers = []
+
+    def stop_test(self):
+        with self.lock:
+            browsers, self.test_browsers = self.test_browsers, None
+        for browser in browsers or ():
+            self.release(browser)
+
+    def clear(self):
+        """Quit all browsers, idle or not."""
+        with self.lock:
+            browsers = [browser
+                        for idle in self.idle.values()
+                        for browser in idle]
+            browsers.extend([browser
+                             for key, browser in self.in_use.values()])
+            self.idle.clear()
+            self.in_use.clear()
+            if self.test_browsers is not None:
+                self.test_browsers = []
+        for browser in browsers:
+            if self.watchdog is not None:
+                self.watchdog.forget(browser)
+            real_quit(browser)
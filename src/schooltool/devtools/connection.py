@@ -0,0 +1,189 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Keep-alive connections to WebDriver servers shared by browsers
+"""
+import errno
+import httplib
+import socket
+import threading
+import time
+import urlparse
+
+from selenium.webdriver.remote.remote_connection import RemoteConnection
+
+from schooltool.devtools import selenium_recipe
+
+
+class PooledHTTPConnection(httplib.HTTPConnection):
+    """HTTP connection that knows whether the last request was sent."""
+
+    sent = False
+
+    def request(self, *args, **kw):
+        self.sent = False
+        httplib.HTTPConnection.request(self, *args, **kw)
+        self.sent = True
+
+
+def stale_connection_error(connection, error):
+    """Did the server close the connection before it got the request?
+
+    Only then can the request be sent again without doing it twice.
+    Timeouts and errors after the request was sent may come after the
+    server acted on it.
+    """
+    if isinstance(error, socket.timeout):
+        return False
+    if isinstance(error, httplib.BadStatusLine):
+        # Closed without sending a byte of the response.
+        return (not error.line or
+                error.line.startswith('No status line received'))
+    if isinstance(error, socket.error) and not connection.sent:
+        return error.errno in (errno.ECONNRESET, errno.EPIPE)
+    return False
+
+
+class ConnectionPool(object):
+    """Idle keep-alive HTTP connections to a WebDriver server.
+
+    Up to size connections are kept for reuse.  Connections idle for
+    longer than idle_timeout seconds are closed, as servers drop them.
+    Commands time out after timeout seconds, never if None.
+    """
+
+    def __init__(self, host, port, size=4, timeout=None, idle_timeout=30):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.idle = []
+        self.created = 0
+        self.reused = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        return PooledHTTPConnection(self.host, self.port,
+                                    timeout=self.timeout)
+
+    def acquire(self):
+        """Return a connection and whether it was used before."""
+        now = time.time()
+        with self.lock:
+            while self.idle:
+                connection, last_used = self.idle.pop()
+                if (self.idle_timeout is None or
+                    now - last_used < self.idle_timeout):
+                    self.reused += 1
+                    return connection, True
+                connection.close()
+            self.created += 1
+        return self.connect(), False
+
+    def release(self, connection):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((connection, time.time()))
+                return
+        connection.close()
+
+    def discard(self, connection):
+        connection.close()
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection, last_used in idle:
+            connection.close()
+
+
+class ConnectionPools(object):
+    """Connection pools by server address and settings."""
+
+    def __init__(self):
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def get(self, host, port, **settings):
+        key = (host, port, tuple(sorted(settings.items())))
+        with self.lock:
+            if key not in self.pools:
+                self.pools[key] = ConnectionPool(host, port, **settings)
+            return self.pools[key]
+
+    def clear(self):
+        with self.lock:
+            pools = self.pools.values()
+        for pool in pools:
+            pool.clear()
+
+
+connection_pools = ConnectionPools()
+selenium_recipe.cleanups.append(connection_pools.clear)
+
+
+class PooledRemoteConnection(RemoteConnection):
+    """Command executor sending commands over pooled keep-alive connections.
+
+    Browsers talking to the same server share the pool, so a command does
+    not need a new TCP connection, nor leave a socket in TIME_WAIT.
+    """
+
+    def __init__(self, remote_server_addr, pools=None, **settings):
+        RemoteConnection.__init__(self, remote_server_addr, keep_alive=False)
+        # Use the keep-alive code path of RemoteConnection._request, with
+        # a connection of the pool as self._conn.
+        self.keep_alive = True
+        if pools is None:
+            pools = connection_pools
+        url = urlparse.urlparse(self._url)
+        self.pool = pools.get(url.hostname, url.port or 80, **settings)
+        self.local = threading.local()
+
+    @property
+    def _conn(self):
+        return self.local.connection
+
+    def _request(self, method, url, body=None):
+        retry = True
+        while True:
+            connection, reused = self.pool.acquire()
+            self.local.connection = connection
+            try:
+                result = RemoteConnection._request(self, method, url, body)
+            except Exception, e:
+                self.pool.discard(connection)
+                if reused and retry and stale_connection_error(connection, e):
+                    # The server closed the idle connection, retry once.
+                    retry = False
+                    continue
+                raise
+            except:
+                self.pool.discard(connection)
+                raise
+            self.pool.release(connection)
+            return result
+
+
+def pooled_connection(url, **settings):
+    """Command executor for a WebDriver server with pooled connections.
+
+    Settings are passed to ConnectionPool: size, timeout, idle_timeout.
+    """
+    return PooledRemoteConnection(url, **settings)
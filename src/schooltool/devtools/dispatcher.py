@@ -0,0 +1,548 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Local WebDriver dispatcher
+
+Speaks the WebDriver wire protocol on a single port and hands sessions
+out to a fixed pool of local chromedriver processes.  Sessions wait in a
+queue while all drivers are busy.  Commands are forwarded as they are, so
+only drivers that speak the JSON wire protocol of selenium 2 clients can
+be used; geckodriver speaks W3C WebDriver only.
+
+    webdriverdispatcher --chrome 2 --port 4444
+
+Test runner configuration:
+
+    [selenium.chrome]
+    web_driver = remote
+    remote_hub = http://localhost:4444/wd/hub
+    capabilities = CHROME
+
+"""
+import BaseHTTPServer
+import SocketServer
+import abc
+import httplib
+import json
+import optparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+
+# Wire protocol status codes
+UNKNOWN_COMMAND = 9
+UNKNOWN_ERROR = 13
+NO_SUCH_SESSION = 6
+SESSION_NOT_CREATED = 33
+
+
+class DispatcherError(Exception):
+
+    def __init__(self, message, status=UNKNOWN_ERROR):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def error_response(status, message):
+    return json.dumps({'status': status, 'value': {'message': message}})
+
+
+def free_port(host='127.0.0.1'):
+    sock = socket.socket()
+    try:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def requested_browser(payload):
+    """Browser name asked for in a new session request."""
+    name = (payload.get('desiredCapabilities') or {}).get('browserName')
+    if not name:
+        capabilities = payload.get('capabilities') or {}
+        matches = ([capabilities.get('alwaysMatch') or {}] +
+                   list(capabilities.get('firstMatch') or []))
+        for match in matches:
+            if match.get('browserName'):
+                name = match['browserName']
+                break
+    return (name or '').lower()
+
+
+def response_session_id(data):
+    """Session id from a new session response, JSON wire or W3C."""
+    try:
+        response = json.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(response, dict):
+        return None
+    if response.get('sessionId'):
+        return response['sessionId']
+    value = response.get('value')
+    if isinstance(value, dict):
+        return value.get('sessionId')
+    return None
+
+
+class DriverProcess(object):
+    """A local WebDriver server serving up to max_sessions sessions."""
+
+    __metaclass__ = abc.ABCMeta
+
+    browser_name = None
+    max_sessions = 1
+
+    def __init__(self, executable, max_sessions=None, host='127.0.0.1',
+                 timeout=30):
+        self.executable = executable
+        if max_sessions is not None:
+            self.max_sessions = max_sessions
+        self.host = host
+        self.timeout = timeout
+        self.port = None
+        self.process = None
+        self.sessions = 0
+        self.connections = []
+        self.lock = threading.Lock()
+        self.start_lock = threading.Lock()
+
+    @abc.abstractmethod
+    def command(self):
+        """Command line of the driver, listening on self.port."""
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    @property
+    def available(self):
+        return self.sessions < self.max_sessions
+
+    def connectable(self):
+        try:
+            sock = socket.create_connection((self.host, self.port), 1)
+        except socket.error:
+            return False
+        sock.close()
+        return True
+
+    def start(self):
+        self.port = free_port(self.host)
+        devnull = open(os.devnull, 'w')
+        try:
+            self.process = subprocess.Popen(
+                self.command(), stdout=devnull, stderr=devnull,
+                close_fds=True)
+        except OSError, e:
+            raise DispatcherError('Cannot start %s: %s' % (
+                self.executable, e), SESSION_NOT_CREATED)
+        finally:
+            devnull.close()
+        deadline = time.time() + self.timeout
+        while not self.connectable():
+            if not self.alive():
+                raise DispatcherError('%s exited with status %s' % (
+                    self.executable, self.process.returncode),
+                    SESSION_NOT_CREATED)
+            if time.time() > deadline:
+                self.stop()
+                raise DispatcherError('%s did not start in %s seconds' % (
+                    self.executable, self.timeout), SESSION_NOT_CREATED)
+            time.sleep(0.05)
+
+    def ensure(self):
+        """Replace a crashed driver."""
+        with self.start_lock:
+            if not self.alive():
+                self.stop()
+                self.start()
+
+    def stop(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
+        if self.alive():
+            self.process.terminate()
+            self.process.wait()
+
+    def connection(self):
+        with self.lock:
+            if self.connections:
+                return self.connections.pop(), True
+        return httplib.HTTPConnection(self.host, self.port), False
+
+    def request(self, method, path, body=None):
+        """Send a command, return the response status and body."""
+        headers = {'Content-Type': 'application/json;charset=UTF-8'}
+        while True:
+            connection, reused = self.connection()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if reused:
+                    # The driver closed an idle keep-alive connection.
+                    continue
+                raise
+            break
+        if response.getheader('connection', '').lower() == 'close':
+            connection.close()
+        else:
+            with self.lock:
+                self.connections.append(connection)
+        return response.status, data
+
+
+class ChromeDriverProcess(DriverProcess):
+
+    browser_name = 'chrome'
+    max_sessions = 4
+
+    def command(self):
+        return [self.executable, '--port=%d' % self.port]
+
+
+class SessionStats(object):
+
+    def __init__(self, session_id, browser_name, queued):
+        self.session_id = session_id
+        self.browser_name = browser_name
+        self.queued = queued
+        self.started = time.time()
+        self.duration = None
+        self.commands = 0
+        self.command_time = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def add(self, seconds, sent, received):
+        self.commands += 1
+        self.command_time += seconds
+        self.bytes_sent += sent
+        self.bytes_received += received
+
+    def finish(self):
+        self.duration = time.time() - self.started
+
+    def as_dict(self):
+        return {
+            'session': self.session_id,
+            'browser': self.browser_name,
+            'queued': self.queued,
+            'duration': self.duration,
+            'commands': self.commands,
+            'command_time': self.command_time,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            }
+
+
+class Dispatcher(object):
+    """Routes WebDriver sessions to driver processes.
+
+    New sessions go to the least busy driver for the requested browser.
+    When all of them are full, or max_sessions sessions are running in
+    total, the request waits up to queue_timeout seconds for a session to
+    end.
+    """
+
+    def __init__(self, drivers, max_sessions=None, queue_timeout=300,
+                 prefix='/wd/hub'):
+        self.drivers = drivers
+        self.max_sessions = max_sessions
+        self.queue_timeout = queue_timeout
+        self.prefix = prefix
+        self.sessions = {}
+        self.finished = []
+        self.queued = 0
+        self.condition = threading.Condition()
+
+    def start(self):
+        for driver in self.drivers:
+            driver.start()
+
+    def stop(self):
+        for driver in self.drivers:
+            driver.stop()
+
+    @property
+    def active(self):
+        return sum([driver.sessions for driver in self.drivers])
+
+    def purge(self):
+        """End sessions of crashed drivers, with the condition held."""
+        for session_id, (driver, stats) in self.sessions.items():
+            if not driver.alive():
+                del self.sessions[session_id]
+                stats.finish()
+                self.finished.append(stats)
+                driver.sessions -= 1
+
+    def reserve(self, browser_name):
+        candidates = [driver for driver in self.drivers
+                      if driver.browser_name == browser_name]
+        if not candidates:
+            raise DispatcherError('No drivers for browser %r' % browser_name,
+                                  SESSION_NOT_CREATED)
+        deadline = time.time() + self.queue_timeout
+        with self.condition:
+            self.queued += 1
+            try:
+                while True:
+                    self.purge()
+                    available = [driver for driver in candidates
+                                 if driver.available]
+                    if available and (self.max_sessions is None or
+                                      self.active < self.max_sessions):
+                        driver = min(available,
+                                     key=lambda driver: driver.sessions)
+                        driver.sessions += 1
+                        return driver
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise DispatcherError(
+                            'Timed out after %s seconds waiting for a %s'
+                            ' driver' % (self.queue_timeout, browser_name),
+                            SESSION_NOT_CREATED)
+                    # Wake up now and then to notice crashed drivers.
+                    self.condition.wait(min(remaining, 1))
+            finally:
+                self.queued -= 1
+
+    def free(self, driver):
+        with self.condition:
+            driver.sessions -= 1
+            self.condition.notify_all()
+
+    def new_session(self, body):
+        try:
+            payload = json.loads(body or '{}')
+        except ValueError:
+            raise DispatcherError('Bad new session request',
+                                  SESSION_NOT_CREATED)
+        browser_name = requested_browser(payload)
+        start = time.time()
+        driver = self.reserve(browser_name)
+        queued = time.time() - start
+        try:
+            driver.ensure()
+            status, data = driver.request('POST', '/session', body)
+        except Exception:
+            self.free(driver)
+            raise
+        session_id = None
+        if status == 200:
+            session_id = response_session_id(data)
+        if session_id is None:
+            self.free(driver)
+            return status, data
+        with self.condition:
+            self.sessions[session_id] = (
+                driver, SessionStats(session_id, browser_name, queued))
+        return status, data
+
+    def end_session(self, session_id):
+        with self.condition:
+            driver, stats = self.sessions.pop(session_id)
+            stats.finish()
+            self.finished.append(stats)
+        self.free(driver)
+
+    def handle(self, method, path, body=None):
+        """Dispatch a command, return the response status and body."""
+        if path.startswith(self.prefix):
+            path = path[len(self.prefix):] or '/'
+        parts = path.split('?')[0].strip('/').split('/')
+        if parts == ['status']:
+            return 200, json.dumps({'status': 0, 'value': self.status()})
+        if parts == ['dispatcher', 'stats']:
+            return 200, json.dumps(self.stats())
+        if parts == ['session'] and method == 'POST':
+            return self.new_session(body)
+        if parts[0] != 'session' or len(parts) < 2:
+            return 404, error_response(
+                UNKNOWN_COMMAND, 'Unknown command %s %s' % (method, path))
+        session_id = parts[1]
+        with self.condition:
+            entry = self.sessions.get(session_id)
+        if entry is None:
+            return 404, error_response(
+                NO_SUCH_SESSION, 'Unknown session %s' % session_id)
+        driver, stats = entry
+        start = time.time()
+        try:
+            status, data = driver.request(method, path, body)
+        except (httplib.HTTPException, socket.error), e:
+            if not driver.alive():
+                self.end_session(session_id)
+            raise DispatcherError('Driver %s failed: %s' % (
+                driver.executable, e))
+        stats.add(time.time() - start, len(body or ''), len(data))
+        if method == 'DELETE' and len(parts) == 2:
+            self.end_session(session_id)
+        return status, data
+
+    def status(self):
+        with self.condition:
+            return {
+                'ready': any([driver.available for driver in self.drivers]),
+                'sessions': len(self.sessions),
+                'queued': self.queued,
+                'drivers': [{'browser': driver.browser_name,
+                             'sessions': driver.sessions,
+                             'max_sessions': driver.max_sessions}
+                            for driver in self.drivers],
+                }
+
+    def stats(self):
+        with self.condition:
+            return {
+                'active': [stats.as_dict()
+                           for driver, stats in self.sessions.values()],
+                'finished': [stats.as_dict() for stats in self.finished],
+                'queued': self.queued,
+                }
+
+    def report(self):
+        with self.condition:
+            finished = list(self.finished)
+        if not finished:
+            return 'No sessions.'
+        commands = sum([stats.commands for stats in finished])
+        command_time = sum([stats.command_time for stats in finished])
+        queued = [stats.queued for stats in finished]
+        return ('%d sessions, %d commands in %.2fs;'
+                ' queue wait %.2fs average, %.2fs max' % (
+                    len(finished), commands, command_time,
+                    sum(queued) / len(queued), max(queued)))
+
+
+class DispatcherHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_request(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = None
+        if length:
+            body = self.rfile.read(length)
+        try:
+            status, data = self.server.dispatcher.handle(
+                self.command, self.path, body)
+        except DispatcherError, e:
+            status, data = 500, error_response(e.status, str(e))
+        except Exception, e:
+            status, data = 500, error_response(
+                UNKNOWN_ERROR, 'Dispatcher error: %s' % e)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_DELETE = do_request
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+
+class DispatcherServer(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, dispatcher, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, DispatcherHandler)
+        self.dispatcher = dispatcher
+        self.verbose = verbose
+
+
+def parse_args(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Dispatch WebDriver sessions to local chromedriver'
+                    ' processes.')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=4444)
+    parser.add_option('--chrome', type='int', default=0, metavar='N',
+                      help='number of chromedriver processes')
+    parser.add_option('--chromedriver', default='chromedriver',
+                      metavar='PATH')
+    parser.add_option('--chrome-sessions', type='int', metavar='N',
+                      help='sessions per chromedriver (default: %d)' % (
+                          ChromeDriverProcess.max_sessions))
+    parser.add_option('--max-sessions', type='int', metavar='N',
+                      help='sessions running at once over all drivers')
+    parser.add_option('--queue-timeout', type='float', default=300,
+                      metavar='SECONDS',
+                      help='how long new sessions wait for a free driver')
+    parser.add_option('--stats', metavar='FILE',
+                      help='write per session statistics to a JSON file')
+    parser.add_option('-v', '--verbose', action='store_true',
+                      help='log every request')
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %s' % ' '.join(args))
+    if not options.chrome:
+        parser.error('need at least one --chrome driver')
+    return options
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    options = parse_args(argv)
+    drivers = [ChromeDriverProcess(options.chromedriver,
+                                   options.chrome_sessions)
+               for n in range(options.chrome)]
+    dispatcher = Dispatcher(drivers, max_sessions=options.max_sessions,
+                            queue_timeout=options.queue_timeout)
+    server = DispatcherServer((options.host, options.port), dispatcher,
+                              verbose=options.verbose)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        try:
+            dispatcher.start()
+        except DispatcherError, e:
+            print >> sys.stderr, e
+            sys.exit(1)
+        print 'Dispatching WebDriver sessions at http://%s:%d%s' % (
+            options.host, options.port, dispatcher.prefix)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    finally:
+        server.server_close()
+        dispatcher.stop()
+        print dispatcher.report()
+        if options.stats:
+            with open(options.stats, 'w') as f:
+                json.dump(dispatcher.stats(), f, indent=1, sort_keys=True)
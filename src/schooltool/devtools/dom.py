@@ -0,0 +1,198 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Batched DOM queries for selenium browsers
+"""
+
+
+# Shared helpers of the scripts below.  Text is the rendered text where
+# the browser knows it (innerText), with whitespace collapsed.
+SCRIPT_HELPERS = """\
+var root = arguments[0] || document;
+function text(element) {
+    var value = element.innerText;
+    if (value === undefined || value === null) {
+        value = element.textContent || '';
+    }
+    return value.replace(/\\s+/g, ' ').replace(/^ | $/g, '');
+}
+function visible(element) {
+    if (!(element.offsetWidth || element.offsetHeight ||
+          element.getClientRects().length)) {
+        return false;
+    }
+    var style = window.getComputedStyle(element, null);
+    return style.visibility != 'hidden' && style.display != 'none';
+}
+"""
+
+ELEMENTS_SCRIPT = SCRIPT_HELPERS + """\
+var names = arguments[2];
+var elements = root.querySelectorAll(arguments[1]);
+var result = [];
+for (var i = 0; i < elements.length; i++) {
+    var element = elements[i];
+    var attributes = {};
+    for (var j = 0; j < names.length; j++) {
+        attributes[names[j]] = element.getAttribute(names[j]);
+    }
+    result.push({tag: element.tagName.toLowerCase(),
+                 text: text(element),
+                 value: element.value === undefined ? null : element.value,
+                 visible: visible(element),
+                 attributes: attributes});
+}
+return result;
+"""
+
+TABLE_SCRIPT = SCRIPT_HELPERS + """\
+var table = root.querySelector(arguments[1]);
+if (!table) {
+    return null;
+}
+var result = [];
+for (var i = 0; i < table.rows.length; i++) {
+    var row = table.rows[i];
+    var cells = [];
+    for (var j = 0; j < row.cells.length; j++) {
+        cells.push(text(row.cells[j]));
+    }
+    result.push({header: row.parentNode.tagName.toLowerCase() == 'thead',
+                 cells: cells});
+}
+return result;
+"""
+
+FILL_SCRIPT = SCRIPT_HELPERS + """\
+var values = arguments[1];
+var missing = [];
+function fire(element, type) {
+    var event = document.createEvent('HTMLEvents');
+    event.initEvent(type, true, false);
+    element.dispatchEvent(event);
+}
+for (var i = 0; i < values.length; i++) {
+    var selector = values[i][0], value = values[i][1];
+    var element = root.querySelector(selector);
+    if (!element) {
+        missing.push(selector);
+        continue;
+    }
+    var type = (element.type || '').toLowerCase();
+    if (type == 'checkbox' || type == 'radio') {
+        element.checked = !!value;
+    } else if (element.tagName.toLowerCase() == 'select') {
+        var selected = [].concat(value);
+        for (var j = 0; j < element.options.length; j++) {
+            var option = element.options[j];
+            option.selected = (selected.indexOf(option.value) >= 0 ||
+                               selected.indexOf(text(option)) >= 0);
+        }
+    } else {
+        element.value = value;
+    }
+    fire(element, 'input');
+    fire(element, 'change');
+}
+return missing;
+"""
+
+
+class ElementNotFound(AssertionError):
+    pass
+
+
+class DOMQuery(object):
+    """Reads and fills many elements with a single WebDriver command.
+
+    Every method takes CSS selectors and runs one script, instead of a
+    find_element and a command per value:
+
+        browser.dom.texts('#grid td.score')
+        browser.dom.table('#grid')
+        browser.dom.fill({'#name': 'John', '#active': True})
+
+    Queries look in the whole page, or in the within element.
+    """
+
+    def __init__(self, browser):
+        self.browser = browser
+
+    def run(self, script, within, *args):
+        return self.browser.execute_script(script, within, *args)
+
+    def elements(self, selector, attributes=(), within=None):
+        """Text, value, visibility and attributes of matching elements."""
+        return self.run(ELEMENTS_SCRIPT, within, selector, list(attributes))
+
+    def texts(self, selector, within=None):
+        return [element['text']
+                for element in self.elements(selector, within=within)]
+
+    def values(self, selector, within=None):
+        return [element['value']
+                for element in self.elements(selector, within=within)]
+
+    def attributes(self, selector, *names, **kw):
+        """Values of the attributes of matching elements.
+
+        With a single name, a list of values, otherwise a list of dicts.
+        """
+        elements = self.elements(selector, attributes=names,
+                                 within=kw.get('within'))
+        if len(names) == 1:
+            return [element['attributes'][names[0]] for element in elements]
+        return [element['attributes'] for element in elements]
+
+    def visible(self, selector, within=None):
+        return [element['visible']
+                for element in self.elements(selector, within=within)]
+
+    def table(self, selector, within=None, header=False):
+        """Cell texts of a table, as a list of rows.
+
+        With header=True, body rows are returned as dicts keyed by the
+        texts of the last header row.
+        """
+        rows = self.run(TABLE_SCRIPT, within, selector)
+        if rows is None:
+            raise ElementNotFound('Table %r not found' % selector)
+        if not header:
+            return [row['cells'] for row in rows]
+        headers = [row['cells'] for row in rows if row['header']]
+        if not headers and rows:
+            headers = [rows[0]['cells']]
+            rows = rows[1:]
+        names = headers and headers[-1] or []
+        return [dict(zip(names, row['cells']))
+                for row in rows if not row['header']]
+
+    def fill(self, values, within=None):
+        """Set values of form controls, given as selector: value.
+
+        Checkboxes and radio buttons take booleans, selects take option
+        values or texts (a list for multiple selects).  Change events are
+        fired, like when typing.
+        """
+        if isinstance(values, dict):
+            values = sorted(values.items())
+        missing = self.run(FILL_SCRIPT, within,
+                           [list(item) for item in values])
+        if missing:
+            raise ElementNotFound('Form controls not found: %s' % (
+                ', '.join(missing)))
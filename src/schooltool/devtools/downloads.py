@@ -0,0 +1,221 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Download completion watcher
+"""
+import errno
+import os
+import select
+import struct
+import threading
+import time
+
+
+# Browsers download into these, then rename to the final name.
+PARTIAL_SUFFIXES = ('.crdownload', '.part', '.partial', '.download', '.tmp')
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+INOTIFY_EVENT = 'iIII'
+
+
+class DownloadTimeout(Exception):
+    pass
+
+
+def is_partial(name):
+    return name.startswith('.') or name.endswith(PARTIAL_SUFFIXES)
+
+
+def load_inotify():
+    import ctypes
+    import ctypes.util
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class DownloadWatcher(object):
+    """Tracks files completely downloaded to a directory.
+
+    Uses inotify where available and polls the directory elsewhere.  When
+    polling, a file downloaded again under a name seen before is told
+    apart by its modification time and size.
+    """
+
+    poll_interval = 0.1
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.completed = []
+        self.consumed = set()
+        # Modification times and sizes of consumed files
+        self.snapshot = {}
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+    def complete(self, name):
+        """Is the named file downloaded completely?"""
+        if is_partial(name):
+            return False
+        path = os.path.join(self.directory, name)
+        if not os.path.isfile(path):
+            return False
+        for suffix in PARTIAL_SUFFIXES:
+            if os.path.exists(path + suffix):
+                return False
+        return True
+
+    def stat(self, name):
+        try:
+            st = os.stat(os.path.join(self.directory, name))
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    def consume(self, name):
+        self.consumed.add(name)
+        self.snapshot[name] = self.stat(name)
+
+    def changed(self, name):
+        """Has a consumed file changed since it was consumed?"""
+        return (self.snapshot.get(name) is not None and
+                self.stat(name) != self.snapshot[name])
+
+    def found(self, names, fresh=False):
+        with self.condition:
+            for name in names:
+                if not self.complete(name):
+                    continue
+                if name in self.consumed and (fresh or self.changed(name)):
+                    # Downloaded again
+                    self.consumed.discard(name)
+                    self.snapshot.pop(name, None)
+                    if name in self.completed:
+                        self.completed.remove(name)
+                if name not in self.completed:
+                    self.completed.append(name)
+            self.condition.notifyAll()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.mark()
+        libc = load_inotify()
+        fd = -1
+        if libc is not None:
+            fd = libc.inotify_init()
+        if fd >= 0:
+            mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE
+            wd = libc.inotify_add_watch(fd, self.directory, mask)
+            if wd < 0:
+                os.close(fd)
+                fd = -1
+        if fd >= 0:
+            target, args = self.watch, (fd, )
+        else:
+            target, args = self.poll, ()
+        self.thread = threading.Thread(
+            target=target, args=args, name='selenium-download-watcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def watch(self, fd):
+        try:
+            while not self.stopped:
+                try:
+                    ready, _, _ = select.select([fd], [], [], 0.5)
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if not ready:
+                    continue
+                data = os.read(fd, 65536)
+                names = []
+                pos = 0
+                header_size = struct.calcsize(INOTIFY_EVENT)
+                while pos + header_size <= len(data):
+                    wd, mask, cookie, length = struct.unpack(
+                        INOTIFY_EVENT, data[pos:pos+header_size])
+                    pos += header_size
+                    names.append(data[pos:pos+length].rstrip('\0'))
+                    pos += length
+                # A download may complete by removing its partial file.
+                self.found(names + [name[:-len(suffix)]
+                                    for name in names
+                                    for suffix in PARTIAL_SUFFIXES
+                                    if name.endswith(suffix)],
+                           fresh=True)
+        finally:
+            os.close(fd)
+
+    def poll(self):
+        while not self.stopped:
+            self.found(sorted(os.listdir(self.directory)))
+            time.sleep(self.poll_interval)
+
+    def mark(self):
+        """Forget downloads made so far."""
+        with self.condition:
+            names = list(self.completed)
+            if os.path.isdir(self.directory):
+                names.extend(os.listdir(self.directory))
+            for name in names:
+                self.consume(name)
+
+    def wait(self, name=None, timeout=60):
+        """Wait for a download to complete, return its path.
+
+        Waits for the named file, or the next download not waited for yet.
+        """
+        self.start()
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                pending = [n for n in self.completed
+                           if n not in self.consumed]
+                if name is not None:
+                    if (name in pending or
+                        name not in self.consumed and self.complete(name)):
+                        break
+                else:
+                    if pending:
+                        name = pending[0]
+                        break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise DownloadTimeout(
+                        'Download %s did not complete in %s seconds' % (
+                            name or 'to %s' % self.directory, timeout))
+                self.condition.wait(min(remaining, 0.5))
+            self.consume(name)
+        return os.path.join(self.directory, name)
+
+    def stop(self):
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.stopped = False
@@ -0,0 +1,137 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+State of browsers captured when selenium tests fail
+"""
+import os
+import threading
+import time
+
+from schooltool.devtools.screenshots import test_filename
+
+
+def format_console_log(entries):
+    lines = []
+    for entry in entries:
+        timestamp = entry.get('timestamp')
+        if timestamp:
+            timestamp = time.strftime('%H:%M:%S',
+                                      time.localtime(timestamp / 1000.0))
+        lines.append('%s %s %s' % (timestamp or '-', entry.get('level', '-'),
+                                   entry.get('message', '')))
+    return ''.join([line + '\n' for line in lines]).encode('utf-8')
+
+
+class FailureCapture(object):
+    """Keeps track of live browsers, and captures them when a test fails.
+
+    A screenshot, the page source and the console log of every browser
+    are taken in threads of their own.  The test runner waits for them at
+    most timeout seconds, so a hung browser cannot stall the run.
+    """
+
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self.browsers = []
+        self.lock = threading.Lock()
+
+    def add(self, browser):
+        with self.lock:
+            if browser not in self.browsers:
+                self.browsers.append(browser)
+        quit = browser.quit
+        if getattr(quit, 'failure_capture', False):
+            return
+
+        def forgetting_quit():
+            self.forget(browser)
+            return quit()
+
+        forgetting_quit.failure_capture = True
+        browser.quit = forgetting_quit
+
+    def forget(self, browser):
+        with self.lock:
+            if browser in self.browsers:
+                self.browsers.remove(browser)
+
+    def live_browsers(self):
+        with self.lock:
+            return list(self.browsers)
+
+    def capture_browser(self, browser, state):
+        """Fill state with what can be had from the browser."""
+        for name, get in [('screenshot', browser.get_screenshot_as_png),
+                          ('source', lambda: browser.page_source),
+                          ('console', lambda: browser.get_log('browser'))]:
+            try:
+                state[name] = get()
+            except Exception:
+                # Not supported by the driver, or the browser is gone.
+                continue
+
+    def capture(self, browsers):
+        """States of the browsers, as dicts in the order of browsers.
+
+        States of browsers that did not answer in time are incomplete,
+        with 'timed out' set.
+        """
+        states = []
+        threads = []
+        for browser in browsers:
+            state = {}
+            thread = threading.Thread(target=self.capture_browser,
+                                      args=(browser, state),
+                                      name='selenium-failure-capture')
+            thread.daemon = True
+            thread.start()
+            states.append(state)
+            threads.append(thread)
+        deadline = time.time() + self.timeout
+        result = []
+        for thread, state in zip(threads, states):
+            thread.join(max(0, deadline - time.time()))
+            # The thread may still add to the state.
+            state = dict(state)
+            if thread.isAlive():
+                state['timed out'] = True
+            result.append(state)
+        return result
+
+    def save(self, writer, test_id, states):
+        """Queue captured states to a ScreenshotWriter, return entries."""
+        entries = []
+        base = os.path.join('failures', test_filename(test_id))
+        for n, state in enumerate(states):
+            browser = 'browser %d' % (n + 1)
+            if 'screenshot' in state:
+                entries.append(writer.add(
+                    state['screenshot'], test_id=test_id,
+                    name='Screenshot of %s' % browser))
+            if 'source' in state:
+                entries.append(writer.add_file(
+                    '%s-%d.html' % (base, n + 1),
+                    state['source'].encode('utf-8'), test_id=test_id,
+                    name='Page source of %s' % browser))
+            if 'console' in state:
+                console = state['console']
+                entries.append(writer.add_file(
+                    '%s-%d.log' % (base, n + 1),
+                    lambda console=console: format_console_log(console),
+                    test_id=test_id, name='Console log of %s' % browser))
+        return entries
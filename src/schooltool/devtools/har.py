@@ -0,0 +1,215 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+HTTP traffic of selenium browsers as HAR
+"""
+import datetime
+import json
+import threading
+
+
+# Chrome logs network events to its performance log with these capabilities.
+CHROME_CAPTURE_CAPABILITIES = {
+    'loggingPrefs': {'performance': 'ALL'},
+    }
+CHROME_CAPTURE_OPTIONS = {
+    'perfLoggingPrefs': {'enableNetwork': True,
+                         'enablePage': False,
+                         'enableTimeline': False},
+    }
+
+
+def network_events(log_entries):
+    for entry in log_entries:
+        try:
+            message = json.loads(entry['message'])['message']
+        except (KeyError, TypeError, ValueError):
+            continue
+        method = message.get('method', '')
+        if method.startswith('Network.'):
+            yield entry, method, message.get('params', {})
+
+
+def har_timings(timing, start, total):
+    """HAR timings (ms) from DevTools resource timing of a response."""
+    if not timing:
+        return {'send': 0, 'wait': round(total, 3), 'receive': 0}
+    def span(begin, end):
+        if timing.get(begin, -1) < 0 or timing.get(end, -1) < 0:
+            return -1
+        return round(timing[end] - timing[begin], 3)
+    queued = (timing.get('requestTime', start) - start) * 1000
+    first = [timing[name]
+             for name in ('dnsStart', 'connectStart', 'sendStart')
+             if timing.get(name, -1) >= 0]
+    result = {
+        'blocked': round(max(queued + (first and first[0] or 0), 0), 3),
+        'dns': span('dnsStart', 'dnsEnd'),
+        'connect': span('connectStart', 'connectEnd'),
+        'ssl': span('sslStart', 'sslEnd'),
+        'send': max(span('sendStart', 'sendEnd'), 0),
+        'wait': max(span('sendEnd', 'receiveHeadersEnd'), 0),
+        }
+    spent = sum([max(result[name], 0)
+                 for name in ('blocked', 'dns', 'connect', 'send', 'wait')])
+    result['receive'] = round(max(total - spent, 0), 3)
+    return result
+
+
+def har_entry(record):
+    request = record['request']
+    response = record['response'] or {}
+    end = record['end'] or record['start']
+    total = (end - record['start']) * 1000
+    started = datetime.datetime.utcfromtimestamp(record['wall'])
+    entry = {
+        'startedDateTime': started.isoformat() + 'Z',
+        'time': round(total, 3),
+        'request': {
+            'method': request.get('method', 'GET'),
+            'url': request.get('url', ''),
+            'httpVersion': response.get('protocol', ''),
+            'headers': [], 'queryString': [], 'cookies': [],
+            'headersSize': -1, 'bodySize': -1,
+            },
+        'response': {
+            'status': int(response.get('status', 0)),
+            'statusText': response.get('statusText', ''),
+            'httpVersion': response.get('protocol', ''),
+            'headers': [], 'cookies': [],
+            'content': {'size': record['size'],
+                        'mimeType': response.get('mimeType', '')},
+            'redirectURL': '',
+            'headersSize': -1, 'bodySize': record['size'],
+            },
+        'cache': {},
+        'timings': har_timings(response.get('timing'), record['start'],
+                               total),
+        }
+    if record['error']:
+        entry['_error'] = record['error']
+    return entry
+
+
+def make_har(log_entries):
+    """Convert Chrome performance log entries to a HAR log.
+
+    Only what the network events tell is included: URLs, statuses,
+    sizes and timings.  Headers are left out to keep files small.
+    Request ids are only unique within a browser, entries of different
+    browsers are told apart by their 'browser' key.
+    """
+    requests = {}
+    records = []
+    for entry, method, params in network_events(log_entries):
+        request_id = (entry.get('browser'), params.get('requestId'))
+        if method == 'Network.requestWillBeSent':
+            if request_id in requests and params.get('redirectResponse'):
+                previous = requests[request_id]
+                previous['response'] = params['redirectResponse']
+                previous['end'] = params['timestamp']
+            record = {
+                'request': params.get('request', {}),
+                'start': params['timestamp'],
+                'wall': (params.get('wallTime') or
+                         entry.get('timestamp', 0) / 1000.0),
+                'response': None,
+                'end': None,
+                'size': 0,
+                'error': None,
+                }
+            requests[request_id] = record
+            records.append(record)
+        elif request_id in requests:
+            record = requests[request_id]
+            if method == 'Network.responseReceived':
+                record['response'] = params.get('response')
+            elif method == 'Network.loadingFinished':
+                record['end'] = params.get('timestamp')
+                record['size'] = int(params.get('encodedDataLength', 0))
+            elif method == 'Network.loadingFailed':
+                record['end'] = params.get('timestamp')
+                record['error'] = params.get('errorText', 'failed')
+    return {'log': {
+        'version': '1.2',
+        'creator': {'name': 'schooltool.devtools', 'version': ''},
+        'pages': [],
+        'entries': [har_entry(record) for record in records],
+        }}
+
+
+class HttpCapture(object):
+    """Collects HTTP traffic of browsers from their performance logs.
+
+    The log is drained when a browser quits and when the test ends.
+    """
+
+    def __init__(self):
+        self.browsers = []
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def add(self, browser):
+        with self.lock:
+            if browser not in self.browsers:
+                self.browsers.append(browser)
+        quit = browser.quit
+        if getattr(quit, 'http_capture', False):
+            return
+
+        def capturing_quit():
+            self.collect(browser)
+            with self.lock:
+                if browser in self.browsers:
+                    self.browsers.remove(browser)
+            return quit()
+
+        capturing_quit.http_capture = True
+        browser.quit = capturing_quit
+
+    def forget(self, browser):
+        """Stop collecting traffic of a browser that quit bypassing quit()."""
+        with self.lock:
+            if browser in self.browsers:
+                self.browsers.remove(browser)
+
+    def collect(self, browser):
+        try:
+            entries = browser.get_log('performance')
+        except Exception:
+            # No performance log, or the browser is gone.
+            return
+        for entry in entries:
+            entry['browser'] = id(browser)
+        with self.lock:
+            self.entries.extend(entries)
+
+    def stop_test(self):
+        """Return performance log entries since the last call."""
+        with self.lock:
+            browsers = list(self.browsers)
+        for browser in browsers:
+            self.collect(browser)
+        with self.lock:
+            entries, self.entries = self.entries, []
+        return entries
+
+
+def har_json(log_entries):
+    return json.dumps(make_har(log_entries), separators=(',', ':'),
+                      sort_keys=True)
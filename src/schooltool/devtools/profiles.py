@@ -0,0 +1,205 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Firefox profiles prepared once per test run
+"""
+import atexit
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+from selenium.webdriver.firefox.firefox_profile import FirefoxProfile
+from selenium.webdriver.firefox.firefox_profile import EXTENSION_NAME
+from selenium.webdriver.firefox.firefox_profile import WEBDRIVER_EXT
+
+from schooltool.devtools import selenium_recipe
+
+
+# Files FirefoxProfile leaves out of profile copies
+IGNORED_FILES = ('parent.lock', 'lock', '.parentlock')
+
+# Firefox only reads installed extensions, so copies can share them.
+# Everything else (sqlite databases, prefs.js) is written in place.
+LINKED_DIRECTORIES = ('extensions',)
+
+
+def profile_fingerprint(path):
+    """Changes when a file of the profile is added, removed or modified."""
+    digest = hashlib.sha1()
+    for base, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name in IGNORED_FILES:
+                continue
+            filename = os.path.join(base, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            digest.update('%s\0%d\0%r\n' % (
+                os.path.relpath(filename, path), stat.st_size,
+                stat.st_mtime))
+    return digest.hexdigest()
+
+
+def copy_profile(source, target, linked=LINKED_DIRECTORIES):
+    """Copy a profile directory, hard linking files of linked directories."""
+    for base, dirs, files in os.walk(source):
+        relative = os.path.relpath(base, source)
+        target_dir = os.path.normpath(os.path.join(target, relative))
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        link = relative.split(os.sep)[0] in linked
+        for name in files:
+            if name in IGNORED_FILES:
+                continue
+            filename = os.path.join(base, name)
+            target_filename = os.path.join(target_dir, name)
+            if os.path.islink(filename):
+                os.symlink(os.readlink(filename), target_filename)
+                continue
+            if link:
+                try:
+                    os.link(filename, target_filename)
+                    continue
+                except OSError:
+                    # Other file system, or no hard links there.
+                    pass
+            shutil.copy2(filename, target_filename)
+
+
+def install_webdriver_extension(path):
+    profile = FirefoxProfile.__new__(FirefoxProfile)
+    profile.profile_dir = path
+    profile.add_extension()
+
+
+class ProfileTemplate(object):
+    """A copy of a source profile that browser profiles are copied from."""
+
+    def __init__(self, source, fingerprint, webdriver_extension=False):
+        self.source = source
+        self.fingerprint = fingerprint
+        self.tempfolder = tempfile.mkdtemp(prefix='schooltool-profile-')
+        self.path = os.path.join(self.tempfolder, 'profile')
+        copy_profile(source, self.path)
+        self.webdriver_extension = webdriver_extension
+        if webdriver_extension:
+            install_webdriver_extension(self.path)
+        self._encoded = None
+        self.lock = threading.Lock()
+
+    @property
+    def encoded(self):
+        with self.lock:
+            if self._encoded is None:
+                profile = FirefoxProfile.__new__(FirefoxProfile)
+                profile.profile_dir = self.path
+                self._encoded = profile.encoded
+            return self._encoded
+
+    def remove(self):
+        shutil.rmtree(self.tempfolder, ignore_errors=True)
+
+
+class CachedFirefoxProfile(FirefoxProfile):
+    """FirefoxProfile made from a prepared template.
+
+    Profiles of local browsers are copies of the template with the
+    webdriver extension already installed.  Remote browsers only need the
+    encoded profile, they use the template as is.
+    """
+
+    def __init__(self, template, copy=True):
+        FirefoxProfile.__init__(self)
+        self.template = template
+        self.copied = copy
+        if copy:
+            os.rmdir(self.profile_dir)
+            copy_profile(template.path, self.profile_dir)
+        else:
+            os.rmdir(self.profile_dir)
+            self.profile_dir = template.path
+        self.extensionsDir = os.path.join(self.profile_dir, "extensions")
+        self.userPrefs = os.path.join(self.profile_dir, "user.js")
+        self._read_existing_userjs(self.userPrefs)
+
+    def add_extension(self, extension=WEBDRIVER_EXT):
+        if (extension == WEBDRIVER_EXT and self.template.webdriver_extension
+            and os.path.exists(os.path.join(self.extensionsDir,
+                                            EXTENSION_NAME))):
+            return
+        FirefoxProfile.add_extension(self, extension)
+
+    @property
+    def encoded(self):
+        if not self.copied:
+            return self.template.encoded
+        return FirefoxProfile.encoded.fget(self)
+
+
+class ProfileCache(object):
+    """Prepared profiles by source directory.
+
+    A template is rebuilt when files of its source profile change.
+    """
+
+    def __init__(self):
+        self.templates = {}
+        self.stale = []
+        self.lock = threading.Lock()
+
+    def template(self, source, webdriver_extension=False):
+        source = os.path.abspath(source)
+        fingerprint = profile_fingerprint(source)
+        key = (source, webdriver_extension)
+        with self.lock:
+            template = self.templates.get(key)
+            if template is not None and template.fingerprint == fingerprint:
+                return template
+            if template is not None:
+                # Remote profiles may still be encoding it.
+                self.stale.append(template)
+            template = ProfileTemplate(source, fingerprint,
+                                       webdriver_extension=webdriver_extension)
+            self.templates[key] = template
+            return template
+
+    def profile(self, source, remote=False):
+        template = self.template(source, webdriver_extension=not remote)
+        return CachedFirefoxProfile(template, copy=not remote)
+
+    def stop(self):
+        with self.lock:
+            templates = self.templates.values() + self.stale
+            self.templates.clear()
+            self.stale = []
+        for template in templates:
+            template.remove()
+
+
+profile_cache = ProfileCache()
+selenium_recipe.cleanups.append(profile_cache.stop)
+atexit.register(profile_cache.stop)
+
+
+def cached_profile(path, remote=False):
+    """FirefoxProfile of the profile directory for a local or remote browser."""
+    return profile_cache.profile(path, remote=remote)
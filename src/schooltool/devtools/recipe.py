@@ -0,0 +1,84 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Selenium test runner buildout recipe
+
+Kept apart from selenium_recipe, which every bin/test imports, so that
+test runs do not import zc.buildout.
+"""
+import sys
+
+import zc.recipe.testrunner
+
+from schooltool.devtools.selenium_recipe import BadOptions
+from schooltool.devtools.selenium_recipe import unflatten_options
+from schooltool.devtools.selenium_recipe import selenium_config_script
+from schooltool.devtools.selenium_recipe import selenium_options_script
+
+
+class SeleniumRunnerRecipe(zc.recipe.testrunner.TestRunner):
+
+    def __init__(self, buildout, name, options):
+        zc.recipe.testrunner.TestRunner.__init__(self, buildout, name, options)
+        selenium_init = self.getSeleniumSection(options)
+        extra_init = options.get('initialization', '').strip()
+        options['initialization'] = '%s\n\n%s' % (selenium_init, extra_init)
+
+    def getSeleniumSection(self, options):
+        driver_configs = unflatten_options(options, "selenium")
+        if not driver_configs:
+            return ''
+        default_driver = driver_configs.pop('default', None)
+        if default_driver and default_driver not in driver_configs:
+            raise BadOptions('No configuration for default driver'
+                             'selenium.%s' % default_driver)
+
+        try:
+            from schooltool.devtools.webdriver import ScriptFactory
+            script_factory = ScriptFactory()
+        except SyntaxError:
+            print >> sys.stderr, 'warning: selenium is not compatible with python << 2.6'
+            return ''
+
+        scripts = []
+
+        implicit_wait = driver_configs.pop('implicit_wait', None)
+        if implicit_wait is not None:
+            scripts.append(
+                'schooltool.devtools.selenium_recipe'
+                '.default_browser_config.implicit_wait = %f' % (
+                    float(implicit_wait)))
+
+        for driver, config in sorted(driver_configs.items()):
+            if (not isinstance(config, dict) and
+                config != "default"):
+                raise BadOptions(
+                    'Driver %r config must be a dict in form of'
+                    ' "mydriver.setting = ..." or "mydriver=default"'
+                    ' for standard WebDrivers, not'
+                    ' %r' % (driver, config))
+            if config == "default":
+                scripts.append(script_factory(driver, {}))
+            else:
+                scripts.append(script_factory(driver, config))
+
+        return selenium_config_script % {
+            'default_factory': default_driver,
+            'factory_templates': '\n\n'.join(scripts),
+            'selenium_options': selenium_options_script,
+            }
@@ -0,0 +1,137 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Recording of the virtual display, kept for failing tests
+"""
+import glob
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+# Segments are kept in memory, where available
+SHARED_MEMORY = '/dev/shm'
+
+
+class DisplayRecorder(object):
+    """Records an X display into a ring of short video segments.
+
+    ffmpeg overwrites the oldest segment when it starts a new one, so the
+    recording takes a fixed amount of memory in /dev/shm and nothing is
+    written to disk.  recording() returns the last seconds of the display
+    as an MPEG transport stream, segments of which can be concatenated.
+    """
+
+    ffmpeg = 'ffmpeg'
+    fps = 5
+    segment_seconds = 5
+
+    process = None
+    directory = None
+
+    def __init__(self, seconds=30, fps=None, segment_seconds=None):
+        if fps is not None:
+            self.fps = fps
+        if segment_seconds is not None:
+            self.segment_seconds = segment_seconds
+        self.seconds = seconds
+        # One more segment for the one being written.
+        self.segments = int(math.ceil(
+            float(seconds) / self.segment_seconds)) + 1
+
+    def command(self, display, size):
+        return [
+            self.ffmpeg, '-nostdin', '-loglevel', 'error',
+            '-f', 'x11grab', '-draw_mouse', '0',
+            '-framerate', str(self.fps),
+            '-video_size', '%dx%d' % tuple(size),
+            '-i', display,
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'zerolatency',
+            '-pix_fmt', 'yuv420p',
+            # Segments start at key frames.
+            '-force_key_frames',
+            'expr:gte(t,n_forced*%d)' % self.segment_seconds,
+            '-f', 'segment', '-segment_format', 'mpegts',
+            '-segment_time', str(self.segment_seconds),
+            '-segment_wrap', str(self.segments),
+            os.path.join(self.directory, 'segment-%03d.ts'),
+            ]
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self, display, size):
+        """Start recording the display (say, ':1') of the given size."""
+        self.stop()
+        parent = None
+        if os.path.isdir(SHARED_MEMORY):
+            parent = SHARED_MEMORY
+        self.directory = tempfile.mkdtemp(prefix='schooltool-recording-',
+                                          dir=parent)
+        # ffmpeg has its own copies of these.
+        devnull = open(os.devnull)
+        log = open(os.path.join(self.directory, 'ffmpeg.log'), 'w')
+        try:
+            self.process = subprocess.Popen(
+                self.command(display, size),
+                stdin=devnull, stdout=log, stderr=log)
+        except OSError, e:
+            print >> sys.stderr, (
+                'warning: cannot record display %s: %s: %s' % (
+                    display, self.ffmpeg, e))
+            self.process = None
+        finally:
+            devnull.close()
+            log.close()
+
+    def recording(self):
+        """The last seconds of the display, None if nothing was recorded."""
+        if self.directory is None:
+            return None
+        if self.process is not None and not self.alive:
+            print >> sys.stderr, (
+                'warning: display recording stopped, see %s' % (
+                    os.path.join(self.directory, 'ffmpeg.log')))
+        segments = []
+        for filename in glob.glob(os.path.join(self.directory, '*.ts')):
+            try:
+                segments.append((os.path.getmtime(filename), filename))
+            except OSError:
+                # Removed by ffmpeg meanwhile.
+                continue
+        data = []
+        for mtime, filename in sorted(segments):
+            try:
+                with open(filename, 'rb') as f:
+                    data.append(f.read())
+            except IOError:
+                continue
+        return ''.join(data) or None
+
+    def stop(self):
+        process, self.process = self.process, None
+        if process is not None and process.poll() is None:
+            process.terminate()
+            process.wait()
+        directory, self.directory = self.directory, None
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
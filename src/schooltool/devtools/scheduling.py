@@ -0,0 +1,314 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Test history, sharding and ordering of test runs
+"""
+import fcntl
+import hashlib
+import inspect
+import json
+import optparse
+import os
+import sys
+import time
+
+
+class TestHistory(object):
+    """Durations and outcomes of tests in previous runs.
+
+    The history is a JSON file mapping test ids to their last duration,
+    outcome and run time.  Parallel test runner processes merge their
+    results into the same file.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.tests = {}
+        self.recorded = {}
+        if path is not None:
+            self.tests = load_history(path)
+
+    def duration(self, test_id, default=None):
+        return self.tests.get(test_id, {}).get('duration', default)
+
+    def average_duration(self):
+        durations = [result['duration'] for result in self.tests.values()
+                     if 'duration' in result]
+        if not durations:
+            return 0.0
+        return float(sum(durations)) / len(durations)
+
+    def failed(self, test_id):
+        """Did the test fail on its last run?"""
+        outcome = self.tests.get(test_id, {}).get('outcome')
+        return outcome in ('failure', 'error')
+
+    def changed(self, test_id, source=None):
+        """Is the test new, or has its source changed since its last run?"""
+        if test_id not in self.tests:
+            return True
+        recorded = self.tests[test_id].get('source')
+        return (source is not None and recorded is not None and
+                source != recorded)
+
+    def record(self, test_id, duration, outcome, source=None):
+        self.recorded[test_id] = {
+            'duration': duration,
+            'outcome': outcome,
+            'time': time.time(),
+            }
+        if source is not None:
+            self.recorded[test_id]['source'] = source
+
+    def save(self, path=None):
+        """Merge the recorded results into the history file."""
+        if path is None:
+            path = self.path
+        if not self.recorded:
+            return
+        lock = open(path + '.lock', 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            tests = load_history(path)
+            tests.update(self.recorded)
+            save_history(path, tests)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+        self.tests.update(self.recorded)
+        self.recorded = {}
+
+
+def load_history(path):
+    try:
+        with open(path) as f:
+            return json.load(f)['tests']
+    except (IOError, ValueError, KeyError, TypeError):
+        return {}
+
+
+def save_history(path, tests):
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump({'tests': tests}, f, indent=1, sort_keys=True)
+    os.rename(temp_path, path)
+
+
+def merge_histories(paths):
+    """Combine histories, keeping the latest result of every test."""
+    tests = {}
+    for path in paths:
+        for test_id, result in load_history(path).items():
+            if (test_id not in tests or
+                tests[test_id].get('time', 0) <= result.get('time', 0)):
+                tests[test_id] = result
+    return tests
+
+
+def parse_shard(value):
+    """Parse "N/M", the Nth of M shards."""
+    try:
+        index, count = [int(n) for n in value.split('/')]
+    except ValueError:
+        raise ValueError('Shard must be given as N/M, not %r' % value)
+    if not 1 <= index <= count:
+        raise ValueError('Shard %r does not exist' % value)
+    return index, count
+
+
+def split_shards(test_ids, count, history=None):
+    """Split tests into count shards of about the same duration.
+
+    Tests are bin packed by their durations in the history, longest
+    first, each to the shard with the least work so far.  Tests not in
+    the history count as the average test.  Without any history, tests
+    are split into runs of consecutive tests of the same size, which
+    keeps tests of a layer together.
+    """
+    durations = {}
+    if history is not None:
+        for test_id in test_ids:
+            duration = history.duration(test_id)
+            if duration is not None:
+                durations[test_id] = duration
+    shards = [[] for n in range(count)]
+    if not durations:
+        size, extra = divmod(len(test_ids), count)
+        start = 0
+        for n in range(count):
+            end = start + size + (n < extra)
+            shards[n] = list(test_ids[start:end])
+            start = end
+        return shards
+    average = float(sum(durations.values())) / len(durations)
+    loads = [0.0] * count
+    work = sorted(set(test_ids),
+                  key=lambda test_id: (-durations.get(test_id, average),
+                                       test_id))
+    assigned = {}
+    for test_id in work:
+        n = loads.index(min(loads))
+        loads[n] += durations.get(test_id, average)
+        assigned[test_id] = n
+    for test_id in test_ids:
+        shards[assigned[test_id]].append(test_id)
+    return shards
+
+
+def select_shard(test_ids, index, count, history=None):
+    """Return tests of the index-th (1 based) of count shards, in order."""
+    return split_shards(test_ids, count, history)[index - 1]
+
+
+def test_source_file(test):
+    dt_test = getattr(test, '_dt_test', None)
+    if dt_test is not None:
+        return dt_test.filename
+    try:
+        return inspect.getsourcefile(type(test))
+    except TypeError:
+        return None
+
+
+class SourceFingerprints(object):
+    """Hashes of the source files of tests."""
+
+    def __init__(self):
+        self.hashes = {}
+
+    def __call__(self, test):
+        path = test_source_file(test)
+        if path is None:
+            return None
+        if path not in self.hashes:
+            try:
+                with open(path, 'rb') as f:
+                    self.hashes[path] = hashlib.sha1(f.read()).hexdigest()
+            except IOError:
+                self.hashes[path] = None
+        return self.hashes[path]
+
+
+ORDERS = ('failed', 'slowest', 'new')
+
+
+def order_key(order, history, fingerprints=None):
+    """Return the sort key of tests for the order.
+
+    failed: tests that failed on their last run first
+    slowest: longest tests first, tests not in history count as average
+    new: new tests and tests with changed source files first
+    """
+    if order == 'failed':
+        return lambda test: not history.failed(test.id())
+    elif order == 'slowest':
+        average = history.average_duration()
+        return lambda test: -history.duration(test.id(), average)
+    elif order == 'new':
+        if fingerprints is None:
+            fingerprints = SourceFingerprints()
+        return lambda test: not history.changed(test.id(), fingerprints(test))
+    raise ValueError('Unknown test order %r, use one of: %s' % (
+        order, ', '.join(ORDERS)))
+
+
+def layer_path(layer):
+    """The layer and its first bases, from the most general one."""
+    path = []
+    while layer is not None and layer is not object:
+        path.insert(0, layer)
+        bases = getattr(layer, '__bases__', ())
+        if not bases:
+            break
+        layer = bases[0]
+    return path
+
+
+def order_layers(layers, order, key):
+    """Sort (layer_name, layer, tests) by the sort key of their tests.
+
+    Layers that share a base stay together, so that the base is not set
+    up and torn down again: groups of layers with a common base are
+    sorted, then the layers inside each group, a base layer before the
+    layers built on it.  Layers keep their order if their keys are equal.
+    For the slowest order, layers are sorted by their total time, so that
+    the longest layers start first in parallel runs.
+    """
+    def combine(keys):
+        keys = list(keys) or [0]
+        if order == 'slowest':
+            return sum(keys)
+        return min(keys)
+
+    def sort(entries, depth):
+        groups = []
+        members = {}
+        for n, (path, layer_key, item) in enumerate(entries):
+            if len(path) > depth:
+                group = path[depth]
+            else:
+                group = ('layer', n)
+            if group not in members:
+                groups.append(group)
+                members[group] = []
+            members[group].append((path, layer_key, item))
+        groups.sort(key=lambda group: combine(
+            [layer_key for path, layer_key, item in members[group]]))
+        result = []
+        for group in groups:
+            nested = []
+            for entry in members[group]:
+                if len(entry[0]) > depth + 1:
+                    nested.append(entry)
+                else:
+                    result.append(entry[2])
+            result.extend(sort(nested, depth + 1))
+        return result
+
+    return sort([(layer_path(item[1]),
+                  combine([key(test) for test in item[2]]),
+                  item)
+                 for item in layers], 0)
+
+
+def parse_args(argv):
+    """Parse the command line arguments"""
+    parser = optparse.OptionParser(
+        usage="usage: %prog [options] OUTPUT HISTORY...",
+        description="Merge test histories of shards (--selenium-history)"
+                    " into one for the next run, and report failed tests.")
+    options, args = parser.parse_args(argv)
+    if len(args) < 3:
+        parser.error('Need the output file and at least one history')
+    return options, args[1], args[2:]
+
+
+def main():
+    options, output, paths = parse_args(sys.argv)
+    tests = merge_histories(paths)
+    save_history(output, tests)
+    failed = sorted([test_id for test_id, result in tests.items()
+                     if result.get('outcome') in ('failure', 'error')])
+    total = sum([result.get('duration', 0) for result in tests.values()])
+    print 'Merged %d tests (%.2fs) from %d histories into %s' % (
+        len(tests), total, len(paths), output)
+    if failed:
+        print 'Failed on their last run:'
+        for test_id in failed:
+            print '    %s' % test_id
+        sys.exit(1)
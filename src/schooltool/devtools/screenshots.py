@@ -0,0 +1,218 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Background writer for selenium screenshots and other test output
+"""
+import hashlib
+import json
+import os
+import re
+import struct
+import sys
+import threading
+import urllib
+import zlib
+import Queue
+
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# Chunks needed to display the image, everything else is dropped.
+PNG_CRITICAL_CHUNKS = ('IHDR', 'PLTE', 'tRNS', 'IEND')
+
+
+def png_chunks(data):
+    pos = len(PNG_SIGNATURE)
+    while pos < len(data):
+        length, = struct.unpack('>I', data[pos:pos+4])
+        chunk_type = data[pos+4:pos+8]
+        yield chunk_type, data[pos+8:pos+8+length]
+        pos += length + 12
+
+
+def png_chunk(chunk_type, chunk_data):
+    crc = zlib.crc32(chunk_type + chunk_data) & 0xffffffff
+    return (struct.pack('>I', len(chunk_data)) + chunk_type + chunk_data +
+            struct.pack('>I', crc))
+
+
+def optimize_png(data, level=9):
+    """Recompress PNG image data at the given zlib level.
+
+    Ancillary chunks (text, timestamps, gamma) are dropped.  The original
+    data is returned if it is not a PNG or recompressing does not help.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        return data
+    try:
+        chunks = []
+        image = []
+        for chunk_type, chunk_data in png_chunks(data):
+            if chunk_type == 'IDAT':
+                image.append(chunk_data)
+                if len(image) == 1:
+                    chunks.append((chunk_type, None))
+            elif chunk_type in PNG_CRITICAL_CHUNKS:
+                chunks.append((chunk_type, chunk_data))
+        pixels = zlib.decompress(''.join(image))
+    except (struct.error, zlib.error):
+        return data
+    result = [PNG_SIGNATURE]
+    for chunk_type, chunk_data in chunks:
+        if chunk_type == 'IDAT':
+            chunk_data = zlib.compress(pixels, level)
+        result.append(png_chunk(chunk_type, chunk_data))
+    result = ''.join(result)
+    if len(result) >= len(data):
+        return data
+    return result
+
+
+def test_filename(test_id, extension=''):
+    """Name of a file for output of a test."""
+    return re.sub(r'[^\w.-]+', '_', test_id).strip('_') + extension
+
+
+class ScreenshotWriter(object):
+    """Writes screenshots from a worker thread.
+
+    Screenshots are stored once per distinct image, named by their content
+    hash.  index.json in the directory maps test ids to the screenshots
+    and other files they saved.
+    """
+
+    index_name = 'index.json'
+
+    def __init__(self, directory, url=None):
+        self.directory = directory
+        self.url = url
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.index = self.load_index()
+        self.saved = set()
+        self.thread = None
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, self.index_name)
+
+    def load_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def url_for(self, filename):
+        if self.url:
+            return self.url + urllib.quote(filename)
+        return 'file://' + urllib.pathname2url(
+            os.path.abspath(os.path.join(self.directory, filename)))
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(
+                target=self.run, name='selenium-screenshot-writer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def add_entry(self, test_id, filename, name):
+        entry = {'name': name,
+                 'file': filename,
+                 'url': self.url_for(filename)}
+        with self.lock:
+            if test_id is not None:
+                if test_id not in self.saved:
+                    # Forget files of the previous run of this test
+                    self.saved.add(test_id)
+                    self.index[test_id] = []
+                self.index[test_id].append(entry)
+        return entry
+
+    def add(self, png, test_id=None, name=None):
+        """Queue a screenshot, return its index entry."""
+        filename = hashlib.sha1(png).hexdigest() + '.png'
+        entry = self.add_entry(test_id, filename, name)
+        self.start()
+        self.queue.put((self.write, filename, png))
+        return entry
+
+    def add_file(self, filename, data, test_id=None, name=None):
+        """Queue other test output (say, page source), return its entry.
+
+        data can be a function returning the data, to do conversions in
+        the writer thread.  Unlike screenshots, the file is overwritten if
+        it exists.
+        """
+        entry = self.add_entry(test_id, filename, name)
+        self.start()
+        self.queue.put((self.write_file, filename, data))
+        return entry
+
+    def write(self, filename, png):
+        path = os.path.join(self.directory, filename)
+        if os.path.exists(path):
+            return
+        self.write_file(filename, optimize_png(png))
+
+    def write_file(self, filename, data):
+        if callable(data):
+            data = data()
+        path = os.path.join(self.directory, filename)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.rename(temp_path, path)
+
+    def run(self):
+        while True:
+            write, filename, data = self.queue.get()
+            try:
+                if write is not None:
+                    write(filename, data)
+            except Exception, e:
+                print >> sys.stderr, (
+                    'warning: could not save %s: %s' % (filename, e))
+            finally:
+                self.queue.task_done()
+            if write is None:
+                break
+
+    def flush(self):
+        """Wait for queued screenshots and write the index."""
+        if self.thread is not None:
+            self.queue.join()
+        with self.lock:
+            if not self.saved:
+                return
+            data = json.dumps(self.index, indent=1, sort_keys=True)
+        with open(self.index_path, 'w') as f:
+            f.write(data)
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put((None, None, None))
+            thread.join()
@@ -37,27 +37,66 @@ To use the selenium testrunner, add a section to buildout.cfg::
   #selenium.html_unit.capabilities = HTMLUNITWITHJS
 
 """
+import errno
+import fcntl
+import json
 import os, sys
-import zc.recipe.testrunner
+import re
+import shutil
+import tempfile
+import time
+import types
+import urllib
 from zope.testrunner.runner import Runner as ZopeTestRunner
+from zope.testrunner.find import name_from_layer
 import zope.testrunner.feature
 
+from schooltool.devtools.browserpool import BrowserPool, BrowserWatchdog
+from schooltool.devtools.browserpool import SpareBrowsers, quit_listeners
+from schooltool.devtools.screenshots import ScreenshotWriter, test_filename
+from schooltool.devtools.downloads import DownloadWatcher
+from schooltool.devtools.timing import SeleniumTimings, time_commands
+from schooltool.devtools.trace import CommandTracer, trace_commands
+from schooltool.devtools.dom import DOMQuery
+from schooltool.devtools.recording import DisplayRecorder
+from schooltool.devtools.failures import FailureCapture
+from schooltool.devtools.waits import Waits
+from schooltool.devtools.sessions import SessionCache
+from schooltool.devtools.har import HttpCapture, har_json
+from schooltool.devtools.scheduling import TestHistory, parse_shard
+from schooltool.devtools.scheduling import select_shard, SourceFingerprints
+from schooltool.devtools.scheduling import order_key, order_layers
+
 
 class BrowserConfig(object):
     implicit_wait = 30
 
+    # Explicit waits (browser.waits), poll intervals grow by wait_backoff
+    wait_timeout = 30
+    wait_poll = 0.05
+    wait_backoff = 1.5
+    wait_max_poll = 1.0
+
     screenshots_dir = None # Directory to store screenshots
     screenshots_url = None # (external) URL to screenshots directory
+    # Deprecated: screenshots are named by their content, so nothing is
+    # overwritten.  Kept for test suites that read it.
     overwrite_screenshots = False
 
     downloads_dir = None # Directory to store downloads
     downloads_url = None # (external) URL to downloads directory
 
+    reuse_browsers = False # Hand out pooled browsers from spawn_browser
+
+    headless = False # Use the browser's built-in headless mode, no X server
+    capture_http = False # Save HTTP traffic of tests next to screenshots
+    window_size = (1024, 768) # Window size of headless browsers
+
     def __init__(self, **kw):
         kw = dict(kw)
         for attr in self._settings():
             if attr in kw:
-                value = kw.pop()
+                value = kw.pop(attr)
                 setattr(self, attr, value)
         if kw:
             raise TypeError(
@@ -65,9 +104,9 @@ class BrowserConfig(object):
                     ', '.join((kw))))
 
     def _settings(self):
-        for attr in self.__class__.__dict__:
+        for attr, value in self.__class__.__dict__.items():
             if (not attr.startswith('_') and
-                attr not in ('update', 'copy')):
+                not isinstance(value, types.FunctionType)):
                 yield attr
 
     def update(self, other_config):
@@ -83,6 +122,28 @@ class BrowserConfig(object):
                     (self.__class__,),
                     config)()
 
+    def wait_for_download(self, name=None, timeout=60):
+        """Wait until a download to downloads_dir completes.
+
+        Waits for the named file, or for the next download not waited for
+        yet in this test.  Returns (path, url) of the downloaded file.
+        """
+        watcher = get_download_watcher(self)
+        if watcher is None:
+            raise SeleniumNotConfigured("Downloads directory not configured.")
+        start = time.time()
+        try:
+            path = watcher.wait(name=name, timeout=timeout)
+        finally:
+            if timings is not None:
+                timings.add('downloads', time.time() - start)
+        filename = os.path.basename(path)
+        if self.downloads_url:
+            url = self.downloads_url + urllib.quote(filename)
+        else:
+            url = 'file://' + urllib.pathname2url(os.path.abspath(path))
+        return path, url
+
     def __str__(self):
         result = ['<%s> :' % self.__class__.__name__]
         for attr in sorted(self._settings()):
@@ -95,6 +156,50 @@ class BrowserConfig(object):
 factories = {}
 default_factory = None
 
+browser_pool = BrowserPool(factories)
+
+virtual_display = None
+
+# Callables run once at the end of the test run
+cleanups = []
+
+# Texts shown in the report at the end of the test run
+reports = []
+
+# Id of the test being run
+current_test = None
+
+# Name of the layer being run
+current_layer = None
+
+# Logged in browser states of the current layer
+session_cache = SessionCache()
+
+http_capture = HttpCapture()
+quit_listeners.append(http_capture.forget)
+
+# Live browsers, captured when a test fails
+failure_capture = FailureCapture()
+quit_listeners.append(failure_capture.forget)
+
+screenshot_writers = {}
+
+download_watchers = {}
+
+# SeleniumTimings of the run, if requested
+timings = None
+
+# CommandTracer of the run, if requested
+tracer = None
+
+test_history = None
+
+# Tests of the shard, for test runner subprocesses
+shard_selection_variable = 'SCHOOLTOOL_SELENIUM_SHARD'
+
+# Where test runner subprocesses save timings for the main process
+timings_file_variable = 'SCHOOLTOOL_SELENIUM_TIMINGS'
+
 default_browser_config = BrowserConfig()
 
 
@@ -118,11 +223,90 @@ def spawn_browser(factory_name=None, config=None):
                 "Default selenium web driver not configured.")
         raise SeleniumNotConfigured(
             "Web driver %r not configured." % factory_name)
-    browser = factories[factory_name](config=config)
+    if virtual_display is not None:
+        virtual_display.ensure()
+    start = time.time()
+    if config.reuse_browsers:
+        browser = browser_pool.acquire(factory_name, config)
+    else:
+        browser = browser_pool.new_browser(factory_name, config)
+    if timings is not None:
+        timings.add('spawn', time.time() - start)
+        time_commands(browser, timings)
+    if tracer is not None:
+        trace_commands(browser, tracer)
+    if config.capture_http:
+        http_capture.add(browser)
+    failure_capture.add(browser)
     browser.implicitly_wait(config.implicit_wait)
+    browser.dom = DOMQuery(browser)
+    browser.waits = Waits(browser,
+                          timeout=config.wait_timeout,
+                          poll=config.wait_poll,
+                          backoff=config.wait_backoff,
+                          max_poll=config.wait_max_poll,
+                          implicit_wait=config.implicit_wait,
+                          timings=timings)
     return browser
 
 
+def get_screenshot_writer(config=None):
+    if config is None:
+        config = default_browser_config
+    if not config.screenshots_dir:
+        return None
+    directory = os.path.abspath(config.screenshots_dir)
+    if directory not in screenshot_writers:
+        writer = ScreenshotWriter(directory, url=config.screenshots_url)
+        screenshot_writers[directory] = writer
+        cleanups.append(writer.close)
+    return screenshot_writers[directory]
+
+
+def get_download_watcher(config=None):
+    if config is None:
+        config = default_browser_config
+    if not config.downloads_dir:
+        return None
+    directory = os.path.abspath(config.downloads_dir)
+    if directory not in download_watchers:
+        watcher = DownloadWatcher(directory)
+        watcher.start()
+        download_watchers[directory] = watcher
+        cleanups.append(watcher.stop)
+    return download_watchers[directory]
+
+
+def login_cached(browser, user, login, check=None):
+    """Log the browser in as user, reusing the session of an earlier login.
+
+    login(browser) logs in through the UI.  It is called for the first
+    login of the user in the layer; later logins restore the cookies and
+    storage it left.  check(browser), if given, verifies that a restored
+    session is still logged in.
+    """
+    session_cache.login(browser, (user, current_layer), login, check=check)
+
+
+def save_screenshot(browser, name=None, test_id=None, config=None):
+    """Take a screenshot, and save it in background.
+
+    Returns the URL of the screenshot.  Identical screenshots are stored
+    only once.
+    """
+    writer = get_screenshot_writer(config)
+    if writer is None:
+        return None
+    if test_id is None:
+        test_id = current_test
+    start = time.time()
+    entry = writer.add(browser.get_screenshot_as_png(),
+                       test_id=test_id, name=name)
+    if timings is not None:
+        timings.add('screenshots', time.time() - start)
+    return entry['url']
+
+
 def eval_val(val):
     try:
         return eval(val)
@@ -163,6 +347,7 @@ schooltool.devtools.selenium_recipe.default_factory = %(default_factory)r
 
 selenium_options_script = '''
 import schooltool.devtools.selenium_recipe
+import schooltool.devtools.scheduling
 
 import optparse
 import zope.testrunner.options
@@ -186,6 +371,9 @@ selenium_options.add_option(
     dest='selenium_headless_backend',
     help="""\
 Select virtual display backend: xvfb, xvnc, xephyr.
+With "native", browsers run in their built-in headless mode
+and no virtual display is started.  Firefox has no headless mode
+with selenium 2, it still runs under a virtual display.
 """)
 
 zope.testrunner.options.parser.set_default(
@@ -234,7 +422,8 @@ External URL to screenshots directory.  Use file:// if not specified.
 selenium_options.add_option(
     '--selenium-overwrite-screenshots', action="store_true", dest='selenium_overwrite',
     help="""\
-Overwrite existing files when taking screenshots.
+Deprecated, screenshots are named by their content and never overwritten.
+Sets overwrite_screenshots of the browser configuration.
 """)
 
 selenium_options.add_option(
@@ -253,6 +442,142 @@ selenium_options.add_option(
 External URL to downloads directory.  Use file:// if not specified.
 """)
 
+selenium_options.add_option(
+    '--selenium-failure-capture', action="store", type="float",
+    dest='selenium_failure_capture', metavar='SECONDS',
+    help="""\
+When a test fails, save a screenshot, the page source and the console
+log of every live browser next to the screenshots, waiting at most
+SECONDS for them (default: 10).  0 turns capture off.
+""")
+
+zope.testrunner.options.parser.set_default('selenium_failure_capture', 10)
+
+selenium_options.add_option(
+    '--selenium-record-failures', action="store", type="int",
+    dest='selenium_record_failures', metavar='SECONDS',
+    help="""\
+Record the virtual display with ffmpeg, keeping the last SECONDS
+in memory, and save them next to the screenshots when a test fails.
+Needs --selenium-headless with an X server backend.
+""")
+
+selenium_options.add_option(
+    '--selenium-reuse-browsers', action="store_true",
+    dest='selenium_reuse_browsers',
+    help="""\
+Keep spawned browsers in a pool and reuse them between tests.
+Cookies, storage and extra windows are reset when a test ends.  Browsers
+that visited more than one origin are quit, as their cookies and storage
+can only be cleared for the page they are on.
+""")
+
+selenium_options.add_option(
+    '--selenium-spare-browsers', action="store", type="int",
+    dest='selenium_spare_browsers', metavar='N',
+    help="""\
+Keep N browsers of each kind spawned in the background, ready for tests
+that ask for one.  Every browser factory and configuration used by tests
+gets N spares of its own.  The default, 0, spawns browsers when tests ask.
+""")
+
+zope.testrunner.options.parser.set_default('selenium_spare_browsers', 0)
+
+selenium_options.add_option(
+    '--selenium-recycle-tests', action="store", type="int",
+    dest='selenium_recycle_tests', metavar='N',
+    help="""\
+Replace a pooled browser with a fresh one after it served N tests.
+""")
+
+selenium_options.add_option(
+    '--selenium-recycle-rss', action="store", type="int",
+    dest='selenium_recycle_rss', metavar='MB',
+    help="""\
+Replace a pooled browser with a fresh one when its browser and driver
+processes use more than MB megabytes of resident memory.
+""")
+
+selenium_options.add_option(
+    '--selenium-implicit-wait', action="store", type="float",
+    dest='selenium_implicit_wait', metavar='SECONDS',
+    help="""\
+Implicit wait of spawned browsers.  With 0, lookups of missing elements
+fail immediately; use browser.waits to wait for elements explicitly.
+""")
+
+selenium_options.add_option(
+    '--selenium-wait-timeout', action="store", type="float",
+    dest='selenium_wait_timeout', metavar='SECONDS',
+    help="""\
+Default timeout of explicit waits (browser.waits).
+""")
+
+selenium_options.add_option(
+    '--selenium-capture-http', action="store_true",
+    dest='selenium_capture_http',
+    help="""\
+Save HTTP requests of each test with their timings as HAR files
+to the http/ subdirectory of the screenshots directory.  Needs
+Chrome, which logs network events to its performance log.
+""")
+
+selenium_options.add_option(
+    '--selenium-timings', action="store", type="int",
+    dest='selenium_timings', metavar='N',
+    help="""\
+Report the N slowest selenium tests with their browser spawn,
+WebDriver command, implicit wait, screenshot and download times,
+and the same times per layer.
+""")
+
+zope.testrunner.options.parser.set_default('selenium_timings', 0)
+
+selenium_options.add_option(
+    '--selenium-timings-file', action="store", type="string",
+    dest='selenium_timings_file',
+    help="""\
+Write selenium times of all tests and layers to this file as JSON.
+""")
+
+selenium_options.add_option(
+    '--selenium-trace', action="store", type="string",
+    dest='selenium_trace', metavar='FILE',
+    help="""\
+Trace WebDriver commands.  Writes time in commands by test code stack
+to FILE, for flamegraph.pl, and command histograms of every test and of
+the run to FILE.json.
+""")
+
+selenium_options.add_option(
+    '--selenium-history', action="store", type="string",
+    dest='selenium_history', metavar='FILE',
+    help="""\
+Keep durations and outcomes of tests in this file.
+Used to balance shards (--selenium-shard).  Merge histories
+of shards with the mergetesthistory script.
+""")
+
+selenium_options.add_option(
+    '--selenium-shard', action="store", type="string",
+    dest='selenium_shard', metavar='N/M',
+    help="""\
+Run only the Nth of M shards of tests, e.g. 2/4.  Shards take
+about the same time according to --selenium-history, or have the
+same number of tests if there is no history.
+""")
+
+selenium_options.add_option(
+    '--selenium-order', action="store", type="choice",
+    choices=list(schooltool.devtools.scheduling.ORDERS),
+    dest='selenium_order',
+    help="""\
+Order tests by their --selenium-history: "failed" runs tests
+that failed last time first, "slowest" runs the longest tests
+and layers first, "new" runs new tests and tests with changed
+source files first.
+""")
+
 zope.testrunner.options.parser.add_option_group(selenium_options)
 
 # Replace the default Zope test runner
@@ -260,78 +585,219 @@ zope.testrunner.runner.Runner = schooltool.devtools.selenium_recipe.Runner
 '''
 
 
-class SeleniumRunnerRecipe(zc.recipe.testrunner.TestRunner):
+def SeleniumRunnerRecipe(buildout, name, options):
+    """The recipe at its old place, for buildouts that still name it.
+
+    The recipe lives in schooltool.devtools.recipe, imported only when
+    buildout asks for it.
+    """
+    from schooltool.devtools.recipe import SeleniumRunnerRecipe
+    return SeleniumRunnerRecipe(buildout, name, options)
+
 
-    def __init__(self, buildout, name, options):
-        zc.recipe.testrunner.TestRunner.__init__(self, buildout, name, options)
-        selenium_init = self.getSeleniumSection(options)
-        extra_init = options.get('initialization', '').strip()
-        options['initialization'] = '%s\n\n%s' % (selenium_init, extra_init)
+virtual_display_lock = '/tmp/.schooltool-selenium-display.lock'
 
-    def getSeleniumSection(self, options):
-        driver_configs = unflatten_options(options, "selenium")
-        if not driver_configs:
-            return ''
-        default_driver = driver_configs.pop('default', None)
-        if default_driver and default_driver not in driver_configs:
-            raise BadOptions('No configuration for default driver'
-                             'selenium.%s' % default_driver)
 
+def start_virtual_display(**kw):
+    """Create and start a pyvirtualdisplay Display.
+
+    pyvirtualdisplay picks the next display number from X server lock files
+    in /tmp, so parallel test runner processes starting displays at the
+    same time would pick the same number.  Start them one at a time, and
+    wait for the X server to claim its number before letting others go.
+    """
+    from pyvirtualdisplay import Display
+    lock = open(virtual_display_lock, 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        display = Display(**kw)
+        display.start()
+        x_lock = '/tmp/.X%d-lock' % display.display
+        for n in range(50):
+            if os.path.exists(x_lock):
+                break
+            time.sleep(0.1)
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+    return display
+
+
+class VirtualDisplay(object):
+    """Virtual display shared by all layers of a test run.
+
+    The display is started when the first browser is spawned and is
+    restarted only if the X server dies.
+    """
+
+    display = None
+
+    # DisplayRecorder following the display, if recording
+    recorder = None
+
+    def __init__(self, **settings):
+        self.settings = settings
+
+    @property
+    def alive(self):
+        return self.display is not None and self.display.is_alive()
+
+    def ensure(self):
+        if self.alive:
+            return
+        if self.display is not None:
+            print >> sys.stderr, (
+                'warning: virtual display :%s died, restarting' % (
+                    self.display.display))
+            # Browsers do not survive their X server.
+            browser_pool.clear()
+            if browser_pool.spares is not None:
+                browser_pool.spares.clear()
+            self.stop()
+        self.display = start_virtual_display(**self.settings)
+        if self.recorder is not None:
+            self.recorder.start(':%d' % self.display.display,
+                                self.settings['size'])
+
+    def stop(self):
+        if self.recorder is not None:
+            self.recorder.stop()
+        if self.display is None:
+            return
         try:
-            from schooltool.devtools.webdriver import ScriptFactory
-            script_factory = ScriptFactory()
-        except SyntaxError:
-            print >> sys.stderr, 'warning: selenium is not compatible with python << 2.6'
-            return ''
-
-        scripts = []
-
-        implicit_wait = driver_configs.pop('implicit_wait', None)
-        if implicit_wait:
-            scripts.append(
-                'schooltool.devtools.selenium_recipe.implicit_wait = %f' % (
-                    float(implicit_wait)))
-
-        for driver, config in sorted(driver_configs.items()):
-            if (not isinstance(config, dict) and
-                config != "default"):
-                raise BadOptions(
-                    'Driver %r config must be a dict in form of'
-                    ' "mydriver.setting = ..." or "mydriver=default"'
-                    ' for standard WebDrivers, not'
-                    ' %r' % (driver, config))
-            if config == "default":
-                scripts.append(script_factory(driver, {}))
-            else:
-                scripts.append(script_factory(driver, config))
+            self.display.stop()
+        except Exception:
+            pass
+        self.display = None
 
-        return selenium_config_script % {
-            'default_factory': default_driver,
-            'factory_templates': '\n\n'.join(scripts),
-            'selenium_options': selenium_options_script,
-            }
 
+def make_dirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
 
-class RunnerSeleniumFeature(zope.testrunner.feature.Feature):
 
-    virtual_display = None
+def remove_file(path):
+    try:
+        os.unlink(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class SeleniumOutput(object):
+    """Test runner output formatter that notifies the selenium feature.
+
+    zope.testrunner does not call per-test feature hooks, but all test
+    results pass through the output formatter.
+    """
+
+    def __init__(self, output, feature):
+        self.__dict__['output'] = output
+        self.__dict__['feature'] = feature
+
+    def __getattr__(self, name):
+        return getattr(self.output, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.output, name, value)
+
+    def start_test(self, test, tests_run, total_tests):
+        self.output.start_test(test, tests_run, total_tests)
+        self.feature.start_test(test)
+
+    def stop_test(self, test):
+        self.feature.stop_test(test)
+        self.output.stop_test(test)
+
+    def test_success(self, test, seconds):
+        self.output.test_success(test, seconds)
+        self.feature.test_result(test, seconds, 'success')
+
+    def test_failure(self, test, seconds, exc_info):
+        entries = self.feature.capture_failure(test)
+        self.output.test_failure(test, seconds, exc_info)
+        self.feature.print_captured(entries)
+        self.feature.test_result(test, seconds, 'failure')
+
+    def test_error(self, test, seconds, exc_info):
+        entries = self.feature.capture_failure(test)
+        self.output.test_error(test, seconds, exc_info)
+        self.feature.print_captured(entries)
+        self.feature.test_result(test, seconds, 'error')
+
+
+class RunnerSeleniumFeature(zope.testrunner.feature.Feature):
 
     @property
     def active(self):
         global factories
-        return bool(factories)
+        # Unit test runs have no selenium layers to set up for.
+        return bool(factories) and not self.runner.options.unit
+
+    @property
+    def layer_number(self):
+        """Number of the layer run in this subprocess, None in the main one.
+
+        With -j, zope.testrunner runs every layer in a subprocess of its
+        own (--resume-layer), numbered in order.  Screenshots, downloads,
+        traces and timings of the layer go to files and directories with
+        that number, so that layers running at once do not overwrite each
+        other's.
+        """
+        options = self.runner.options
+        if options.resume_layer is None:
+            return None
+        return options.resume_number
+
+    def layer_path(self, path):
+        if self.layer_number is None:
+            return path
+        return os.path.join(path, 'layer-%d' % self.layer_number)
+
+    def layer_file(self, path):
+        if self.layer_number is None:
+            return path
+        return '%s.layer-%d' % (path, self.layer_number)
+
+    def layer_files(self, path):
+        """Existing files of test runner subprocesses for path."""
+        directory, name = os.path.split(path)
+        pattern = re.compile(re.escape(name) + r'\.layer-\d+$')
+        try:
+            names = os.listdir(directory or os.curdir)
+        except OSError:
+            return []
+        return [os.path.join(directory, name)
+                for name in sorted(names) if pattern.match(name)]
+
+    def layer_url(self, url):
+        if self.layer_number is None:
+            return url
+        return '%slayer-%d/' % (url, self.layer_number)
 
     def set_up_virtual_display(self):
         options = self.runner.options
 
-        if (options.selenium_headless or
-            options.selenium_headless_backend):
-            from pyvirtualdisplay import Display
-            self.virtual_display = Display(
+        global virtual_display
+        if options.selenium_headless_backend == 'native':
+            global default_browser_config
+            default_browser_config.headless = True
+            default_browser_config.window_size = (
+                options.selenium_headless_width,
+                options.selenium_headless_height)
+        elif (options.selenium_headless or
+              options.selenium_headless_backend):
+            virtual_display = VirtualDisplay(
                 backend=options.selenium_headless_backend,
                 visible=False,
                 size=(options.selenium_headless_width,
                       options.selenium_headless_height))
+            if options.selenium_record_failures:
+                virtual_display.recorder = DisplayRecorder(
+                    seconds=options.selenium_record_failures)
 
     def set_up_screenshots(self):
         options = self.runner.options
@@ -343,16 +809,21 @@ class RunnerSeleniumFeature(zope.testrunner.feature.Feature):
 
         global default_browser_config
         default_browser_config.overwrite_screenshots = options.selenium_overwrite
+        if options.selenium_capture_http:
+            default_browser_config.capture_http = True
 
-        default_browser_config.screenshots_dir = os.path.normpath(target_dir)
+        default_browser_config.screenshots_dir = self.layer_path(
+            os.path.normpath(target_dir))
 
         if not os.path.exists(default_browser_config.screenshots_dir):
-            os.mkdir(default_browser_config.screenshots_dir)
+            make_dirs(default_browser_config.screenshots_dir)
 
         if options.selenium_screenshots_url:
             default_browser_config.screenshots_url = options.selenium_screenshots_url
             if not default_browser_config.screenshots_url.endswith('/'):
                 default_browser_config.screenshots_url += '/'
+            default_browser_config.screenshots_url = self.layer_url(
+                default_browser_config.screenshots_url)
 
     def set_up_downloads(self):
         options = self.runner.options
@@ -364,15 +835,18 @@ class RunnerSeleniumFeature(zope.testrunner.feature.Feature):
 
         global default_browser_config
 
-        default_browser_config.downloads_dir = os.path.normpath(target_dir)
+        default_browser_config.downloads_dir = self.layer_path(
+            os.path.normpath(target_dir))
 
         if not os.path.exists(default_browser_config.downloads_dir):
-            os.mkdir(default_browser_config.downloads_dir)
+            make_dirs(default_browser_config.downloads_dir)
 
         if options.selenium_downloads_url:
             default_browser_config.downloads_url = options.selenium_downloads_url
             if not default_browser_config.downloads_url.endswith('/'):
                 default_browser_config.downloads_url += '/'
+            default_browser_config.downloads_url = self.layer_url(
+                default_browser_config.downloads_url)
 
     def global_setup(self):
         options = self.runner.options
@@ -383,20 +857,341 @@ class RunnerSeleniumFeature(zope.testrunner.feature.Feature):
         self.set_up_virtual_display()
         self.set_up_screenshots()
         self.set_up_downloads()
+        # Start worker threads before tests, so tests do not seem to
+        # leave them behind.
+        get_screenshot_writer().start()
+        get_download_watcher()
+        self.set_up_failure_capture()
+        self.set_up_browser_pool()
+        if browser_pool.spares is not None:
+            browser_pool.spares.start()
+        self.set_up_waits()
+        self.set_up_timings()
+        self.set_up_trace()
+        self.set_up_history()
+        self.set_up_shard()
+        self.set_up_order()
+
+        options.output = SeleniumOutput(options.output, self)
+
+    def set_up_failure_capture(self):
+        options = self.runner.options
+        failure_capture.timeout = options.selenium_failure_capture
 
-    def layer_setup(self, layer):
-        if self.virtual_display:
-            self.virtual_display.start()
+    def set_up_browser_pool(self):
+        options = self.runner.options
+        global default_browser_config
+        if options.selenium_reuse_browsers:
+            default_browser_config.reuse_browsers = True
+        if options.selenium_recycle_tests or options.selenium_recycle_rss:
+            max_rss = None
+            if options.selenium_recycle_rss:
+                max_rss = options.selenium_recycle_rss * 2**20
+            browser_pool.watchdog = BrowserWatchdog(
+                max_tests=options.selenium_recycle_tests, max_rss=max_rss)
+        if options.selenium_spare_browsers > 0:
+            browser_pool.spares = SpareBrowsers(
+                factories, count=options.selenium_spare_browsers)
+
+    def set_up_waits(self):
+        options = self.runner.options
+        global default_browser_config
+        if options.selenium_implicit_wait is not None:
+            default_browser_config.implicit_wait = options.selenium_implicit_wait
+        if options.selenium_wait_timeout is not None:
+            default_browser_config.wait_timeout = options.selenium_wait_timeout
+
+    timings_file = None
+
+    def set_up_timings(self):
+        options = self.runner.options
+        global timings
+        if not (options.selenium_timings or options.selenium_timings_file):
+            return
+        timings = SeleniumTimings()
+        self.timings_file = options.selenium_timings_file
+        if self.layer_number is not None:
+            if not self.timings_file:
+                self.timings_file = os.environ.get(timings_file_variable)
+            return
+        if not self.timings_file:
+            # Subprocesses still need to pass their timings on.
+            directory = tempfile.mkdtemp(prefix='selenium-timings-')
+            self.timings_file = os.path.join(directory, 'timings.json')
+            os.environ[timings_file_variable] = self.timings_file
+            self.remove_timings_dir = directory
+        for path in self.layer_files(self.timings_file):
+            # Left by an earlier run.
+            os.unlink(path)
+
+    def set_up_trace(self):
+        options = self.runner.options
+        global tracer
+        if not options.selenium_trace:
+            return
+        tracer = CommandTracer()
+        if self.layer_number is None:
+            for path in self.layer_files(options.selenium_trace):
+                # Left by an earlier run.
+                remove_file(path)
+                remove_file(path + '.json')
+
+    def set_up_history(self):
+        options = self.runner.options
+        global test_history
+        if options.selenium_history:
+            test_history = TestHistory(options.selenium_history)
+
+    def set_up_shard(self):
+        options = self.runner.options
+        if not options.selenium_shard:
+            return
+        index, count = parse_shard(options.selenium_shard)
+        tests_by_layer_name = self.runner.tests_by_layer_name
+        selection_file = os.environ.get(shard_selection_variable)
+        if self.layer_number is not None and selection_file:
+            # Tests of the shard were chosen by the main process, the
+            # history may have changed since.
+            with open(selection_file) as f:
+                selected = json.load(f)
+        else:
+            test_ids = [test.id()
+                        for layer_name, layer, tests
+                        in self.runner.ordered_layers()
+                        for test in tests]
+            selected = select_shard(test_ids, index, count, test_history)
+            fd, selection_file = tempfile.mkstemp(
+                prefix='selenium-shard-', suffix='.json')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(selected, f)
+            os.environ[shard_selection_variable] = selection_file
+            cleanups.append(lambda: os.unlink(selection_file))
+            options.output.info('Running selenium shard %d/%d: %d of %d tests'
+                                % (index, count, len(selected), len(test_ids)))
+        selected = set(selected)
+        for layer_name, suite in tests_by_layer_name.items():
+            tests = [test for test in suite if test.id() in selected]
+            if tests:
+                tests_by_layer_name[layer_name] = suite.__class__(tests)
+            else:
+                del tests_by_layer_name[layer_name]
 
-    def layer_teardown(self, layer):
-        if self.virtual_display:
-            self.virtual_display.stop()
+    fingerprints = None
+
+    def source_fingerprints(self):
+        """Hashes of test sources, shared by test order and history."""
+        if self.fingerprints is None:
+            self.fingerprints = SourceFingerprints()
+        return self.fingerprints
+
+    def set_up_order(self):
+        options = self.runner.options
+        order = options.selenium_order
+        if not order:
+            return
+        key = order_key(order, test_history, self.source_fingerprints())
+        tests_by_layer_name = self.runner.tests_by_layer_name
+        for layer_name, suite in tests_by_layer_name.items():
+            tests_by_layer_name[layer_name] = suite.__class__(
+                sorted(suite, key=key))
+        self.runner.layer_order = lambda layers: order_layers(
+            layers, order, key)
+        if self.layer_number is None and order in ('failed', 'new'):
+            first = len([test
+                         for suite in tests_by_layer_name.values()
+                         for test in suite
+                         if not key(test)])
+            options.output.info('Running %d %s tests first' % (
+                first, {'failed': 'previously failed',
+                        'new': 'new or changed'}[order]))
+
+    def test_result(self, test, seconds, outcome):
+        if test_history is not None:
+            test_history.record(test.id(), seconds, outcome,
+                                source=self.source_fingerprints()(test))
+
+    def capture_failure(self, test):
+        """Save the state of live browsers, return the index entries."""
+        entries = []
+        if failure_capture.timeout:
+            entries.extend(self.save_browser_states(test))
+        entry = self.save_recording(test)
+        if entry is not None:
+            entries.append(entry)
+        return entries
+
+    def save_browser_states(self, test):
+        writer = get_screenshot_writer()
+        with browser_pool.lock:
+            # Pooled browsers went back to the pool with earlier tests.
+            browsers = [browser
+                        for browser in failure_capture.live_browsers()
+                        if not browser_pool.is_idle(browser)]
+        if writer is None or not browsers:
+            return []
+        start = time.time()
+        states = failure_capture.capture(browsers)
+        if timings is not None:
+            timings.add('screenshots', time.time() - start)
+        for n, state in enumerate(states):
+            if state.get('timed out'):
+                print >> sys.stderr, (
+                    'warning: browser %d did not respond in %s seconds' % (
+                        n + 1, failure_capture.timeout))
+        return failure_capture.save(writer, test.id(), states)
+
+    def print_captured(self, entries):
+        if not entries:
+            return
+        lines = ['  Captured:']
+        for entry in entries:
+            lines.append('    %s: %s' % (entry['name'], entry['url']))
+        self.runner.options.output.info('\n'.join(lines))
+
+    def save_recording(self, test):
+        if virtual_display is None or virtual_display.recorder is None:
+            return None
+        writer = get_screenshot_writer()
+        data = virtual_display.recorder.recording()
+        if not data or writer is None:
+            return None
+        filename = os.path.join('recordings', test_filename(test.id(), '.ts'))
+        return writer.add_file(filename, data, test_id=test.id(),
+                               name='Display recording')
+
+    def start_test(self, test):
+        global current_test
+        current_test = test.id()
+        if timings is not None:
+            timings.start_test(current_test)
+        if tracer is not None:
+            tracer.start_test(current_test)
+        browser_pool.start_test()
+        for watcher in download_watchers.values():
+            watcher.mark()
+
+    def save_http_traffic(self):
+        entries = http_capture.stop_test()
+        writer = get_screenshot_writer()
+        if not entries or writer is None:
+            return
+        filename = os.path.join('http', test_filename(current_test, '.har'))
+        writer.add_file(filename, lambda: har_json(entries),
+                        test_id=current_test, name='HTTP traffic')
+
+    def stop_test(self, test):
+        global current_test
+        if default_browser_config.capture_http:
+            self.save_http_traffic()
+        browser_pool.stop_test()
+        if timings is not None:
+            timings.stop_test()
+        if tracer is not None:
+            tracer.stop_test()
+        current_test = None
+
+    def layer_setup(self, layer):
+        global current_layer
+        current_layer = name_from_layer(layer)
+        # Sessions of other layers may belong to a torn down database.
+        session_cache.clear()
+        if timings is not None:
+            timings.start_layer(current_layer)
+        # Check that the display from previous layers is still alive.
+        if (virtual_display is not None and
+            virtual_display.display is not None):
+            virtual_display.ensure()
+
+    def global_teardown(self):
+        if browser_pool.spares is not None:
+            browser_pool.spares.stop()
+        browser_pool.clear()
+        session_cache.clear()
+        while cleanups:
+            cleanup = cleanups.pop()
+            try:
+                cleanup()
+            except Exception, e:
+                print >> sys.stderr, 'warning: cleanup failed: %s' % e
+        if virtual_display is not None:
+            virtual_display.stop()
+
+    remove_timings_dir = None
+
+    def merge_trace(self):
+        for path in self.layer_files(self.runner.options.selenium_trace):
+            if os.path.exists(path + '.json'):
+                tracer.load(path)
+            remove_file(path)
+            remove_file(path + '.json')
+
+    def merge_timings(self):
+        for path in self.layer_files(self.timings_file):
+            timings.load(path)
+            os.unlink(path)
+
+    def report(self):
+        options = self.runner.options
+        # Save everything first: test runner subprocesses have closed
+        # their stdout by now, and report to the main process on stderr.
+        if test_history is not None:
+            test_history.save()
+        if tracer is not None:
+            if self.layer_number is None:
+                self.merge_trace()
+            tracer.save(self.layer_file(options.selenium_trace))
+        if timings is not None and self.timings_file:
+            if self.layer_number is None:
+                self.merge_timings()
+            if self.remove_timings_dir is None:
+                timings.save(self.layer_file(self.timings_file))
+            else:
+                shutil.rmtree(self.remove_timings_dir, ignore_errors=True)
+        if self.layer_number is not None:
+            return
+        if browser_pool.watchdog is not None:
+            summary = browser_pool.watchdog.report()
+            if summary is not None:
+                options.output.info(summary)
+        if tracer is not None:
+            options.output.info(tracer.report())
+        if timings is not None and options.selenium_timings:
+            options.output.info(timings.report(options.selenium_timings))
+        for text in reports:
+            options.output.info(text)
 
 
 class Runner(ZopeTestRunner):
 
+    layer_order = None
+
+    def ordered_layers(self):
+        layers = ZopeTestRunner.ordered_layers(self)
+        if self.layer_order is None:
+            return layers
+        return self.layer_order(list(layers))
+
     def configure(self):
         ZopeTestRunner.configure(self)
+        options = self.options
+        error = None
+        if options.selenium_shard:
+            try:
+                parse_shard(options.selenium_shard)
+            except ValueError, e:
+                error = str(e)
+        if options.selenium_order and not options.selenium_history:
+            error = '--selenium-order needs --selenium-history'
+        if options.selenium_record_failures and (
+            options.selenium_headless_backend == 'native' or
+            not (options.selenium_headless or
+                 options.selenium_headless_backend)):
+            error = ('--selenium-record-failures needs a virtual display'
+                     ' (--selenium-headless)')
+        if error is not None:
+            options.output.error(error)
+            options.fail = True
+            return
         selenium = RunnerSeleniumFeature(self)
         if selenium.active:
             self.features.append(selenium)
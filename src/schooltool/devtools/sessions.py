@@ -0,0 +1,141 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Logged in browser sessions, captured once and restored in other browsers
+"""
+import threading
+import urlparse
+
+
+capture_storage_script = '''
+var dump = function (storage) {
+    var items = {};
+    for (var i = 0; i < storage.length; i++) {
+        var key = storage.key(i);
+        items[key] = storage.getItem(key);
+    }
+    return items;
+};
+try {
+    return [dump(window.localStorage), dump(window.sessionStorage)];
+} catch (e) {
+    return [{}, {}];
+}
+'''
+
+restore_storage_script = '''
+var load = function (storage, items) {
+    storage.clear();
+    for (var key in items) {
+        storage.setItem(key, items[key]);
+    }
+};
+try {
+    load(window.localStorage, arguments[0]);
+    load(window.sessionStorage, arguments[1]);
+} catch (e) {}
+'''
+
+# Cookie fields WebDriver accepts when adding a cookie.  The domain is left
+# out, the cookie is set for the page the browser is on.
+COOKIE_FIELDS = ('name', 'value', 'path', 'secure', 'expiry')
+
+
+def origin(url):
+    parts = urlparse.urlsplit(url)
+    return '%s://%s' % (parts.scheme, parts.netloc)
+
+
+class SessionCache(object):
+    """Browser states (cookies, local and session storage) by key.
+
+    The state of a browser that logged in through the UI is captured
+    once and restored in other browsers, skipping the login forms.
+
+    Cookies can only be set for the site the browser is on, so restoring
+    first opens landing_path of the site, a page that should be cheap to
+    load.
+    """
+
+    landing_path = '/robots.txt'
+
+    def __init__(self, landing_path=None):
+        if landing_path is not None:
+            self.landing_path = landing_path
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def capture(self, browser):
+        local, session = browser.execute_script(capture_storage_script)
+        return {
+            'url': browser.current_url,
+            'cookies': browser.get_cookies(),
+            'local': local,
+            'session': session,
+            }
+
+    def restore(self, browser, state, url=None):
+        """Restore the state and open url, by default the captured page."""
+        browser.get(origin(state['url']) + self.landing_path)
+        browser.delete_all_cookies()
+        for cookie in state['cookies']:
+            browser.add_cookie(dict([(field, cookie[field])
+                                     for field in COOKIE_FIELDS
+                                     if cookie.get(field) is not None]))
+        browser.execute_script(
+            restore_storage_script, state['local'], state['session'])
+        browser.get(url or state['url'])
+
+    def get(self, key):
+        with self.lock:
+            return self.sessions.get(key)
+
+    def save(self, key, browser):
+        state = self.capture(browser)
+        with self.lock:
+            self.sessions[key] = state
+        return state
+
+    def forget(self, key):
+        with self.lock:
+            self.sessions.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.sessions.clear()
+
+    def login(self, browser, key, login, check=None):
+        """Restore the session saved under key, or log in and save it.
+
+        login(browser) logs in through the UI.  If check(browser) is given
+        and returns False after a restore, the session is stale (say, the
+        database was reset) and login() is called again.
+        """
+        state = self.get(key)
+        if state is not None:
+            self.restore(browser, state)
+            if check is None or check(browser):
+                self.hits += 1
+                return
+            self.forget(key)
+            browser.delete_all_cookies()
+        self.misses += 1
+        login(browser)
+        self.save(key, browser)
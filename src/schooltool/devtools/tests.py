@@ -29,6 +29,7 @@ from zope.app.locales import pygettext
 from zope.i18nmessageid import Message
 
 from schooltool.devtools.selenium_recipe import unflatten_options
+from schooltool.devtools.benchmark import BrowserBenchmark
 
 
 def doctest_STPOTEntry():
@@ -129,9 +130,10 @@ def doctest_ScriptFactory():
     Default firefox driver script.
 
         >>> print maker('firefox', {})
-        import selenium.webdriver.firefox.webdriver
-        schooltool.devtools.selenium_recipe.factories['firefox'] =\
-            lambda config=None: selenium.webdriver.firefox.webdriver.WebDriver()
+        def selenium_factory(config=None):
+            import schooltool.devtools.webdriver
+            return schooltool.devtools.webdriver.FirefoxWebDriver(config=config)
+        schooltool.devtools.selenium_recipe.factories['firefox'] = selenium_factory
 
     Customized default firefox driver.
 
@@ -140,11 +142,12 @@ def doctest_ScriptFactory():
         ...     timeout = 30
         ...     binary = /usr/bin/firefox
         ...     '''))
-        import selenium.webdriver.firefox.webdriver
-        from selenium.webdriver.firefox.firefox_profile import FirefoxProfile
-        from selenium.webdriver.firefox.firefox_binary import FirefoxBinary
-        schooltool.devtools.selenium_recipe.factories['firefox'] =\
-            lambda config=None: selenium.webdriver.firefox.webdriver.WebDriver(firefox_binary=FirefoxBinary('/usr/bin/firefox'), firefox_profile=FirefoxProfile('/.../ff/profile'), timeout=30)
+        def selenium_factory(config=None):
+            import schooltool.devtools.webdriver
+            from schooltool.devtools.profiles import cached_profile
+            from selenium.webdriver.firefox.firefox_binary import FirefoxBinary
+            return schooltool.devtools.webdriver.FirefoxWebDriver(firefox_binary=FirefoxBinary('/usr/bin/firefox'), firefox_profile=cached_profile('/.../ff/profile'), timeout=30, config=config)
+        schooltool.devtools.selenium_recipe.factories['firefox'] = selenium_factory
 
     Non-default driver named firefox4.
 
@@ -160,10 +163,11 @@ def doctest_ScriptFactory():
         ...     web_driver = firefox
         ...     binary = /usr/bin/firefox4
         ...     '''))
-        import selenium.webdriver.firefox.webdriver
-        from selenium.webdriver.firefox.firefox_binary import FirefoxBinary
-        schooltool.devtools.selenium_recipe.factories['firefox4'] =\
-            lambda config=None: selenium.webdriver.firefox.webdriver.WebDriver(firefox_binary=FirefoxBinary('/usr/bin/firefox4'))
+        def selenium_factory(config=None):
+            import schooltool.devtools.webdriver
+            from selenium.webdriver.firefox.firefox_binary import FirefoxBinary
+            return schooltool.devtools.webdriver.FirefoxWebDriver(firefox_binary=FirefoxBinary('/usr/bin/firefox4'), config=config)
+        schooltool.devtools.selenium_recipe.factories['firefox4'] = selenium_factory
 
     IE driver.
 
@@ -171,9 +175,10 @@ def doctest_ScriptFactory():
         ...     timeout = 50
         ...     port = 80
         ...     '''))
-        import selenium.webdriver.ie.webdriver
-        schooltool.devtools.selenium_recipe.factories['ie'] =\
-            lambda config=None: selenium.webdriver.ie.webdriver.WebDriver(port=80, timeout=50)
+        def selenium_factory(config=None):
+            import selenium.webdriver.ie.webdriver
+            return selenium.webdriver.ie.webdriver.WebDriver(port=80, timeout=50)
+        schooltool.devtools.selenium_recipe.factories['ie'] = selenium_factory
 
     Chrome driver, default.
 
@@ -181,9 +186,11 @@ def doctest_ScriptFactory():
         ...     binary = /usr/bin/chromium-driver
         ...     port = 80
         ...     '''))
-        import selenium.webdriver.chrome.webdriver
-        schooltool.devtools.selenium_recipe.factories['chrome'] =\
-            lambda config=None: selenium.webdriver.chrome.webdriver.WebDriver(desired_capabilities={'platform': 'ANY', 'browserName': 'chrome', 'version': '', 'javascriptEnabled': True}, executable_path='/usr/bin/chromium-driver', port=80)
+        def selenium_factory(config=None):
+            import selenium.webdriver.chrome.webdriver
+            import schooltool.devtools.webdriver
+            return selenium.webdriver.chrome.webdriver.WebDriver(chrome_options=schooltool.devtools.webdriver.chrome_options(config=config), desired_capabilities=schooltool.devtools.webdriver.chrome_capabilities({'platform': 'ANY', 'browserName': 'chrome', 'version': '', 'javascriptEnabled': True}, config=config), executable_path='/usr/bin/chromium-driver', port=80)
+        schooltool.devtools.selenium_recipe.factories['chrome'] = selenium_factory
 
     Chrome driver, modified to accept capabilities.  Needed for Linux chrome driver.
 
@@ -191,10 +198,160 @@ def doctest_ScriptFactory():
         ...     binary = /usr/bin/chromium-driver
         ...     capabilities.chrome.binary = /usr/bin/chromium-browser
         ...     '''))
-        import schooltool.devtools.webdriver
-        schooltool.devtools.selenium_recipe.factories['linux_chrome'] =\
-            lambda config=None: schooltool.devtools.webdriver.ChromeWebDriver(desired_capabilities={'platform': 'ANY', 'browserName': 'chrome', 'version': '', 'chrome.binary': '/usr/bin/chromium-browser', 'javascriptEnabled': True}, executable_path='/usr/bin/chromium-driver', config=config)
+        def selenium_factory(config=None):
+            import schooltool.devtools.webdriver
+            return schooltool.devtools.webdriver.ChromeWebDriver(desired_capabilities={'platform': 'ANY', 'browserName': 'chrome', 'version': '', 'chrome.binary': '/usr/bin/chromium-browser', 'javascriptEnabled': True}, executable_path='/usr/bin/chromium-driver', config=config)
+        schooltool.devtools.selenium_recipe.factories['linux_chrome'] = selenium_factory
 
+    Linux chrome drivers share chromedriver processes unless told otherwise.
+
+        >>> print maker('linux_chrome', parse_ini_string('''
+        ...     shared_service = False
+        ...     '''))
+        def selenium_factory(config=None):
+            import schooltool.devtools.webdriver
+            return schooltool.devtools.webdriver.ChromeWebDriver(shared_service=False, config=config)
+        schooltool.devtools.selenium_recipe.factories['linux_chrome'] = selenium_factory
+
+        >>> print maker('linux_chrome', parse_ini_string('''
+        ...     service_sessions = 4
+        ...     '''))
+        def selenium_factory(config=None):
+            import schooltool.devtools.webdriver
+            return schooltool.devtools.webdriver.ChromeWebDriver(service_sessions=4, config=config)
+        schooltool.devtools.selenium_recipe.factories['linux_chrome'] = selenium_factory
+
+    Commands can go over keep-alive connections shared by browsers.
+
+        >>> print maker('linux_chrome', parse_ini_string('''
+        ...     keep_alive = True
+        ...     '''))
+        def selenium_factory(config=None):
+            import schooltool.devtools.webdriver
+            return schooltool.devtools.webdriver.ChromeWebDriver(keep_alive=True, config=config)
+        schooltool.devtools.selenium_recipe.factories['linux_chrome'] = selenium_factory
+
+        >>> print maker('remote_chrome', parse_ini_string('''
+        ...     web_driver = remote
+        ...     capabilities = chrome
+        ...     remote_hub = http://localhost:4444/wd/hub
+        ...     keep_alive = True
+        ...     keep_alive_connections = 8
+        ...     keep_alive_idle = 10
+        ...     '''))
+        def selenium_factory(config=None):
+            import selenium.webdriver.remote.webdriver
+            import schooltool.devtools.connection
+            return selenium.webdriver.remote.webdriver.WebDriver(command_executor=schooltool.devtools.connection.pooled_connection('http://localhost:4444/wd/hub', idle_timeout=10.0, size=8), desired_capabilities={...})
+        schooltool.devtools.selenium_recipe.factories['remote_chrome'] = selenium_factory
+
+    Browsers can run in their built-in headless mode, without an X server.
+
+        >>> print maker('chrome', parse_ini_string('''
+        ...     headless = True
+        ...     '''))
+        def selenium_factory(config=None):
+            import selenium.webdriver.chrome.webdriver
+            import schooltool.devtools.webdriver
+            return selenium.webdriver.chrome.webdriver.WebDriver(chrome_options=schooltool.devtools.webdriver.chrome_options(config=config, headless=True), desired_capabilities=schooltool.devtools.webdriver.chrome_capabilities({'platform': 'ANY', 'browserName': 'chrome', 'version': '', 'javascriptEnabled': True}, config=config, headless=True))
+        schooltool.devtools.selenium_recipe.factories['chrome'] = selenium_factory
+
+        >>> print maker('linux_chrome', parse_ini_string('''
+        ...     headless = True
+        ...     '''))
+        def selenium_factory(config=None):
+            import schooltool.devtools.webdriver
+            return schooltool.devtools.webdriver.ChromeWebDriver(headless=True, config=config)
+        schooltool.devtools.selenium_recipe.factories['linux_chrome'] = selenium_factory
+
+        >>> print maker('firefox', parse_ini_string('''
+        ...     headless = True
+        ...     '''))
+        def selenium_factory(config=None):
+            import schooltool.devtools.webdriver
+            return schooltool.devtools.webdriver.FirefoxWebDriver(headless=True, config=config)
+        schooltool.devtools.selenium_recipe.factories['firefox'] = selenium_factory
+
+    Without the setting, config.headless decides when the browser is
+    spawned (--selenium-headless-backend native).
+
+        >>> from schooltool.devtools.webdriver import chrome_capabilities
+        >>> from schooltool.devtools.selenium_recipe import BrowserConfig
+        >>> config = BrowserConfig(headless=True, window_size=(800, 600))
+        >>> caps = {'chromeOptions': {'args': ['--lang=en']}}
+        >>> chrome_capabilities(caps, config=config)
+        {'chromeOptions': {'args': ['--lang=en', '--headless', '--disable-gpu', '--window-size=800,600']}}
+        >>> chrome_capabilities(caps, config=config, headless=False)
+        {'chromeOptions': {'args': ['--lang=en']}}
+        >>> chrome_capabilities(caps, config=BrowserConfig())
+        {'chromeOptions': {'args': ['--lang=en']}}
+
+    selenium's Chrome WebDriver sends chromeOptions of its ChromeOptions,
+    not of the desired capabilities, so the chrome factory passes both.
+
+        >>> sent = chrome_factory_capabilities(
+        ...     maker, config, 'web_driver = chrome')
+        >>> sent['chromeOptions']
+        {'args': ['--headless', '--disable-gpu', '--window-size=800,600'], 'extensions': []}
+        >>> sent['browserName']
+        'chrome'
+
+    The performance log needed to capture HTTP traffic is asked for too.
+
+        >>> config = BrowserConfig(capture_http=True)
+        >>> sent = chrome_factory_capabilities(
+        ...     maker, config, 'web_driver = chrome')
+        >>> sent['loggingPrefs']
+        {'performance': 'ALL'}
+
+    Firefox has no headless mode with selenium 2's Firefox driver, so
+    headless Firefox runs under a virtual display instead.
+
+        >>> import sys
+        >>> import selenium.webdriver.firefox.webdriver
+        >>> import schooltool.devtools.selenium_recipe
+        >>> from schooltool.devtools.webdriver import FirefoxWebDriver
+        >>> selenium_recipe = schooltool.devtools.selenium_recipe
+        >>> firefox = selenium.webdriver.firefox.webdriver.WebDriver
+        >>> real_init = firefox.__init__
+        >>> real_start = selenium_recipe.start_virtual_display
+        >>> def firefox_init(self, **kw):
+        ...     print 'Firefox on %s' % os.environ.get('DISPLAY')
+        >>> def start_virtual_display(**kw):
+        ...     print 'start display %s' % sorted(kw.items())
+        ...     os.environ['DISPLAY'] = ':1001'
+        ...     return FakeDisplay()
+        >>> class FakeDisplay(object):
+        ...     def is_alive(self):
+        ...         return True
+        ...     def stop(self):
+        ...         print 'stop display'
+        >>> firefox.__init__ = firefox_init
+        >>> selenium_recipe.start_virtual_display = start_virtual_display
+        >>> old_display = os.environ.get('DISPLAY')
+
+        >>> config = BrowserConfig(headless=True, window_size=(800, 600))
+        >>> sys.stderr = sys.stdout
+        >>> browser = FirefoxWebDriver(config=config)
+        warning: Firefox has no headless mode with this WebDriver,
+                 running it under a virtual display
+        start display [('size', (800, 600)), ('visible', False)]
+        Firefox on :1001
+        >>> browser = FirefoxWebDriver(config=config)
+        Firefox on :1001
+        >>> sys.stderr = sys.__stderr__
+
+        >>> selenium_recipe.virtual_display.stop()
+        stop display
+        >>> selenium_recipe.virtual_display = None
+        >>> selenium_recipe.start_virtual_display = real_start
+        >>> firefox.__init__ = real_init
+        >>> if old_display is None:
+        ...     del os.environ['DISPLAY']
+        ... else:
+        ...     os.environ['DISPLAY'] = old_display
+        >>> sorted(sent['chromeOptions']['perfLoggingPrefs'].items())
+        [('enableNetwork', True), ('enablePage', False), ('enableTimeline', False)]
 
     Remote driver.
 
@@ -209,9 +366,23 @@ def doctest_ScriptFactory():
         ...     web_driver = remote
         ...     capabilities = iphone
         ...     '''))
-        import selenium.webdriver.remote.webdriver
-        schooltool.devtools.selenium_recipe.factories['remote_iphone'] =\
-            lambda config=None: selenium.webdriver.remote.webdriver.WebDriver(desired_capabilities={'platform': 'MAC', 'browserName': 'iPhone', 'version': '', 'javascriptEnabled': True})
+        def selenium_factory(config=None):
+            import selenium.webdriver.remote.webdriver
+            return selenium.webdriver.remote.webdriver.WebDriver(desired_capabilities={'platform': 'MAC', 'browserName': 'iPhone', 'version': '', 'javascriptEnabled': True})
+        schooltool.devtools.selenium_recipe.factories['remote_iphone'] = selenium_factory
+
+    Remote Firefox with a profile.
+
+        >>> print maker('remote_firefox', parse_ini_string('''
+        ...     web_driver = remote
+        ...     capabilities = firefox
+        ...     profile = ff/profile
+        ...     '''))
+        def selenium_factory(config=None):
+            import selenium.webdriver.remote.webdriver
+            from schooltool.devtools.profiles import cached_profile
+            return selenium.webdriver.remote.webdriver.WebDriver(browser_profile=cached_profile('/.../ff/profile', remote=True), desired_capabilities={...})
+        schooltool.devtools.selenium_recipe.factories['remote_firefox'] = selenium_factory
 
     Remote driver with bad capabilities.
 
@@ -234,9 +405,2026 @@ def doctest_ScriptFactory():
         ...     capabilities.platform = LINUX
         ...     capabilities.javascriptEnabled = True
         ...     '''))
-        import selenium.webdriver.remote.webdriver
-        schooltool.devtools.selenium_recipe.factories['buildroid'] =\
-            lambda config=None: selenium.webdriver.remote.webdriver.WebDriver(desired_capabilities={'javascriptEnabled': True, 'browserName': 'android', 'version': '', 'platform': 'LINUX'})
+        def selenium_factory(config=None):
+            import selenium.webdriver.remote.webdriver
+            return selenium.webdriver.remote.webdriver.WebDriver(desired_capabilities={'javascriptEnabled': True, 'browserName': 'android', 'version': '', 'platform': 'LINUX'})
+        schooltool.devtools.selenium_recipe.factories['buildroid'] = selenium_factory
+
+    Browsers can stop waiting for pages to load at DOMContentLoaded, and
+    leave out resources that tests do not need.
+
+        >>> print maker('firefox', parse_ini_string('''
+        ...     page_load_strategy = eager
+        ...     block_urls = *.woff http://www.google-analytics.com/*
+        ...     '''))
+        def selenium_factory(config=None):
+            import schooltool.devtools.webdriver
+            return schooltool.devtools.webdriver.FirefoxWebDriver(capabilities={...'pageLoadStrategy': 'eager'...}, config=config)
+        schooltool.devtools.selenium_recipe.factories['firefox'] = selenium_factory
+
+    URLs are blocked by a proxy auto-config script, which every driver
+    takes the same way.
+
+        >>> caps = maker.page_load('firefox', parse_ini_string('''
+        ...     block_urls = ['*.woff', 'http://www.google-analytics.com/*']
+        ...     '''))
+        >>> caps['proxy']['proxyType']
+        'PAC'
+        >>> url = caps['proxy']['proxyAutoconfigUrl']
+        >>> url
+        'data:application/x-ns-proxy-autoconfig;base64,...'
+
+        >>> import base64
+        >>> print base64.b64decode(url.split(',', 1)[1])
+        function FindProxyForURL(url, host) {
+            if (shExpMatch(url, "*.woff") ||
+                shExpMatch(url, "http://www.google-analytics.com/*")) {
+                return "PROXY 127.0.0.1:9";
+            }
+            return "DIRECT";
+        }
+
+        >>> for web_driver in ['chrome', 'linux_chrome', 'firefox', 'remote']:
+        ...     print maker('browser', parse_ini_string('''
+        ...         web_driver = %s
+        ...         capabilities.browserName = chrome
+        ...         page_load_strategy = none
+        ...         block_urls = *.png
+        ...         ''' % web_driver)).count("'pageLoadStrategy': 'none'"),
+        1 1 1 1
+
+        >>> maker('linux_chrome', parse_ini_string('''
+        ...     page_load_strategy = fast
+        ...     '''))
+        Traceback (most recent call last):
+        ...
+        BadOptions: "page_load_strategy" for 'linux_chrome' should be one of:
+          normal, eager, none.
+
+    Browser modules are imported when the first browser is spawned, not when
+    the test runner starts.
+
+        >>> import __builtin__
+        >>> import schooltool.devtools.selenium_recipe
+        >>> imported = []
+        >>> def logging_import(name, *args):
+        ...     imported.append(name)
+        ...     return __import__(name, *args)
+        >>> namespace = {
+        ...     '__builtins__': dict(__builtin__.__dict__,
+        ...                          __import__=logging_import),
+        ...     'schooltool': schooltool}
+        >>> exec maker('remote_iphone', parse_ini_string('''
+        ...     web_driver = remote
+        ...     capabilities = iphone
+        ...     ''')) in namespace
+        >>> imported
+        []
+
+        >>> factories = schooltool.devtools.selenium_recipe.factories
+        >>> factories['remote_iphone']
+        <function selenium_factory at ...>
+        >>> del factories['remote_iphone']
+
+    """
+
+
+def chrome_factory_capabilities(maker, config, settings):
+    """Capabilities the chrome factory sends to chromedriver."""
+    import schooltool.devtools.selenium_recipe
+    from selenium.webdriver.chrome import webdriver as chrome_webdriver
+    factories = schooltool.devtools.selenium_recipe.factories
+    sent = {}
+
+    class Service(object):
+        service_url = 'http://localhost:9515'
+        def __init__(self, *args, **kw):
+            pass
+        def start(self):
+            pass
+
+    def remote_init(self, command_executor, desired_capabilities,
+                    keep_alive=False):
+        sent.update(desired_capabilities)
+
+    real_service = chrome_webdriver.Service
+    real_init = chrome_webdriver.RemoteWebDriver.__init__
+    chrome_webdriver.Service = Service
+    chrome_webdriver.RemoteWebDriver.__init__ = remote_init
+    try:
+        exec maker('spawned_chrome', parse_ini_string(settings)) in {
+            'schooltool': schooltool}
+        factories.pop('spawned_chrome')(config=config)
+    finally:
+        chrome_webdriver.Service = real_service
+        chrome_webdriver.RemoteWebDriver.__init__ = real_init
+    return sent
+
+
+class FakeBrowser(object):
+
+    instances = 0
+    current_url = 'about:blank'
+
+    def __init__(self, config=None):
+        FakeBrowser.instances += 1
+        self.name = 'browser-%d' % FakeBrowser.instances
+        self.window_handles = ['main']
+
+    def switch_to_window(self, handle):
+        print '%s: switch to %s' % (self.name, handle)
+
+    def close(self):
+        print '%s: close' % self.name
+
+    def delete_all_cookies(self):
+        print '%s: delete cookies' % self.name
+
+    def execute_script(self, script, *args):
+        print '%s: execute script' % self.name
+
+    def get(self, url):
+        print '%s: get %s' % (self.name, url)
+        self.current_url = url
+
+    def implicitly_wait(self, seconds):
+        pass
+
+    def quit(self):
+        print '%s: quit' % self.name
+
+    def __repr__(self):
+        return '<%s>' % self.name
+
+
+def doctest_BrowserPool():
+    r"""Tests for the browser pool.
+
+        >>> from schooltool.devtools.selenium_recipe import BrowserConfig
+        >>> from schooltool.devtools.browserpool import BrowserPool
+        >>> FakeBrowser.instances = 0
+        >>> pool = BrowserPool({'fake': FakeBrowser})
+        >>> config = BrowserConfig(reuse_browsers=True)
+
+    Browsers are spawned when the pool has nothing to offer.
+
+        >>> pool.start_test()
+        >>> first = pool.acquire('fake', config)
+        >>> second = pool.acquire('fake', config)
+        >>> first, second
+        (<browser-1>, <browser-2>)
+
+    Quitting a pooled browser resets it and puts it back to the pool.
+
+        >>> first.window_handles = ['main', 'popup']
+        >>> first.quit()
+        browser-1: switch to popup
+        browser-1: close
+        browser-1: switch to main
+        browser-1: delete cookies
+        browser-1: execute script
+        browser-1: get about:blank
+
+    Browsers still in use are released at the end of the test.
+
+        >>> pool.stop_test()
+        browser-2: switch to main
+        browser-2: delete cookies
+        browser-2: execute script
+        browser-2: get about:blank
+
+    Next test gets warm browsers.
+
+        >>> first.window_handles = ['main']
+        >>> pool.start_test()
+        >>> pool.acquire('fake', config)
+        <browser-2>
+        >>> pool.acquire('fake', config)
+        <browser-1>
+
+    Browsers with a different configuration are not shared.
+
+        >>> other = BrowserConfig(reuse_browsers=True, implicit_wait=0)
+        >>> pool.acquire('fake', other)
+        <browser-3>
+
+    Clearing the pool really quits the browsers.
+
+        >>> pool.clear()
+        browser-...: quit
+        browser-...: quit
+        browser-...: quit
+        >>> pool.stop_test()
+
+    Cookies and storage can only be cleared for the page the browser is
+    on, so browsers that visited other origins are not reused.
+
+        >>> pool.start_test()
+        >>> browser = pool.acquire('fake', config)
+        >>> browser.get('http://localhost:8080/login')
+        browser-4: get http://localhost:8080/login
+        >>> browser.get('http://localhost:8080/calendar')
+        browser-4: get http://localhost:8080/calendar
+        >>> browser.quit()
+        browser-4: switch to main
+        browser-4: delete cookies
+        browser-4: execute script
+        browser-4: get about:blank
+
+        >>> pool.acquire('fake', config) is browser
+        True
+        >>> browser.get('http://localhost:8080/login')
+        browser-4: get http://localhost:8080/login
+        >>> browser.current_url = 'https://accounts.example.com/'
+        >>> pool.stop_test()
+        browser-4: switch to main
+        browser-4: quit
+
+        >>> pool.start_test()
+        >>> pool.acquire('fake', config)
+        <browser-5>
+        >>> pool.clear()
+        browser-5: quit
+        >>> pool.stop_test()
+
+    """
+
+
+def doctest_BrowserWatchdog():
+    r"""Tests for recycling of pooled browsers.
+
+        >>> from schooltool.devtools.selenium_recipe import BrowserConfig
+        >>> from schooltool.devtools.browserpool import BrowserPool
+        >>> from schooltool.devtools.browserpool import BrowserWatchdog
+        >>> FakeBrowser.instances = 0
+        >>> watchdog = BrowserWatchdog(max_tests=2, max_rss=500 * 2**20)
+        >>> sizes = {}
+        >>> watchdog.rss = lambda browser: sizes.get(browser.name)
+        >>> pool = BrowserPool({'fake': FakeBrowser}, watchdog=watchdog)
+        >>> config = BrowserConfig(reuse_browsers=True)
+
+    A browser is replaced after serving the given number of tests.
+
+        >>> pool.start_test()
+        >>> browser = pool.acquire('fake', config)
+        >>> pool.stop_test()
+        browser-1: switch to main
+        browser-1: delete cookies
+        browser-1: execute script
+        browser-1: get about:blank
+        >>> pool.start_test()
+        >>> pool.acquire('fake', config)
+        <browser-1>
+        >>> pool.stop_test()
+        browser-1: quit
+
+    Or when it grows too big.
+
+        >>> pool.start_test()
+        >>> pool.acquire('fake', config)
+        <browser-2>
+        >>> sizes['browser-2'] = 600 * 2**20
+        >>> pool.stop_test()
+        browser-2: quit
+        >>> pool.start_test()
+        >>> pool.acquire('fake', config)
+        <browser-3>
+        >>> pool.clear()
+        browser-3: quit
+        >>> pool.stop_test()
+
+        >>> print watchdog.report()
+        Recycled 2 browsers: 1 after 2 tests, 1 over 500 MB (peak 600 MB)
+
+    Memory is measured for browser and driver processes and their
+    children.
+
+        >>> import os
+        >>> from schooltool.devtools.browserpool import browser_rss
+        >>> class Process(object):
+        ...     pid = os.getpid()
+        >>> class Binary(object):
+        ...     process = Process()
+        >>> browser = FakeBrowser()
+        >>> browser_rss(browser) is None
+        True
+        >>> browser.binary = Binary()
+        >>> browser_rss(browser) > 0
+        True
+
+    """
+
+
+def doctest_SpareBrowsers():
+    r"""Tests for browsers spawned ahead of time.
+
+        >>> import time
+        >>> from schooltool.devtools.selenium_recipe import BrowserConfig
+        >>> from schooltool.devtools.browserpool import BrowserPool
+        >>> from schooltool.devtools.browserpool import SpareBrowsers
+        >>> FakeBrowser.instances = 0
+        >>> spares = SpareBrowsers({'fake': FakeBrowser}, count=1)
+        >>> config = BrowserConfig()
+
+        >>> def wait_for_spares(count):
+        ...     for n in range(500):
+        ...         with spares.condition:
+        ...             ready = sum(map(len, spares.spares.values()))
+        ...         if ready == count:
+        ...             return
+        ...         time.sleep(0.01)
+        ...     print 'timed out'
+
+    Spares of a factory are spawned once it is asked for.
+
+        >>> key = spares.want('fake', config)
+        >>> wait_for_spares(1)
+        >>> spares.take('fake', config)
+        <browser-1>
+
+    Taking a spare spawns the next one.
+
+        >>> wait_for_spares(1)
+        >>> spares.spares[key]
+        [(<browser-2>, ...)]
+
+    The browser pool hands out spares when it has no idle browsers.
+
+        >>> pool = BrowserPool({'fake': FakeBrowser}, spares=spares)
+        >>> pool.acquire('fake', BrowserConfig(reuse_browsers=True))
+        <browser-3>
+        >>> pool.new_browser('fake', config)
+        <browser-2>
+
+        >>> wait_for_spares(2)
+        >>> spares.stop()
+        browser-...: quit
+        browser-...: quit
+        >>> pool.clear()
+        browser-3: quit
+
+    Spares spawned on another X display, say one that was restarted, are
+    quit instead of handed out.
+
+        >>> import os
+        >>> old_display = os.environ.get('DISPLAY')
+        >>> os.environ['DISPLAY'] = ':7'
+        >>> FakeBrowser.instances = 0
+        >>> spares = SpareBrowsers({'fake': FakeBrowser}, count=1)
+        >>> key = spares.want('fake', config)
+        >>> wait_for_spares(1)
+        >>> spares.spares[key]
+        [(<browser-1>, ':7')]
+
+        >>> os.environ['DISPLAY'] = ':8'
+        >>> print spares.take('fake', config)
+        browser-1: quit
+        None
+        >>> wait_for_spares(1)
+        >>> spares.take('fake', config)
+        <browser-2>
+
+    stop() does not wait for a hung factory forever.
+
+        >>> import threading
+        >>> hang = threading.Event()
+        >>> def hung(config=None):
+        ...     hang.wait()
+        ...     return FakeBrowser()
+        >>> wait_for_spares(1)
+        >>> spares.stop()
+        browser-3: quit
+        >>> spares = SpareBrowsers({'hung': hung}, timeout=0.1)
+        >>> key = spares.want('hung', config)
+        >>> for n in range(500):
+        ...     if spares.spawning.get(key):
+        ...         break
+        ...     time.sleep(0.01)
+        >>> thread = spares.thread
+        >>> import sys
+        >>> sys.stderr = sys.stdout
+        >>> spares.stop()
+        warning: gave up waiting for a spare browser to spawn
+        >>> sys.stderr = sys.__stderr__
+
+    The browser is quit when the factory finally returns.
+
+        >>> hang.set(); thread.join()
+        browser-4: quit
+
+        >>> if old_display is None:
+        ...     del os.environ['DISPLAY']
+        ... else:
+        ...     os.environ['DISPLAY'] = old_display
+
+    """
+
+
+def doctest_Dispatcher():
+    r"""Tests for the local WebDriver dispatcher.
+
+        >>> import json
+        >>> from schooltool.devtools.dispatcher import Dispatcher
+        >>> from schooltool.devtools.dispatcher import DispatcherError
+        >>> from schooltool.devtools.dispatcher import DriverProcess
+
+        >>> class FakeDriver(DriverProcess):
+        ...     sessions_started = 0
+        ...     crashed = False
+        ...     def command(self):
+        ...         return [self.executable]
+        ...     def start(self):
+        ...         print '%s: start' % self.executable
+        ...         self.crashed = False
+        ...     def alive(self):
+        ...         return not self.crashed
+        ...     def request(self, method, path, body=None):
+        ...         print '%s: %s %s' % (self.executable, method, path)
+        ...         if path == '/session':
+        ...             FakeDriver.sessions_started += 1
+        ...             return 200, json.dumps({
+        ...                 'status': 0,
+        ...                 'sessionId': 's%d' % self.sessions_started})
+        ...         return 200, json.dumps({'status': 0, 'value': None})
+
+        >>> class FakeChromeDriver(FakeDriver):
+        ...     browser_name = 'chrome'
+        >>> drivers = [FakeChromeDriver('chrome-1', max_sessions=2),
+        ...            FakeChromeDriver('chrome-2', max_sessions=2)]
+        >>> dispatcher = Dispatcher(drivers, max_sessions=3,
+        ...                         queue_timeout=0.1)
+        >>> dispatcher.start()
+        chrome-1: start
+        chrome-2: start
+
+    New sessions go to the least busy driver, commands go to the driver
+    of their session.
+
+        >>> def new_session(browser='chrome'):
+        ...     status, data = dispatcher.handle(
+        ...         'POST', '/wd/hub/session',
+        ...         json.dumps({'desiredCapabilities':
+        ...                     {'browserName': browser}}))
+        ...     return json.loads(data)['sessionId']
+
+        >>> new_session(), new_session(), new_session()
+        chrome-1: POST /session
+        chrome-2: POST /session
+        chrome-1: POST /session
+        (u's1', u's2', u's3')
+
+        >>> status, data = dispatcher.handle(
+        ...     'POST', '/wd/hub/session/s2/url', '{"url": "about:blank"}')
+        chrome-2: POST /session/s2/url
+        >>> dispatcher.handle('GET', '/wd/hub/session/nope/url')
+        (404, '{"status": 6, "value": {"message": "Unknown session nope"}}')
+
+    Past the concurrency limit new sessions wait in the queue.
+
+        >>> new_session()
+        Traceback (most recent call last):
+          ...
+        DispatcherError: Timed out after 0.1 seconds waiting for a chrome driver
+
+        >>> dispatcher.queue_timeout = 5
+        >>> import threading
+        >>> threading.Timer(
+        ...     0.1, dispatcher.handle,
+        ...     ('DELETE', '/wd/hub/session/s1')).start()
+        >>> new_session()
+        chrome-1: DELETE /session/s1
+        chrome-1: POST /session
+        u's4'
+
+        >>> new_session('firefox')
+        Traceback (most recent call last):
+          ...
+        DispatcherError: No drivers for browser u'firefox'
+
+    Statistics are kept for every session.
+
+        >>> [(stats['session'], stats['commands'])
+        ...  for stats in dispatcher.stats()['finished']]
+        [(u's1', 1)]
+        >>> sorted([(stats['session'], stats['commands'])
+        ...         for stats in dispatcher.stats()['active']])
+        [(u's2', 1), (u's3', 0), (u's4', 0)]
+        >>> print dispatcher.report()
+        1 sessions, 1 commands in ...s; queue wait ...s average, ...s max
+
+    Sessions of a driver that crashed do not count towards the limits,
+    the driver is restarted for the next session.
+
+        >>> drivers[1].crashed = True
+        >>> new_session()
+        chrome-2: start
+        chrome-2: POST /session
+        u's5'
+        >>> [stats['session'] for stats in dispatcher.stats()['finished']]
+        [u's1', u's2']
+
+    Drivers have to say how they are started.
+
+        >>> DriverProcess('driver')
+        Traceback (most recent call last):
+          ...
+        TypeError: Can't instantiate abstract class DriverProcess with abstract methods command
+
+    """
+
+
+def doctest_Benchmark():
+    r"""Tests for the browser benchmark.
+
+        >>> from schooltool.devtools.benchmark import Benchmark, percentile
+        >>> percentile([3, 1, 2, 4], 50), percentile([3, 1, 2, 4], 90)
+        (2, 4)
+        >>> print percentile([], 50)
+        None
+
+        >>> class SlowBrowser(FakeBrowser):
+        ...     def get(self, url):
+        ...         self.url = url
+        ...     def quit(self):
+        ...         pass
+        >>> def broken(config=None):
+        ...     raise Exception('no such browser')
+
+        >>> benchmark = Benchmark({'slow': SlowBrowser, 'broken': broken},
+        ...                       runs=3)
+        >>> results = benchmark.run('http://localhost/')
+        >>> [(result.factory, result.display, len(result.samples),
+        ...   len(result.errors)) for result in results]
+        [('broken', 'current', 0, 3), ('slow', 'current', 3, 0)]
+        >>> sorted(results[1].samples[0])
+        ['load', 'quit', 'rss', 'spawn']
+
+        >>> print benchmark.report()
+        Browser benchmark (s=spawn, l=load, q=quit seconds,
+                           peak memory of browser and driver):
+        factory          display  runs     s50    s90    s99    l50    l90
+            l99    q50    q90    q99     MB
+        broken           current     0      -      -      -      -      -
+              -      -      -      -      -  (3 errors)
+        slow             current     3   0.00   0.00   0.00   0.00   0.00
+           0.00   0.00   0.00   0.00      -
+
+        >>> sorted(benchmark.as_dict()['results'][1]['percentiles']['load'])
+        ['p50', 'p90', 'p99']
+
+    The benchmark test adds its results to the report of the test runner.
+
+        >>> import os, unittest
+        >>> from schooltool.devtools import selenium_recipe
+        >>> def run_benchmark():
+        ...     result = unittest.TestResult()
+        ...     BrowserBenchmark('test_spawn_load_quit').run(result)
+        ...     return result.wasSuccessful()
+
+        >>> run_benchmark()
+        True
+        >>> selenium_recipe.reports
+        ['No selenium browsers configured, nothing to benchmark.']
+
+        >>> del selenium_recipe.reports[:]
+        >>> selenium_recipe.factories['slow'] = SlowBrowser
+        >>> os.environ['SCHOOLTOOL_BENCHMARK_RUNS'] = '2'
+        >>> run_benchmark()
+        True
+        >>> print selenium_recipe.reports[0]
+        Browser benchmark (s=spawn, l=load, q=quit seconds,
+        ...
+        slow             current     2   0.00   0.00   0.00   0.00   0.00
+           0.00   0.00   0.00   0.00      -
+
+        >>> del os.environ['SCHOOLTOOL_BENCHMARK_RUNS']
+        >>> del selenium_recipe.factories['slow']
+        >>> del selenium_recipe.reports[:]
+
+    """
+
+
+def doctest_ProfileCache():
+    r"""Tests for prepared Firefox profiles.
+
+        >>> import shutil
+        >>> from schooltool.devtools.profiles import ProfileCache
+        >>> from selenium.webdriver.firefox.firefox_profile import EXTENSION_NAME
+        >>> source = tempfile.mkdtemp()
+        >>> os.mkdir(os.path.join(source, 'extensions'))
+        >>> def write(name, data):
+        ...     with open(os.path.join(source, name), 'w') as f:
+        ...         f.write(data)
+        >>> write('user.js', 'user_pref("browser.startup.page", 0);\n')
+        >>> write('places.sqlite', 'places')
+        >>> write(os.path.join('extensions', 'addon.xpi'), 'addon')
+        >>> write('lock', '')
+
+        >>> cache = ProfileCache()
+
+    The source profile is copied once, browsers get copies of the copy,
+    with the webdriver extension installed.
+
+        >>> first = cache.profile(source)
+        >>> second = cache.profile(source)
+        >>> first.template is second.template
+        True
+        >>> first.path != second.path
+        True
+        >>> sorted(os.listdir(first.path))
+        ['extensions', 'places.sqlite', 'user.js']
+        >>> sorted(os.listdir(first.extensionsDir)) == sorted(
+        ...     ['addon.xpi', EXTENSION_NAME])
+        True
+        >>> first.default_preferences['browser.startup.page']
+        0
+        >>> first.add_extension()
+
+    Extensions are shared by hard links, other files are copied.
+
+        >>> def inode(profile, name):
+        ...     return os.stat(os.path.join(profile.path, name)).st_ino
+        >>> (inode(first, os.path.join('extensions', 'addon.xpi')) ==
+        ...  inode(second, os.path.join('extensions', 'addon.xpi')))
+        True
+        >>> inode(first, 'places.sqlite') == inode(second, 'places.sqlite')
+        False
+
+    Remote browsers share the encoded profile, without the extension.
+
+        >>> remote = cache.profile(source, remote=True)
+        >>> remote.encoded is cache.profile(source, remote=True).encoded
+        True
+        >>> remote.template is first.template
+        False
+
+    Changing the source profile makes a new template.
+
+        >>> write('places.sqlite', 'more places')
+        >>> third = cache.profile(source)
+        >>> third.template is first.template
+        False
+        >>> open(os.path.join(third.path, 'places.sqlite')).read()
+        'more places'
+
+        >>> cache.stop()
+        >>> os.path.exists(first.template.path)
+        False
+        >>> for profile in first, second, third:
+        ...     shutil.rmtree(profile.path)
+        >>> shutil.rmtree(source)
+
+    """
+
+
+def doctest_DOMQuery():
+    r"""Tests for batched DOM queries.
+
+        >>> from schooltool.devtools import dom
+        >>> class ScriptBrowser(object):
+        ...     def __init__(self, result):
+        ...         self.result = result
+        ...     def execute_script(self, script, *args):
+        ...         names = dict([(getattr(dom, name), name)
+        ...                       for name in dir(dom)
+        ...                       if name.endswith('_SCRIPT')])
+        ...         print names[script], args
+        ...         return self.result
+
+    Elements are read with one script.
+
+        >>> query = dom.DOMQuery(ScriptBrowser([
+        ...     {'tag': 'td', 'text': '10', 'value': None, 'visible': True,
+        ...      'attributes': {'class': 'score', 'id': 'a'}},
+        ...     {'tag': 'td', 'text': '7', 'value': None, 'visible': False,
+        ...      'attributes': {'class': 'score', 'id': 'b'}}]))
+        >>> query.texts('td.score')
+        ELEMENTS_SCRIPT (None, 'td.score', [])
+        ['10', '7']
+        >>> query.visible('td.score', within='<grid>')
+        ELEMENTS_SCRIPT ('<grid>', 'td.score', [])
+        [True, False]
+        >>> query.attributes('td', 'id')
+        ELEMENTS_SCRIPT (None, 'td', ['id'])
+        ['a', 'b']
+
+    Tables are lists of rows, or dicts keyed by header cells.
+
+        >>> query = dom.DOMQuery(ScriptBrowser([
+        ...     {'header': True, 'cells': ['Name', 'Score']},
+        ...     {'header': False, 'cells': ['Ann', '10']},
+        ...     {'header': False, 'cells': ['Bob', '7']}]))
+        >>> query.table('#grid')
+        TABLE_SCRIPT (None, '#grid')
+        [['Name', 'Score'], ['Ann', '10'], ['Bob', '7']]
+        >>> [sorted(row.items()) for row in query.table('#grid', header=True)]
+        TABLE_SCRIPT (None, '#grid')
+        [[('Name', 'Ann'), ('Score', '10')], [('Name', 'Bob'), ('Score', '7')]]
+
+        >>> dom.DOMQuery(ScriptBrowser(None)).table('#missing')
+        Traceback (most recent call last):
+          ...
+        ElementNotFound: Table '#missing' not found
+
+    Forms are filled at once.
+
+        >>> dom.DOMQuery(ScriptBrowser([])).fill(
+        ...     {'#name': 'Ann', '#active': True})
+        FILL_SCRIPT (None, [['#active', True], ['#name', 'Ann']])
+        >>> dom.DOMQuery(ScriptBrowser(['#nope'])).fill([('#nope', 1)])
+        Traceback (most recent call last):
+          ...
+        ElementNotFound: Form controls not found: #nope
+
+    """
+
+
+def doctest_CommandTracer():
+    r"""Tests for tracing of WebDriver commands.
+
+        >>> from schooltool.devtools.trace import CommandTracer
+        >>> from schooltool.devtools.trace import trace_commands
+
+        >>> class Executor(object):
+        ...     def execute(self, command, params):
+        ...         return {'status': 0, 'value': 'x' * 2000}
+        >>> class Browser(object):
+        ...     command_executor = Executor()
+        ...     def get(self, url):
+        ...         return self.command_executor.execute('get', {'url': url})
+
+        >>> tracer = CommandTracer()
+        >>> browser = Browser()
+        >>> trace_commands(browser, tracer)
+        >>> trace_commands(browser, tracer)
+
+        >>> namespace = {'__name__': 'app.tests'}
+        >>> exec ("def open_page(browser):\n"
+        ...       "    browser.get('http://localhost/')\n") in namespace
+        >>> open_page = namespace['open_page']
+        >>> browser.get('http://localhost/')['status']
+        0
+        >>> tracer.start_test('test_page')
+        >>> open_page(browser)
+        >>> open_page(browser)
+        >>> tracer.stop_test()
+
+    Commands are counted in histograms of the run and of each test.
+
+        >>> print tracer.report()
+        WebDriver commands:
+            0.00s      3 get      0 KB out   5 KB in  <1ms:3
+        >>> [(test['name'], test['commands']['get']['count'])
+        ...  for test in tracer.as_dict()['tests']]
+        [('test_page', 2)]
+
+    Time is traced by the test code stack that sent the command, in
+    microseconds.
+
+        >>> print tracer.collapsed()
+        (no test);get ...
+        test_page;app.tests:open_page;get ...
+
+    Test runner subprocesses save their traces without printing anything,
+    their stdout is already closed when the runner reports.
+
+        >>> import shutil
+        >>> from schooltool.devtools import selenium_recipe
+        >>> directory = tempfile.mkdtemp()
+
+        >>> class ClosedOutput(object):
+        ...     def info(self, message):
+        ...         raise ValueError('I/O operation on closed file')
+        >>> class Options(object):
+        ...     resume_layer = 'app.tests.Layer'
+        ...     resume_number = 2
+        ...     selenium_trace = os.path.join(directory, 'trace')
+        ...     selenium_timings = 0
+        ...     selenium_timings_file = None
+        ...     output = ClosedOutput()
+        >>> class Runner(object):
+        ...     options = Options()
+
+        >>> selenium_recipe.tracer = tracer
+        >>> selenium_recipe.RunnerSeleniumFeature(Runner()).report()
+        >>> sorted(os.listdir(directory))
+        ['trace.layer-2', 'trace.layer-2.json']
+
+    The main process adds them to its own trace.
+
+        >>> class Output(object):
+        ...     def info(self, message):
+        ...         print message
+        >>> Runner.options.resume_layer = None
+        >>> Runner.options.output = Output()
+        >>> selenium_recipe.tracer = CommandTracer()
+        >>> selenium_recipe.RunnerSeleniumFeature(Runner()).report()
+        WebDriver commands:
+            0.00s      3 get      0 KB out   5 KB in  <1ms:3
+        >>> sorted(os.listdir(directory))
+        ['trace', 'trace.json']
+        >>> print open(os.path.join(directory, 'trace')).read()
+        (no test);get ...
+        test_page;app.tests:open_page;get ...
+
+        >>> selenium_recipe.tracer = None
+        >>> shutil.rmtree(directory)
+
+    """
+
+
+def doctest_PooledRemoteConnection():
+    r"""Tests for pooled keep-alive command executors.
+
+        >>> import BaseHTTPServer, SocketServer, threading, time
+        >>> from schooltool.devtools.connection import ConnectionPools
+        >>> from schooltool.devtools.connection import pooled_connection
+
+        >>> class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        ...     protocol_version = 'HTTP/1.1'
+        ...     clients = set()
+        ...     requests = []
+        ...     drop = 0
+        ...     def do_GET(self):
+        ...         Handler.clients.add(self.client_address)
+        ...         Handler.requests.append(self.path)
+        ...         if Handler.drop:
+        ...             # Close without a response, like a stale connection.
+        ...             Handler.drop -= 1
+        ...             self.close_connection = 1
+        ...             return
+        ...         if self.path.endswith('/slow'):
+        ...             time.sleep(0.5)
+        ...         data = '{"status": 0, "value": "%s"}' % self.path
+        ...         self.send_response(200)
+        ...         self.send_header('Content-Type', 'application/json')
+        ...         self.send_header('Content-Length', str(len(data)))
+        ...         self.end_headers()
+        ...         self.wfile.write(data)
+        ...     def log_message(self, *args):
+        ...         pass
+        >>> class Server(SocketServer.ThreadingMixIn,
+        ...              BaseHTTPServer.HTTPServer):
+        ...     daemon_threads = True
+        ...     def handle_error(self, request, client_address):
+        ...         pass
+        >>> server = Server(('127.0.0.1', 0), Handler)
+        >>> thread = threading.Thread(target=server.serve_forever)
+        >>> thread.daemon = True
+        >>> thread.start()
+        >>> url = 'http://127.0.0.1:%d/wd/hub' % server.server_address[1]
+
+    Executors of the same server share connections.
+
+        >>> pools = ConnectionPools()
+        >>> first = pooled_connection(url, pools=pools, size=2)
+        >>> second = pooled_connection(url, pools=pools, size=2)
+        >>> first.pool is second.pool
+        True
+        >>> first.execute('status', {})
+        {u'status': 0, u'value': u'/wd/hub/status'}
+        >>> second.execute('getCurrentUrl', {'sessionId': 'abc'})
+        {u'status': 0, u'value': u'/wd/hub/session/abc/url'}
+        >>> first.execute('status', {})['status']
+        0
+        >>> first.pool.created, first.pool.reused, len(Handler.clients)
+        (1, 2, 1)
+
+    A connection the server dropped is replaced, and the command is sent
+    again.
+
+        >>> Handler.drop = 1
+        >>> del Handler.requests[:]
+        >>> first.execute('status', {})['status']
+        0
+        >>> first.pool.created, Handler.requests
+        (2, ['/wd/hub/status', '/wd/hub/status'])
+
+    Commands are sent again only once.
+
+        >>> connections = [first.pool.acquire()[0] for n in range(2)]
+        >>> for connection in connections:
+        ...     first.pool.release(connection)
+        >>> Handler.drop = 2
+        >>> first.execute('status', {})
+        Traceback (most recent call last):
+        ...
+        BadStatusLine: ...
+        >>> Handler.drop = 0
+
+    Commands that time out may have been carried out, they are not sent
+    again.
+
+        >>> slow = pooled_connection(url, pools=pools, timeout=0.1)
+        >>> slow.execute('status', {})['status']
+        0
+        >>> del Handler.requests[:]
+        >>> slow._request('GET', url + '/slow')
+        Traceback (most recent call last):
+        ...
+        timeout: timed out
+        >>> Handler.requests
+        ['/wd/hub/slow']
+
+    Idle connections expire.
+
+        >>> created = first.pool.created
+        >>> first.pool.idle_timeout = 0
+        >>> first.execute('status', {})['status']
+        0
+        >>> first.pool.created - created
+        1
+
+        >>> pools.clear()
+        >>> server.shutdown()
+        >>> server.server_close()
+
+    """
+
+
+def doctest_ChromeServices():
+    r"""Tests for shared chromedriver services.
+
+        >>> from schooltool.devtools.webdriver import ChromeServices
+
+        >>> class FakeProcess(object):
+        ...     returncode = None
+        ...     def poll(self):
+        ...         return self.returncode
+
+        >>> class FakeService(object):
+        ...     def __init__(self, path, port):
+        ...         self.path, self.port = path, port
+        ...         self.process = FakeProcess()
+        ...     def stop(self):
+        ...         print 'stop %r' % self
+        ...     def __repr__(self):
+        ...         return '<service %s:%d>' % (self.path, self.port)
+
+        >>> class TestServices(ChromeServices):
+        ...     port = 9000
+        ...     def start(self, path, port):
+        ...         self.port += 1
+        ...         print 'start %s' % path
+        ...         return FakeService(path, port or self.port)
+
+        >>> services = TestServices()
+
+    Browsers share a running chromedriver.
+
+        >>> first = services.acquire('chromedriver')
+        start chromedriver
+        >>> services.acquire('chromedriver') is first
+        True
+
+    Unless it has too many sessions already.
+
+        >>> second = services.acquire('chromedriver', max_sessions=2)
+        start chromedriver
+        >>> second
+        <service chromedriver:9002>
+        >>> services.release(first)
+        >>> services.acquire('chromedriver', max_sessions=2)
+        <service chromedriver:9001>
+
+    Crashed services are replaced.
+
+        >>> first.process.returncode = -11
+        >>> services.acquire('chromedriver')
+        stop <service chromedriver:9001>
+        <service chromedriver:9002>
+
+        >>> services.stop()
+        stop <service chromedriver:9002>
+        >>> services.stop()
+
+    """
+
+
+def make_png(width, height, level=0, text='Software: selenium'):
+    import struct, zlib
+    from schooltool.devtools.screenshots import PNG_SIGNATURE, png_chunk
+    header = struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+    pixels = ('\x00' + '\x80' * width) * height
+    return ''.join([PNG_SIGNATURE,
+                    png_chunk('IHDR', header),
+                    png_chunk('tEXt', text),
+                    png_chunk('IDAT', zlib.compress(pixels, level)),
+                    png_chunk('IEND', '')])
+
+
+def doctest_ScreenshotWriter():
+    r"""Tests for the background screenshot writer.
+
+        >>> from schooltool.devtools.screenshots import png_chunks
+        >>> from schooltool.devtools.screenshots import optimize_png
+
+    Screenshots are recompressed before they are written.
+
+        >>> png = make_png(100, 100)
+        >>> optimized = optimize_png(png)
+        >>> len(optimized) < len(png)
+        True
+        >>> [chunk_type for chunk_type, data in png_chunks(optimized)]
+        ['IHDR', 'IDAT', 'IEND']
+
+        >>> optimize_png('not a png')
+        'not a png'
+
+    Identical screenshots are stored once, named after their content.
+
+        >>> from schooltool.devtools.screenshots import ScreenshotWriter
+        >>> import shutil, json
+        >>> directory = tempfile.mkdtemp()
+        >>> writer = ScreenshotWriter(directory, url='http://ci/shots/')
+
+        >>> def print_entry(entry):
+        ...     print entry['name'], entry['file'], entry['url']
+
+        >>> print_entry(writer.add(png, test_id='test_a', name='start'))
+        start e1b3eb...png http://ci/shots/e1b3eb...png
+        >>> print_entry(writer.add(png, test_id='test_b'))
+        None e1b3eb...png http://ci/shots/e1b3eb...png
+        >>> print_entry(writer.add(make_png(10, 10), test_id='test_b',
+        ...                        name='end'))
+        end ...png http://ci/shots/...png
+
+    Other test output is written too, converted in the writer thread if
+    given as a function.
+
+        >>> from schooltool.devtools.screenshots import test_filename
+        >>> filename = 'http/' + test_filename('test_b (pkg.tests)', '.har')
+        >>> print_entry(writer.add_file(filename, lambda: '{}',
+        ...                             test_id='test_b', name='HTTP'))
+        HTTP http/test_b_pkg.tests.har http://ci/shots/http/test_b_pkg.tests.har
+
+        >>> writer.close()
+        >>> sorted(os.listdir(directory))
+        ['...png', '...png', 'http', 'index.json']
+        >>> open(os.path.join(directory, filename)).read()
+        '{}'
+
+        >>> index = json.load(open(os.path.join(directory, 'index.json')))
+        >>> sorted(index)
+        [u'test_a', u'test_b']
+        >>> [entry['name'] for entry in index['test_b']]
+        [None, u'end', u'HTTP']
+
+        >>> shutil.rmtree(directory)
+
+    """
+
+
+def doctest_DownloadWatcher():
+    r"""Tests for the download watcher.
+
+        >>> import shutil, threading
+        >>> from schooltool.devtools.downloads import DownloadWatcher
+        >>> directory = tempfile.mkdtemp()
+        >>> open(os.path.join(directory, 'old.pdf'), 'w').close()
+
+        >>> watcher = DownloadWatcher(directory)
+        >>> watcher.start()
+
+        >>> def download(name, partial='.crdownload'):
+        ...     path = os.path.join(directory, name)
+        ...     with open(path + partial, 'w') as f:
+        ...         f.write('%PDF')
+        ...     os.rename(path + partial, path)
+
+    Files present before the watcher started are not downloads.
+
+        >>> watcher.wait(timeout=0.1)
+        Traceback (most recent call last):
+        ...
+        DownloadTimeout: Download to ... did not complete in 0.1 seconds
+
+    Partial downloads are not complete.
+
+        >>> open(os.path.join(directory, 'report.xls.part'), 'w').close()
+        >>> watcher.wait('report.xls', timeout=0.1)
+        Traceback (most recent call last):
+        ...
+        DownloadTimeout: Download report.xls did not complete in 0.1 seconds
+
+    Wait for the next download.
+
+        >>> threading.Timer(0.1, download, ('report.pdf', )).start()
+        >>> watcher.wait()
+        '/.../report.pdf'
+
+    Or for a named one.
+
+        >>> threading.Timer(0.1, download, ('report.xls', '.part')).start()
+        >>> watcher.wait('report.xls')
+        '/.../report.xls'
+
+    A file downloaded again under the same name is a new download.
+
+        >>> threading.Timer(0.1, download, ('report.pdf', )).start()
+        >>> watcher.wait('report.pdf')
+        '/.../report.pdf'
+
+        >>> watcher.stop()
+
+    Without inotify the directory is polled, downloads under names seen
+    before are told by their modification time and size.
+
+        >>> from schooltool.devtools import downloads
+        >>> real_load_inotify = downloads.load_inotify
+        >>> downloads.load_inotify = lambda: None
+        >>> watcher = DownloadWatcher(directory)
+        >>> watcher.start()
+        >>> watcher.thread.name, watcher.thread._Thread__target.__name__
+        ('selenium-download-watcher', 'poll')
+
+        >>> watcher.wait('report.pdf', timeout=0.3)
+        Traceback (most recent call last):
+        ...
+        DownloadTimeout: Download report.pdf did not complete in 0.3 seconds
+
+        >>> threading.Timer(0.1, download, ('report.pdf', )).start()
+        >>> watcher.wait('report.pdf')
+        '/.../report.pdf'
+        >>> threading.Timer(0.1, download, ('report.pdf', )).start()
+        >>> watcher.wait()
+        '/.../report.pdf'
+
+        >>> watcher.stop()
+        >>> downloads.load_inotify = real_load_inotify
+        >>> shutil.rmtree(directory)
+
+    """
+
+
+def doctest_SeleniumTimings():
+    r"""Tests for selenium timing instrumentation.
+
+        >>> from schooltool.devtools.timing import SeleniumTimings
+        >>> from schooltool.devtools.timing import time_commands
+
+        >>> class CommandBrowser(object):
+        ...     def execute(self, command, params=None):
+        ...         if command == 'findElements':
+        ...             return {'value': []}
+        ...         if command == 'findElement':
+        ...             raise LookupError('no such element')
+        ...         return {'value': None}
+
+        >>> timings = SeleniumTimings()
+        >>> timings.start_layer('stests.Layer')
+        >>> browser = CommandBrowser()
+        >>> time_commands(browser, timings)
+
+    Commands outside of tests count towards the layer only.
+
+        >>> browser.execute('implicitlyWait', {'ms': 30000})
+        {'value': None}
+
+        >>> timings.start_test('test_login')
+        >>> timings.add('spawn', 2.5)
+        >>> browser.execute('get', {'url': 'http://localhost/'})
+        {'value': None}
+        >>> browser.execute('findElements', {'using': 'id', 'value': 'x'})
+        {'value': []}
+        >>> browser.execute('findElement', {'using': 'id', 'value': 'x'})
+        Traceback (most recent call last):
+        ...
+        LookupError: no such element
+        >>> timings.stop_test()
+
+        >>> [test] = timings.tests
+        >>> test.command_count, sorted(test.commands)
+        (3, ['findElement', 'findElements', 'get'])
+        >>> test.times['spawn']
+        2.5
+        >>> test.times['wait'] <= test.times['commands']
+        True
+        >>> timings.layers['stests.Layer'].command_count
+        4
+
+        >>> print timings.report(5)
+        Slowest selenium tests:
+            ...s test_login
+                   spawn 2.50s, 3 commands 0.00s, implicit waits 0.00s,
+                   explicit waits 0.00s, screenshots 0.00s, downloads 0.00s
+        Selenium time by layer:
+            ...s stests.Layer
+                   spawn 2.50s, 4 commands 0.00s, implicit waits 0.00s,
+                   explicit waits 0.00s, screenshots 0.00s, downloads 0.00s
+
+    Test runner subprocesses save their timings, the main process adds
+    them to its own.
+
+        >>> directory = tempfile.mkdtemp()
+        >>> path = os.path.join(directory, 'timings.json')
+        >>> timings.save(path)
+        >>> merged = SeleniumTimings()
+        >>> merged.start_layer('stests.Layer')
+        >>> merged.start_test('test_logout')
+        >>> merged.add('spawn', 1.5)
+        >>> merged.stop_test()
+        >>> merged.load(path)
+        >>> [test.name for test in merged.tests]
+        ['test_logout', u'test_login']
+        >>> layer = merged.layers['stests.Layer']
+        >>> layer.times['spawn'], layer.command_count
+        (4.0, 4)
+
+        >>> import shutil
+        >>> shutil.rmtree(directory)
+
+    """
+
+
+def doctest_Waits():
+    r"""Tests for explicit waits.
+
+        >>> from schooltool.devtools.waits import Waits
+
+        >>> class SlowPage(object):
+        ...     def __init__(self, results):
+        ...         self.results = list(results)
+        ...     def find_elements(self, by, value):
+        ...         print 'find %s %r' % (by, value)
+        ...         if len(self.results) > 1:
+        ...             return self.results.pop(0)
+        ...         return self.results[0]
+        ...     def implicitly_wait(self, seconds):
+        ...         print 'implicit wait %s' % seconds
+
+        >>> browser = SlowPage([[], [], ['<div id="content">']])
+        >>> waits = Waits(browser, poll=0.001, implicit_wait=30)
+
+    Conditions are polled with the implicit wait off.
+
+        >>> waits.present('#content')
+        implicit wait 0
+        find css selector '#content'
+        find css selector '#content'
+        find css selector '#content'
+        implicit wait 30
+        '<div id="content">'
+
+    Waiting for things to go away does not wait longer than needed.
+
+        >>> browser = SlowPage([['<img class="spinner">'], []])
+        >>> waits = Waits(browser, poll=0.001)
+        >>> waits.absent('.spinner', by='css selector')
+        find css selector '.spinner'
+        find css selector '.spinner'
+
+    Timeouts fail the test.
+
+        >>> waits.present('#missing', timeout=0.01)
+        Traceback (most recent call last):
+        ...
+        WaitTimeout: Element '#missing' not found
+
+        >>> waits.waited > 0
+        True
+
+    Elements replaced while a condition looks at them are looked up again.
+
+        >>> from selenium.common.exceptions import (
+        ...     StaleElementReferenceException)
+        >>> class Element(object):
+        ...     def __init__(self, text, stale=0):
+        ...         self._text = text
+        ...         self.stale = stale
+        ...     def check(self):
+        ...         if self.stale:
+        ...             self.stale -= 1
+        ...             raise StaleElementReferenceException('re-rendered')
+        ...     @property
+        ...     def text(self):
+        ...         self.check()
+        ...         return self._text
+        ...     def is_displayed(self):
+        ...         self.check()
+        ...         return True
+        ...     def __repr__(self):
+        ...         return '<%s>' % self._text
+
+        >>> browser = SlowPage([[Element('Saved', stale=1)],
+        ...                     [Element('Saved')]])
+        >>> waits = Waits(browser, poll=0.001)
+        >>> waits.text('.message', 'Saved')
+        find css selector '.message'
+        find css selector '.message'
+        <Saved>
+
+        >>> browser = SlowPage([[Element('Dialog', stale=1)],
+        ...                     [Element('Dialog')]])
+        >>> waits = Waits(browser, poll=0.001)
+        >>> waits.visible('.dialog')
+        find css selector '.dialog'
+        find css selector '.dialog'
+        <Dialog>
+
+    Elements removed from the page are not visible.
+
+        >>> browser = SlowPage([[Element('Spinner', stale=1)]])
+        >>> waits.browser = browser
+        >>> waits.invisible('.spinner')
+        find css selector '.spinner'
+
+    """
+
+
+def doctest_VirtualDisplay():
+    r"""Tests for the run-wide virtual display.
+
+        >>> from schooltool.devtools import selenium_recipe
+
+        >>> class FakeDisplay(object):
+        ...     alive = True
+        ...     def __init__(self, display):
+        ...         self.display = display
+        ...     def is_alive(self):
+        ...         return self.alive
+        ...     def stop(self):
+        ...         print 'stop :%d' % self.display
+
+        >>> displays = []
+        >>> def start_virtual_display(**kw):
+        ...     display = FakeDisplay(1000 + len(displays))
+        ...     print 'start :%d %s' % (display.display, sorted(kw.items()))
+        ...     displays.append(display)
+        ...     return display
+
+        >>> real_start = selenium_recipe.start_virtual_display
+        >>> selenium_recipe.start_virtual_display = start_virtual_display
+
+    The display is started on first use and then reused.
+
+        >>> vd = selenium_recipe.VirtualDisplay(backend='xvfb')
+        >>> vd.ensure()
+        start :1000 [('backend', 'xvfb')]
+        >>> vd.ensure()
+
+    It is restarted only if it dies.
+
+        >>> import sys
+        >>> displays[0].alive = False
+        >>> sys.stderr = sys.stdout
+        >>> vd.ensure()
+        warning: virtual display :1000 died, restarting
+        stop :1000
+        start :1001 [('backend', 'xvfb')]
+        >>> sys.stderr = sys.__stderr__
+
+        >>> vd.stop()
+        stop :1001
+        >>> vd.stop()
+
+        >>> selenium_recipe.start_virtual_display = real_start
+
+    """
+
+
+def doctest_start_virtual_display():
+    r"""Tests for starting virtual displays one process at a time.
+
+        >>> import fcntl, shutil, sys, tempfile, types
+        >>> from schooltool.devtools import selenium_recipe
+        >>> directory = tempfile.mkdtemp()
+        >>> real_lock = selenium_recipe.virtual_display_lock
+        >>> selenium_recipe.virtual_display_lock = os.path.join(
+        ...     directory, 'display.lock')
+
+        >>> def locked():
+        ...     f = open(selenium_recipe.virtual_display_lock)
+        ...     try:
+        ...         try:
+        ...             fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        ...         except IOError:
+        ...             return True
+        ...         return False
+        ...     finally:
+        ...         f.close()
+
+        >>> class Display(object):
+        ...     display = 4321
+        ...     def __init__(self, **kw):
+        ...         print 'Display(%s)' % sorted(kw.items())
+        ...     def start(self):
+        ...         print 'start, display number locked: %s' % locked()
+        ...         open('/tmp/.X4321-lock', 'w').close()
+        >>> pyvirtualdisplay = types.ModuleType('pyvirtualdisplay')
+        >>> pyvirtualdisplay.Display = Display
+        >>> sys.modules['pyvirtualdisplay'] = pyvirtualdisplay
+
+    Other processes cannot start a display until the X server has claimed
+    its display number.
+
+        >>> display = selenium_recipe.start_virtual_display(visible=False)
+        Display([('visible', False)])
+        start, display number locked: True
+        >>> display.display, locked()
+        (4321, False)
+
+        >>> os.unlink('/tmp/.X4321-lock')
+        >>> del sys.modules['pyvirtualdisplay']
+        >>> selenium_recipe.virtual_display_lock = real_lock
+        >>> shutil.rmtree(directory)
+
+    """
+
+
+def doctest_RunnerSeleniumFeature_layer_paths():
+    r"""Tests for files of layers run in test runner subprocesses.
+
+        >>> import shutil
+        >>> from schooltool.devtools import selenium_recipe
+
+        >>> class Options(object):
+        ...     resume_layer = None
+        ...     resume_number = None
+        >>> class Runner(object):
+        ...     options = Options()
+        >>> feature = selenium_recipe.RunnerSeleniumFeature(Runner())
+
+    The main process uses paths as they are.
+
+        >>> print feature.layer_number
+        None
+        >>> feature.layer_path('/tmp/screenshots')
+        '/tmp/screenshots'
+        >>> feature.layer_file('/tmp/trace')
+        '/tmp/trace'
+        >>> feature.layer_url('http://localhost/screenshots/')
+        'http://localhost/screenshots/'
+
+    With -j, every layer runs in a subprocess numbered by zope.testrunner,
+    and gets directories, files and URLs of its own.
+
+        >>> Runner.options.resume_layer = 'app.tests.Layer'
+        >>> Runner.options.resume_number = 3
+        >>> feature.layer_number
+        3
+        >>> feature.layer_path('/tmp/screenshots')
+        '/tmp/screenshots/layer-3'
+        >>> feature.layer_file('/tmp/trace')
+        '/tmp/trace.layer-3'
+        >>> feature.layer_url('http://localhost/screenshots/')
+        'http://localhost/screenshots/layer-3/'
+
+    The main process finds the files of the layers.
+
+        >>> directory = tempfile.mkdtemp()
+        >>> for name in ['trace', 'trace.layer-1', 'trace.layer-12',
+        ...              'trace.layer-1.json', 'trace.layer-x', 'other']:
+        ...     open(os.path.join(directory, name), 'w').close()
+        >>> [os.path.basename(path) for path in
+        ...  feature.layer_files(os.path.join(directory, 'trace'))]
+        ['trace.layer-1', 'trace.layer-12']
+        >>> feature.layer_files(os.path.join(directory, 'missing', 'trace'))
+        []
+
+    Layer directories are made as needed, another process may have made
+    them already.
+
+        >>> path = feature.layer_path(os.path.join(directory, 'screenshots'))
+        >>> selenium_recipe.make_dirs(path)
+        >>> selenium_recipe.make_dirs(path)
+        >>> os.path.isdir(path)
+        True
+        >>> shutil.rmtree(directory)
+
+    """
+
+
+def doctest_DisplayRecorder():
+    r"""Tests for the ring buffer recording of the virtual display.
+
+        >>> import sys, time
+        >>> from schooltool.devtools.recording import DisplayRecorder
+
+    ffmpeg writes segments of a few seconds, wrapping around to overwrite
+    the oldest one.
+
+        >>> recorder = DisplayRecorder(seconds=12)
+        >>> recorder.segments
+        4
+        >>> recorder.directory = '/dev/shm/rec'
+        >>> print ' '.join(recorder.command(':1', (1024, 768)))
+        ffmpeg -nostdin -loglevel error -f x11grab -draw_mouse 0
+        -framerate 5 -video_size 1024x768 -i :1
+        -c:v libx264 -preset ultrafast -tune zerolatency -pix_fmt yuv420p
+        -force_key_frames expr:gte(t,n_forced*5)
+        -f segment -segment_format mpegts -segment_time 5 -segment_wrap 4
+        /dev/shm/rec/segment-%03d.ts
+
+    The recording is the segments in the order they were written.
+
+        >>> recorder.command = lambda display, size: [
+        ...     sys.executable, '-c', 'import time; time.sleep(30)']
+        >>> open_files = len(os.listdir('/proc/self/fd'))
+        >>> recorder.start(':1', (1024, 768))
+        >>> recorder.alive
+        True
+        >>> recorder.recording() is None
+        True
+
+        >>> def write_segment(n, data, mtime):
+        ...     filename = os.path.join(recorder.directory,
+        ...                             'segment-%03d.ts' % n)
+        ...     with open(filename, 'w') as f:
+        ...         f.write(data)
+        ...     os.utime(filename, (mtime, mtime))
+        >>> now = time.time()
+        >>> write_segment(0, 'fourth', now)
+        >>> write_segment(1, 'second', now - 10)
+        >>> write_segment(2, 'third', now - 5)
+        >>> write_segment(3, 'first', now - 15)
+        >>> recorder.recording()
+        'firstsecondthirdfourth'
+
+    Stopping kills ffmpeg and removes the segments.
+
+        >>> directory = recorder.directory
+        >>> process = recorder.process
+        >>> recorder.stop()
+        >>> process.poll() is not None
+        True
+        >>> os.path.exists(directory)
+        False
+        >>> recorder.recording() is None
+        True
+
+    No files are left open.
+
+        >>> del process
+        >>> len(os.listdir('/proc/self/fd')) == open_files
+        True
+
+    Without ffmpeg, nothing is recorded.
+
+        >>> recorder = DisplayRecorder()
+        >>> recorder.ffmpeg = '/nonexistent/ffmpeg'
+        >>> sys.stderr = sys.stdout
+        >>> recorder.start(':1', (1024, 768))
+        warning: cannot record display :1: /nonexistent/ffmpeg: ...
+        >>> sys.stderr = sys.__stderr__
+        >>> recorder.recording() is None
+        True
+        >>> recorder.stop()
+
+    """
+
+
+def doctest_FailureCapture():
+    r"""Tests for capturing browsers of failed tests.
+
+        >>> import shutil, threading
+        >>> from schooltool.devtools.failures import FailureCapture
+        >>> from schooltool.devtools.screenshots import ScreenshotWriter
+
+        >>> class CapturedBrowser(FakeBrowser):
+        ...     page_source = u'<html>\u2713</html>'
+        ...     hang = None
+        ...     def get_screenshot_as_png(self):
+        ...         return make_png(10, 10, text=self.name)
+        ...     def get_log(self, log_type):
+        ...         if self.hang is not None:
+        ...             self.hang.wait()
+        ...         return [{'level': 'SEVERE', 'timestamp': None,
+        ...                  'message': 'Uncaught TypeError'}]
+
+    Browsers are live until they quit.
+
+        >>> FakeBrowser.instances = 0
+        >>> capture = FailureCapture(timeout=0.5)
+        >>> first, second = CapturedBrowser(), CapturedBrowser()
+        >>> capture.add(first)
+        >>> capture.add(second)
+        >>> capture.add(second)
+        >>> capture.live_browsers()
+        [<browser-1>, <browser-2>]
+        >>> second.quit()
+        browser-2: quit
+        >>> capture.live_browsers()
+        [<browser-1>]
+
+    Pooled browsers quit bypassing quit(), the pool tells about them.
+
+        >>> from schooltool.devtools import browserpool
+        >>> browserpool.quit_listeners.append(capture.forget)
+        >>> third = CapturedBrowser()
+        >>> capture.add(third)
+        >>> browserpool.real_quit(third)
+        browser-3: quit
+        >>> capture.live_browsers()
+        [<browser-1>]
+        >>> browserpool.quit_listeners.remove(capture.forget)
+
+    Browsers are captured in parallel.  Those that hang are left behind
+    after the timeout, with what they returned so far.
+
+        >>> second.hang = threading.Event()
+        >>> states = capture.capture([first, second])
+        >>> [sorted(state) for state in states]
+        [['console', 'screenshot', 'source'],
+         ['screenshot', 'source', 'timed out']]
+        >>> second.hang.set()
+
+    States are written in background, next to screenshots.
+
+        >>> directory = tempfile.mkdtemp()
+        >>> writer = ScreenshotWriter(directory, url='http://ci/shots/')
+        >>> entries = capture.save(writer, 'app.tests.test_form', states)
+        >>> for entry in entries:
+        ...     print '%s: %s' % (entry['name'], entry['url'])
+        Screenshot of browser 1: http://ci/shots/...png
+        Page source of browser 1:
+            http://ci/shots/failures/app.tests.test_form-1.html
+        Console log of browser 1:
+            http://ci/shots/failures/app.tests.test_form-1.log
+        Screenshot of browser 2: http://ci/shots/...png
+        Page source of browser 2:
+            http://ci/shots/failures/app.tests.test_form-2.html
+        >>> writer.close()
+
+        >>> print open(os.path.join(
+        ...     directory, 'failures', 'app.tests.test_form-1.log')).read()
+        - SEVERE Uncaught TypeError
+        >>> open(os.path.join(
+        ...     directory, 'failures', 'app.tests.test_form-2.html')).read()
+        '<html>\xe2\x9c\x93</html>'
+        >>> len(writer.index['app.tests.test_form'])
+        5
+
+        >>> shutil.rmtree(directory)
+
+    """
+
+
+def doctest_SessionCache():
+    r"""Tests for capturing and restoring logged in sessions.
+
+        >>> from schooltool.devtools.sessions import SessionCache
+        >>> from schooltool.devtools.sessions import capture_storage_script
+
+        >>> class SessionBrowser(FakeBrowser):
+        ...     current_url = 'about:blank'
+        ...     cookies = ()
+        ...     def get(self, url):
+        ...         print '%s: get %s' % (self.name, url)
+        ...         self.current_url = url
+        ...     def get_cookies(self):
+        ...         return list(self.cookies)
+        ...     def add_cookie(self, cookie):
+        ...         print '%s: add cookie %s' % (self.name, sorted(cookie.items()))
+        ...     def execute_script(self, script, *args):
+        ...         if script == capture_storage_script:
+        ...             return [{'token': 'abc'}, {}]
+        ...         print '%s: restore storage %s' % (self.name, list(args))
+
+        >>> def login(browser):
+        ...     print 'logging in through the UI'
+        ...     browser.get('http://localhost:7080/persons/manager')
+        ...     browser.cookies = [{'name': '__ac', 'value': 's3cr3t',
+        ...                         'domain': 'localhost', 'path': '/',
+        ...                         'secure': False, 'expiry': None}]
+
+        >>> cache = SessionCache()
+
+    The first login goes through the UI, and the session is captured.
+
+        >>> browser = SessionBrowser()
+        >>> cache.login(browser, ('manager', 'Layer'), login)
+        logging in through the UI
+        browser-...: get http://localhost:7080/persons/manager
+
+    Later logins restore cookies and storage, and open the page the login
+    ended on.
+
+        >>> browser = SessionBrowser()
+        >>> cache.login(browser, ('manager', 'Layer'), login)
+        browser-...: get http://localhost:7080/robots.txt
+        browser-...: delete cookies
+        browser-...: add cookie [('name', '__ac'), ('path', '/'),
+                                 ('secure', False), ('value', 's3cr3t')]
+        browser-...: restore storage [{'token': 'abc'}, {}]
+        browser-...: get http://localhost:7080/persons/manager
+        >>> cache.hits, cache.misses
+        (1, 1)
+
+    Stale sessions are detected with a check and logged in again.
+
+        >>> browser = SessionBrowser()
+        >>> cache.login(browser, ('manager', 'Layer'), login,
+        ...             check=lambda browser: False)
+        browser-...: get http://localhost:7080/robots.txt
+        ...
+        browser-...: delete cookies
+        logging in through the UI
+        browser-...: get http://localhost:7080/persons/manager
+        >>> cache.hits, cache.misses
+        (1, 2)
+
+    """
+
+
+def doctest_make_har():
+    r"""Tests for converting Chrome performance logs to HAR.
+
+        >>> import json
+        >>> from schooltool.devtools.har import make_har, HttpCapture
+
+        >>> def event(method, **params):
+        ...     message = {'message': {'method': method, 'params': params}}
+        ...     return {'message': json.dumps(message),
+        ...             'timestamp': 1400000000000}
+
+        >>> log = [
+        ...     event('Page.frameNavigated'),
+        ...     event('Network.requestWillBeSent', requestId='1',
+        ...           timestamp=100.0, wallTime=1400000000.5,
+        ...           request={'url': 'http://localhost/login',
+        ...                    'method': 'POST'}),
+        ...     event('Network.requestWillBeSent', requestId='1',
+        ...           timestamp=100.1,
+        ...           request={'url': 'http://localhost/', 'method': 'GET'},
+        ...           redirectResponse={'status': 303}),
+        ...     event('Network.responseReceived', requestId='1',
+        ...           response={'status': 200, 'statusText': 'OK',
+        ...                     'mimeType': 'text/html',
+        ...                     'protocol': 'http/1.1',
+        ...                     'timing': {'requestTime': 100.101,
+        ...                                'dnsStart': -1, 'dnsEnd': -1,
+        ...                                'connectStart': 0,
+        ...                                'connectEnd': 1,
+        ...                                'sendStart': 1, 'sendEnd': 2,
+        ...                                'receiveHeadersEnd': 252}}),
+        ...     event('Network.loadingFinished', requestId='1',
+        ...           timestamp=100.4, encodedDataLength=1024),
+        ...     event('Network.requestWillBeSent', requestId='2',
+        ...           timestamp=100.5,
+        ...           request={'url': 'http://localhost/missing.js'}),
+        ...     event('Network.loadingFailed', requestId='2',
+        ...           timestamp=100.6, errorText='net::ERR_FAILED'),
+        ...     ]
+
+        >>> har = make_har(log)
+        >>> for entry in har['log']['entries']:
+        ...     print entry['startedDateTime'], entry['request']['method'],
+        ...     print entry['request']['url'], entry['response']['status'],
+        ...     print entry['time'], entry['response']['bodySize'],
+        ...     print entry.get('_error', '')
+        2014-05-13T16:53:20.500000Z POST http://localhost/login 303 100.0 0
+        2014-05-13T16:53:20Z GET http://localhost/ 200 300.0 1024
+        2014-05-13T16:53:20Z GET http://localhost/missing.js 0 100.0 0 net::ERR_FAILED
+
+        >>> timings = har['log']['entries'][1]['timings']
+        >>> for name in sorted(timings):
+        ...     print name, timings[name]
+        blocked 1.0
+        connect 1.0
+        dns -1
+        receive 47.0
+        send 1.0
+        ssl -1
+        wait 250.0
+
+    The capture drains performance logs of browsers when they quit and when
+    the test ends.
+
+        >>> class LoggingBrowser(FakeBrowser):
+        ...     def get_log(self, log_type):
+        ...         print '%s: get %s log' % (self.name, log_type)
+        ...         return log[:2]
+
+        >>> capture = HttpCapture()
+        >>> browser = LoggingBrowser()
+        >>> capture.add(browser)
+        >>> browser.quit()
+        browser-...: get performance log
+        browser-...: quit
+        >>> browser = LoggingBrowser()
+        >>> capture.add(browser)
+        >>> len(capture.stop_test())
+        browser-...: get performance log
+        4
+        >>> capture.stop_test()
+        browser-...: get performance log
+        [...]
+
+    Browsers that quit bypassing their quit() wrappers, like pooled
+    browsers, are forgotten too.
+
+        >>> from schooltool.devtools import browserpool
+        >>> browserpool.quit_listeners.append(capture.forget)
+        >>> browserpool.real_quit(browser)
+        browser-...: quit
+        >>> capture.browsers
+        []
+        >>> browserpool.quit_listeners.remove(capture.forget)
+
+    """
+
+
+def doctest_TestHistory():
+    r"""Tests for the test history.
+
+        >>> import shutil
+        >>> from schooltool.devtools.scheduling import TestHistory
+        >>> from schooltool.devtools.scheduling import merge_histories
+        >>> directory = tempfile.mkdtemp()
+        >>> path = os.path.join(directory, 'history.json')
+
+        >>> history = TestHistory(path)
+        >>> print history.duration('test_login')
+        None
+
+    Results are merged into the file when saved, so parallel test runner
+    processes can share it.
+
+        >>> history.record('test_login', 3.5, 'success')
+        >>> other = TestHistory(path)
+        >>> other.record('test_logout', 1.0, 'failure')
+        >>> other.save()
+        >>> history.save()
+
+        >>> history = TestHistory(path)
+        >>> history.duration('test_login'), history.duration('test_logout')
+        (3.5, 1.0)
+
+    Histories of shards are merged keeping the latest result of each test.
+
+        >>> shard = os.path.join(directory, 'shard.json')
+        >>> history = TestHistory(shard)
+        >>> history.record('test_logout', 1.5, 'success')
+        >>> history.save()
+        >>> tests = merge_histories([path, shard])
+        >>> for test_id in sorted(tests):
+        ...     print test_id, tests[test_id]['duration'],
+        ...     print tests[test_id]['outcome']
+        test_login 3.5 success
+        test_logout 1.5 success
+
+        >>> shutil.rmtree(directory)
+
+    """
+
+
+def doctest_split_shards():
+    r"""Tests for splitting tests into shards.
+
+        >>> from schooltool.devtools.scheduling import TestHistory
+        >>> from schooltool.devtools.scheduling import split_shards
+        >>> from schooltool.devtools.scheduling import select_shard
+        >>> from schooltool.devtools.scheduling import parse_shard
+
+        >>> tests = ['a1', 'a2', 'a3', 'b1', 'b2', 'c1', 'c2']
+
+    Without history, shards get the same number of consecutive tests.
+
+        >>> split_shards(tests, 3)
+        [['a1', 'a2', 'a3'], ['b1', 'b2'], ['c1', 'c2']]
+
+    With history, long tests are spread among shards first.  Tests not in
+    the history count as the average test (here 3s).
+
+        >>> history = TestHistory()
+        >>> for test_id, duration in [('a1', 1), ('a2', 1), ('a3', 10),
+        ...                           ('b1', 2), ('b2', 2), ('c1', 2)]:
+        ...     history.tests[test_id] = {'duration': duration}
+        >>> shards = split_shards(tests, 3, history)
+        >>> shards
+        [['a3'], ['a2', 'c1', 'c2'], ['a1', 'b1', 'b2']]
+        >>> [sum([history.duration(t) or 3 for t in shard]) for shard in shards]
+        [10, 6, 5]
+
+        >>> select_shard(tests, 2, 3, history)
+        ['a2', 'c1', 'c2']
+
+        >>> parse_shard('2/3')
+        (2, 3)
+        >>> parse_shard('4/3')
+        Traceback (most recent call last):
+        ...
+        ValueError: Shard '4/3' does not exist
+        >>> parse_shard('half')
+        Traceback (most recent call last):
+        ...
+        ValueError: Shard must be given as N/M, not 'half'
+
+    """
+
+
+def doctest_order_tests():
+    r"""Tests for ordering tests by their history.
+
+        >>> from schooltool.devtools.scheduling import TestHistory
+        >>> from schooltool.devtools.scheduling import order_key
+        >>> from schooltool.devtools.scheduling import order_layers
+
+        >>> class Test(object):
+        ...     def __init__(self, test_id):
+        ...         self.test_id = test_id
+        ...     def id(self):
+        ...         return self.test_id
+        ...     def __repr__(self):
+        ...         return self.test_id
+
+        >>> history = TestHistory()
+        >>> history.tests = {
+        ...     'a1': {'duration': 1, 'outcome': 'success', 'source': 'aaa'},
+        ...     'a2': {'duration': 5, 'outcome': 'failure', 'source': 'aaa'},
+        ...     'b1': {'duration': 2, 'outcome': 'success', 'source': 'bbb'},
+        ...     }
+        >>> layers = [('A', None, [Test('a1'), Test('a2')]),
+        ...           ('B', None, [Test('b1'), Test('b2')])]
+        >>> sources = {'a1': 'aaa', 'a2': 'aaa', 'b1': 'bb2', 'b2': 'bb2'}
+        >>> fingerprints = lambda test: sources[test.id()]
+
+        >>> def order(order):
+        ...     key = order_key(order, history, fingerprints)
+        ...     for name, layer, tests in order_layers(layers, order, key):
+        ...         print name, sorted(tests, key=key)
+
+    Tests that failed last time run first.
+
+        >>> order('failed')
+        A [a2, a1]
+        B [b1, b2]
+
+    Longest tests and layers first.  Tests not in the history count as the
+    average test.
+
+        >>> order('slowest')
+        A [a2, a1]
+        B [b2, b1]
+
+    New tests and tests whose source files changed first.
+
+        >>> order('new')
+        B [b1, b2]
+        A [a1, a2]
+
+    Layers that share a base are kept together, the base layer first, so
+    that the base is set up once.  Groups are ordered by their tests, then
+    layers within groups.
+
+        >>> class ServerLayer(object): pass
+        >>> class FormsLayer(ServerLayer): pass
+        >>> class ReportsLayer(ServerLayer): pass
+        >>> class PDFLayer(ReportsLayer): pass
+        >>> class OtherLayer(object): pass
+        >>> history.tests = {'server': {'duration': 1},
+        ...                  'forms': {'duration': 1},
+        ...                  'other': {'duration': 3},
+        ...                  'reports': {'duration': 1},
+        ...                  'pdf': {'duration': 4}}
+        >>> layers = [(layer.__name__, layer,
+        ...            [Test(layer.__name__[:-5].lower())])
+        ...           for layer in (ServerLayer, FormsLayer, OtherLayer,
+        ...                         ReportsLayer, PDFLayer)]
+
+        >>> order('slowest')
+        ServerLayer [server]
+        ReportsLayer [reports]
+        PDFLayer [pdf]
+        FormsLayer [forms]
+        OtherLayer [other]
+
+    The test runner hashes test sources once, for the order and for the
+    history it records.
+
+        >>> import unittest
+        >>> from schooltool.devtools import selenium_recipe
+        >>> class NewTest(unittest.TestCase):
+        ...     def test(self):
+        ...         pass
+        >>> test = NewTest('test')
+        >>> class Output(object):
+        ...     def info(self, message):
+        ...         print message
+        >>> class Options(object):
+        ...     selenium_order = 'new'
+        ...     resume_layer = None
+        ...     output = Output()
+        >>> class Runner(object):
+        ...     options = Options()
+        ...     tests_by_layer_name = {'A': unittest.TestSuite([test])}
+        >>> feature = selenium_recipe.RunnerSeleniumFeature(Runner())
+        >>> selenium_recipe.test_history = TestHistory()
+
+        >>> feature.set_up_order()
+        Running 1 new or changed tests first
+        >>> fingerprints = feature.fingerprints
+        >>> fingerprints.hashes.values()
+        ['...']
+        >>> feature.test_result(test, 0.1, 'success')
+        >>> feature.fingerprints is fingerprints
+        True
+        >>> (selenium_recipe.test_history.recorded[test.id()]['source'] ==
+        ...  fingerprints.hashes.values()[0])
+        True
+
+        >>> selenium_recipe.test_history = None
 
     """
 
@@ -319,6 +2507,7 @@ def test_suite():
                              setUp=setUp, tearDown=tearDown),
         doctest.DocTestSuite('schooltool.devtools.i18nextract',
                              optionflags=optionflags),
+        unittest.makeSuite(BrowserBenchmark),
         ])
 
 
@@ -0,0 +1,205 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Where selenium tests spend their time
+"""
+import json
+import threading
+import time
+
+
+# WebDriver commands that block in the implicit wait when nothing is found
+FIND_COMMANDS = ('findElement', 'findElements',
+                 'findChildElement', 'findChildElements')
+
+# Times collected for every test and layer
+TIMES = ('spawn', 'commands', 'wait', 'explicit_wait',
+         'screenshots', 'downloads')
+
+
+class Timings(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.duration = 0.0
+        self.times = dict.fromkeys(TIMES, 0.0)
+        self.commands = {}
+
+    def add(self, kind, seconds):
+        self.times[kind] += seconds
+
+    def add_command(self, command, seconds):
+        count, total = self.commands.get(command, (0, 0.0))
+        self.commands[command] = (count + 1, total + seconds)
+        self.times['commands'] += seconds
+
+    def merge(self, data):
+        """Add times saved by as_dict(), say by another process."""
+        self.duration += data['duration']
+        for kind, seconds in data['times'].items():
+            self.times[kind] = self.times.get(kind, 0.0) + seconds
+        for command, saved in data['commands'].items():
+            count, total = self.commands.get(command, (0, 0.0))
+            self.commands[command] = (count + saved['count'],
+                                      total + saved['time'])
+
+    @property
+    def command_count(self):
+        return sum([count for count, total in self.commands.values()])
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'duration': self.duration,
+            'times': self.times,
+            'commands': dict([(command, {'count': count, 'time': total})
+                              for command, (count, total)
+                              in self.commands.items()]),
+            }
+
+
+class SeleniumTimings(object):
+    """Collects browser spawn, command, wait and I/O times.
+
+    Times are recorded for the running test and for its layer.  Times
+    outside tests (layer set up) only count towards the layer.
+    """
+
+    def __init__(self):
+        self.tests = []
+        self.layers = {}
+        self.layer = None
+        self.test = None
+        self.test_started = None
+        self.lock = threading.Lock()
+
+    def start_layer(self, name):
+        with self.lock:
+            if name not in self.layers:
+                self.layers[name] = Timings(name)
+            self.layer = self.layers[name]
+
+    def start_test(self, name):
+        with self.lock:
+            self.test = Timings(name)
+            self.test_started = time.time()
+
+    def stop_test(self):
+        with self.lock:
+            if self.test is None:
+                return
+            self.test.duration = time.time() - self.test_started
+            if self.layer is not None:
+                self.layer.duration += self.test.duration
+            self.tests.append(self.test)
+            self.test = None
+
+    def targets(self):
+        return [timings for timings in (self.test, self.layer)
+                if timings is not None]
+
+    def add(self, kind, seconds):
+        with self.lock:
+            for timings in self.targets():
+                timings.add(kind, seconds)
+
+    def add_command(self, command, seconds, waited=False):
+        with self.lock:
+            for timings in self.targets():
+                timings.add_command(command, seconds)
+                if waited:
+                    timings.add('wait', seconds)
+
+    def slowest(self, count):
+        tests = sorted(self.tests, key=lambda t: t.duration, reverse=True)
+        return tests[:count]
+
+    def format_timings(self, timings):
+        times = timings.times
+        return ('%8.2fs %s\n'
+                '           spawn %.2fs, %d commands %.2fs,'
+                ' implicit waits %.2fs, explicit waits %.2fs,'
+                ' screenshots %.2fs, downloads %.2fs' % (
+                    timings.duration, timings.name,
+                    times['spawn'], timings.command_count,
+                    times['commands'], times['wait'],
+                    times['explicit_wait'],
+                    times['screenshots'], times['downloads']))
+
+    def report(self, count):
+        lines = ['Slowest selenium tests:']
+        for timings in self.slowest(count):
+            lines.append(self.format_timings(timings))
+        lines.append('Selenium time by layer:')
+        for name in sorted(self.layers):
+            lines.append(self.format_timings(self.layers[name]))
+        return '\n'.join(lines)
+
+    def as_dict(self):
+        return {
+            'tests': [timings.as_dict() for timings in self.tests],
+            'layers': [self.layers[name].as_dict()
+                       for name in sorted(self.layers)],
+            }
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+
+    def load(self, path):
+        """Add tests and layers of a saved file, say of a subprocess."""
+        with open(path) as f:
+            data = json.load(f)
+        with self.lock:
+            for saved in data['tests']:
+                timings = Timings(saved['name'])
+                timings.merge(saved)
+                self.tests.append(timings)
+            for saved in data['layers']:
+                name = saved['name']
+                if name not in self.layers:
+                    self.layers[name] = Timings(name)
+                self.layers[name].merge(saved)
+
+
+def time_commands(browser, timings):
+    """Record the time of every WebDriver command the browser executes."""
+    if 'execute' in browser.__dict__:
+        return
+    execute = browser.execute
+    state = {'implicit_wait': 0}
+
+    def timed_execute(command, params=None):
+        if command == 'implicitlyWait' and params:
+            state['implicit_wait'] = params.get('ms', 0)
+        start = time.time()
+        waited = False
+        try:
+            result = execute(command, params)
+            if (command in FIND_COMMANDS and
+                isinstance(result, dict) and not result.get('value')):
+                waited = bool(state['implicit_wait'])
+            return result
+        except Exception:
+            if command in FIND_COMMANDS:
+                waited = bool(state['implicit_wait'])
+            raise
+        finally:
+            timings.add_command(command, time.time() - start, waited=waited)
+
+    browser.execute = timed_execute
@@ -0,0 +1,224 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Trace of WebDriver wire commands
+"""
+import json
+import sys
+import threading
+import time
+
+
+# Upper bounds of histogram buckets, in milliseconds
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, None)
+
+# Frames of these modules are left out of traced stacks
+SKIPPED_MODULES = ('selenium.', 'schooltool.devtools.')
+
+# Stacks end at the test runner
+RUNNER_MODULES = ('unittest.', 'zope.testrunner.', 'doctest')
+
+
+def bucket_label(bound):
+    if bound is None:
+        return '>%dms' % BUCKETS[-2]
+    return '<%dms' % bound
+
+
+class Histogram(object):
+    """Counts, times and payload sizes of a wire command."""
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.sent = 0
+        self.received = 0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, seconds, sent, received):
+        self.count += 1
+        self.time += seconds
+        self.sent += sent
+        self.received += received
+        milliseconds = seconds * 1000
+        for n, bound in enumerate(BUCKETS):
+            if bound is None or milliseconds < bound:
+                self.buckets[n] += 1
+                break
+
+    def merge(self, data):
+        """Add counts saved by as_dict()."""
+        self.count += data['count']
+        self.time += data['time']
+        self.sent += data['sent']
+        self.received += data['received']
+        for n, bound in enumerate(BUCKETS):
+            self.buckets[n] += data['buckets'].get(bucket_label(bound), 0)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'time': self.time,
+            'sent': self.sent,
+            'received': self.received,
+            'buckets': dict([(bucket_label(bound), count)
+                             for bound, count in zip(BUCKETS, self.buckets)
+                             if count]),
+            }
+
+    def format(self, name):
+        buckets = ' '.join(['%s:%d' % (bucket_label(bound), count)
+                            for bound, count in zip(BUCKETS, self.buckets)
+                            if count])
+        return '%8.2fs %6d %-24s %8d KB out %8d KB in  %s' % (
+            self.time, self.count, name, self.sent / 1024,
+            self.received / 1024, buckets)
+
+
+def caller_stack(frame, limit=40):
+    """Frames of the test code that issued a command, outermost first."""
+    stack = []
+    while frame is not None and len(stack) < limit:
+        module = frame.f_globals.get('__name__', '?')
+        if module.startswith(RUNNER_MODULES):
+            break
+        if not module.startswith(SKIPPED_MODULES):
+            stack.append('%s:%s' % (module, frame.f_code.co_name))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+class CommandTracer(object):
+    """Records every WebDriver wire command with its time and payload size.
+
+    Keeps command histograms for each test and for the run, and a trace
+    of the time spent in commands by the test code stack that issued them.
+    """
+
+    def __init__(self):
+        self.run = {}
+        self.tests = []
+        self.test = None
+        self.test_name = None
+        self.stacks = {}
+        self.lock = threading.Lock()
+
+    def start_test(self, name):
+        with self.lock:
+            self.test_name = name
+            self.test = {}
+
+    def stop_test(self):
+        with self.lock:
+            if self.test is not None:
+                self.tests.append((self.test_name, self.test))
+            self.test = None
+            self.test_name = None
+
+    def record(self, command, seconds, sent, received, stack=()):
+        with self.lock:
+            targets = [self.run]
+            if self.test is not None:
+                targets.append(self.test)
+            for histograms in targets:
+                if command not in histograms:
+                    histograms[command] = Histogram()
+                histograms[command].add(seconds, sent, received)
+            key = ';'.join([self.test_name or '(no test)'] + list(stack) +
+                           [command])
+            self.stacks[key] = self.stacks.get(key, 0) + seconds
+
+    def report(self):
+        lines = ['WebDriver commands:']
+        by_time = sorted(self.run.items(), key=lambda item: -item[1].time)
+        for command, histogram in by_time:
+            lines.append(histogram.format(command))
+        return '\n'.join(lines)
+
+    def as_dict(self):
+        return {
+            'run': dict([(command, histogram.as_dict())
+                         for command, histogram in self.run.items()]),
+            'tests': [{'name': name,
+                       'commands': dict([(command, histogram.as_dict())
+                                         for command, histogram
+                                         in histograms.items()])}
+                      for name, histograms in self.tests],
+            }
+
+    def collapsed(self):
+        """Trace in the collapsed stack format of flamegraph.pl, in us."""
+        return ''.join(['%s %d\n' % (stack, round(seconds * 1000000))
+                        for stack, seconds in sorted(self.stacks.items())])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write(self.collapsed())
+        with open(path + '.json', 'w') as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+
+    def load(self, path):
+        """Add a saved trace, say of a test runner subprocess."""
+        with open(path + '.json') as f:
+            data = json.load(f)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        with self.lock:
+            for command, saved in data['run'].items():
+                if command not in self.run:
+                    self.run[command] = Histogram()
+                self.run[command].merge(saved)
+            for test in data['tests']:
+                histograms = {}
+                for command, saved in test['commands'].items():
+                    histograms[command] = Histogram()
+                    histograms[command].merge(saved)
+                self.tests.append((test['name'], histograms))
+            for line in lines:
+                stack, microseconds = line.rsplit(' ', 1)
+                self.stacks[stack] = (self.stacks.get(stack, 0) +
+                                      int(microseconds) / 1000000.0)
+
+
+def payload_size(data):
+    if data is None:
+        return 0
+    return len(json.dumps(data))
+
+
+def trace_commands(browser, tracer):
+    """Record commands going through the browser's command executor."""
+    executor = getattr(browser, 'command_executor', None)
+    if executor is None or 'execute' in executor.__dict__:
+        return
+    execute = executor.execute
+
+    def traced_execute(command, params):
+        stack = caller_stack(sys._getframe(1))
+        start = time.time()
+        response = None
+        try:
+            response = execute(command, params)
+            return response
+        finally:
+            tracer.record(command, time.time() - start,
+                          payload_size(params), payload_size(response),
+                          stack)
+
+    executor.execute = traced_execute
@@ -0,0 +1,185 @@
+#
+# SchoolTool - common information systems platform for school administration
+# Copyright (c) 2014 Shuttleworth Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Explicit waits for selenium browsers
+"""
+import time
+
+
+CSS = 'css selector'
+XPATH = 'xpath'
+
+
+class WaitTimeout(AssertionError):
+    pass
+
+
+class Waits(object):
+    """Explicit waits for a spawned browser.
+
+    Conditions are polled with growing intervals, with the implicit wait
+    turned off, so waiting for something to disappear returns as soon as
+    it is gone.
+
+        browser.waits.present('#content')
+        browser.waits.absent('.spinner')
+        browser.waits.until(lambda browser: browser.title == 'Home')
+
+    """
+
+    def __init__(self, browser, timeout=30, poll=0.05, backoff=1.5,
+                 max_poll=1.0, implicit_wait=0, timings=None,
+                 ignored_exceptions=None):
+        if ignored_exceptions is None:
+            # Raised when the page changes under a condition.
+            from selenium.common.exceptions import NoSuchElementException
+            from selenium.common.exceptions import (
+                StaleElementReferenceException)
+            ignored_exceptions = (NoSuchElementException,
+                                  StaleElementReferenceException)
+        self.ignored_exceptions = tuple(ignored_exceptions)
+        self.browser = browser
+        self.timeout = timeout
+        self.poll = poll
+        self.backoff = backoff
+        self.max_poll = max_poll
+        self.implicit_wait = implicit_wait
+        self.timings = timings
+        self.waited = 0.0
+        self.waiting = False
+
+    def until(self, condition, timeout=None, message=None):
+        """Wait until condition(browser) returns a true value, return it.
+
+        Conditions that raise one of ignored_exceptions are polled again.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if self.waiting:
+            # Nested wait from a condition, just check it.
+            return condition(self.browser)
+        start = time.time()
+        deadline = start + timeout
+        interval = self.poll
+        self.waiting = True
+        if self.implicit_wait:
+            self.browser.implicitly_wait(0)
+        try:
+            while True:
+                try:
+                    value = condition(self.browser)
+                except self.ignored_exceptions:
+                    value = None
+                if value:
+                    return value
+                now = time.time()
+                if now >= deadline:
+                    raise WaitTimeout(
+                        message or 'Timed out after %s seconds waiting'
+                        ' for %s' % (timeout, describe(condition)))
+                time.sleep(min(interval, deadline - now))
+                interval = min(interval * self.backoff, self.max_poll)
+        finally:
+            if self.implicit_wait:
+                self.browser.implicitly_wait(self.implicit_wait)
+            self.waiting = False
+            elapsed = time.time() - start
+            self.waited += elapsed
+            if self.timings is not None:
+                self.timings.add('explicit_wait', elapsed)
+
+    def until_not(self, condition, timeout=None, message=None):
+        """Wait until condition(browser) returns a false value."""
+        self.until(lambda browser: not condition(browser),
+                   timeout=timeout,
+                   message=message or 'Timed out waiting for %s to stop' % (
+                       describe(condition)))
+
+    def elements(self, selector, by=CSS):
+        return self.browser.find_elements(by=by, value=selector)
+
+    def present(self, selector, by=CSS, timeout=None):
+        """Wait for an element to appear, return it."""
+        elements = self.until(
+            lambda browser: self.elements(selector, by=by),
+            timeout=timeout,
+            message='Element %r not found' % selector)
+        return elements[0]
+
+    def absent(self, selector, by=CSS, timeout=None):
+        """Wait until no element matches."""
+        self.until(
+            lambda browser: not self.elements(selector, by=by),
+            timeout=timeout,
+            message='Element %r did not go away' % selector)
+
+    def visible(self, selector, by=CSS, timeout=None):
+        """Wait for a visible element, return it."""
+        def visible_element(browser):
+            for element in self.elements(selector, by=by):
+                if element.is_displayed():
+                    return element
+        return self.until(visible_element, timeout=timeout,
+                          message='Element %r not visible' % selector)
+
+    def invisible(self, selector, by=CSS, timeout=None):
+        """Wait until no matching element is visible."""
+        def displayed(element):
+            try:
+                return element.is_displayed()
+            except self.ignored_exceptions:
+                # Gone from the page.
+                return False
+        self.until(
+            lambda browser: not [element
+                                 for element in self.elements(selector, by=by)
+                                 if displayed(element)],
+            timeout=timeout,
+            message='Element %r still visible' % selector)
+
+    def text(self, selector, text, by=CSS, timeout=None):
+        """Wait for an element containing the text, return it."""
+        def element_with_text(browser):
+            for element in self.elements(selector, by=by):
+                if text in element.text:
+                    return element
+        return self.until(element_with_text, timeout=timeout,
+                          message='Element %r with text %r not found' % (
+                              selector, text))
+
+    def title(self, title, timeout=None):
+        """Wait until the page title contains the text."""
+        self.until(lambda browser: title in browser.title,
+                   timeout=timeout,
+                   message='Title %r not found' % title)
+
+    def url(self, url, timeout=None):
+        """Wait until the current URL contains the text."""
+        self.until(lambda browser: url in browser.current_url,
+                   timeout=timeout,
+                   message='URL %r not reached' % url)
+
+    def script(self, script, timeout=None):
+        """Wait until the JavaScript returns a true value, return it."""
+        return self.until(lambda browser: browser.execute_script(script),
+                          timeout=timeout,
+                          message='Script %r still false' % script)
+
+
+def describe(condition):
+    return getattr(condition, '__doc__', None) or repr(condition)
@@ -18,20 +18,211 @@
 """
 Selenium runner recipe
 """
+import atexit
+import base64
+import json
 import os.path
+import sys
+import threading
 
 import selenium.webdriver.remote.webdriver
 import selenium.webdriver.chrome.webdriver
 import selenium.webdriver.chrome.service
+import selenium.webdriver.firefox.webdriver
+from selenium.webdriver.chrome.options import Options as ChromeOptions
 from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
 
+from schooltool.devtools import selenium_recipe
 from schooltool.devtools.selenium_recipe import BadOptions
+from schooltool.devtools.har import CHROME_CAPTURE_CAPABILITIES
+from schooltool.devtools.har import CHROME_CAPTURE_OPTIONS
+
+
+class ChromeServices(object):
+    """Long lived chromedriver processes shared by Chrome sessions.
+
+    A chromedriver serves many sessions at once, so there is no need to
+    start one per browser.  Crashed services are replaced on demand.
+    """
+
+    def __init__(self):
+        self.services = {}
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def alive(self, service):
+        process = getattr(service, 'process', None)
+        return process is not None and process.poll() is None
+
+    def start(self, executable_path, port):
+        service = selenium.webdriver.chrome.service.Service(
+            executable_path, port=port)
+        service.start()
+        return service
+
+    def acquire(self, executable_path="chromedriver", port=0,
+                max_sessions=None):
+        # Browsers inherit the display from chromedriver.
+        key = (executable_path, port, os.environ.get('DISPLAY'))
+        with self.lock:
+            services = self.services.setdefault(key, [])
+            for service in list(services):
+                if not self.alive(service):
+                    services.remove(service)
+                    self.sessions.pop(id(service), None)
+                    self.stop_service(service)
+            available = [service for service in services
+                         if (max_sessions is None or
+                             self.sessions[id(service)] < max_sessions)]
+            if available:
+                service = min(available,
+                              key=lambda s: self.sessions[id(s)])
+            elif services and port:
+                # Cannot start another service on the same port.
+                service = services[0]
+            else:
+                service = self.start(executable_path, port)
+                services.append(service)
+                self.sessions[id(service)] = 0
+            self.sessions[id(service)] += 1
+        return service
+
+    def release(self, service):
+        with self.lock:
+            if id(service) in self.sessions:
+                self.sessions[id(service)] -= 1
+
+    def stop_service(self, service):
+        try:
+            service.stop()
+        except Exception:
+            pass
+
+    def stop(self):
+        with self.lock:
+            services = [service
+                        for key in sorted(self.services)
+                        for service in self.services[key]]
+            self.services.clear()
+            self.sessions.clear()
+        for service in services:
+            self.stop_service(service)
+
+
+chrome_services = ChromeServices()
+selenium_recipe.cleanups.append(chrome_services.stop)
+atexit.register(chrome_services.stop)
+
+
+def is_headless(config, headless=None):
+    """Should the browser start in its built-in headless mode?"""
+    if headless is not None:
+        return headless
+    return bool(config is not None and config.headless)
+
+
+def window_size(config):
+    if config is None:
+        return selenium_recipe.BrowserConfig.window_size
+    return config.window_size
+
+
+def chrome_arguments(config, headless=None):
+    if not is_headless(config, headless):
+        return []
+    width, height = window_size(config)
+    return ['--headless', '--disable-gpu',
+            '--window-size=%d,%d' % (width, height)]
+
+
+def chrome_capabilities(desired_capabilities, config=None, headless=None):
+    """Add capabilities for headless Chrome and HTTP capture."""
+    arguments = chrome_arguments(config, headless)
+    desired_capabilities = dict(desired_capabilities)
+    options = dict(desired_capabilities.get('chromeOptions', {}))
+    if arguments:
+        options['args'] = list(options.get('args', [])) + arguments
+    if config is not None and config.capture_http:
+        desired_capabilities.update(CHROME_CAPTURE_CAPABILITIES)
+        options.update(CHROME_CAPTURE_OPTIONS)
+    if options:
+        desired_capabilities['chromeOptions'] = options
+    return desired_capabilities
+
+
+def chrome_options(config=None, headless=None):
+    """ChromeOptions for headless Chrome and HTTP capture.
+
+    selenium's Chrome WebDriver replaces chromeOptions of the desired
+    capabilities with its ChromeOptions, so they have to go there.
+    """
+    options = ChromeOptions()
+    for argument in chrome_arguments(config, headless):
+        options.add_argument(argument)
+    if config is not None and config.capture_http:
+        for name, value in sorted(CHROME_CAPTURE_OPTIONS.items()):
+            options.add_experimental_option(name, value)
+    return options
+
+
+# Values of the pageLoadStrategy capability: wait for the load event,
+# for DOMContentLoaded, or not at all.
+PAGE_LOAD_STRATEGIES = ('normal', 'eager', 'none')
+
+# Blocked requests go to the discard port, where connections are refused.
+BLOCKING_PROXY = 'PROXY 127.0.0.1:9'
+
+
+def blocking_pac(patterns):
+    """Proxy auto-config script that blocks URLs matching shell patterns."""
+    conditions = ' ||\n        '.join(['shExpMatch(url, %s)' % json.dumps(p)
+                                      for p in patterns])
+    return ('function FindProxyForURL(url, host) {\n'
+            '    if (%s) {\n'
+            '        return %s;\n'
+            '    }\n'
+            '    return "DIRECT";\n'
+            '}\n') % (conditions, json.dumps(BLOCKING_PROXY))
+
+
+def pac_url(script):
+    return ('data:application/x-ns-proxy-autoconfig;base64,' +
+            base64.b64encode(script))
+
+
+def headless_display(config):
+    """Start a virtual display for browsers without a headless mode."""
+    if selenium_recipe.virtual_display is None:
+        print >> sys.stderr, (
+            'warning: Firefox has no headless mode with this WebDriver,'
+            ' running it under a virtual display')
+        selenium_recipe.virtual_display = selenium_recipe.VirtualDisplay(
+            visible=False, size=window_size(config))
+    selenium_recipe.virtual_display.ensure()
+
+
+class FirefoxWebDriver(selenium.webdriver.firefox.webdriver.WebDriver):
+    """Firefox WebDriver that runs under a virtual display when headless.
+
+    The Firefox releases supported by selenium 2's Firefox driver have no
+    headless mode of their own.
+    """
+
+    def __init__(self, firefox_profile=None, firefox_binary=None, timeout=30,
+                 capabilities=None, proxy=None, config=None, headless=None):
+        if is_headless(config, headless):
+            headless_display(config)
+        selenium.webdriver.firefox.webdriver.WebDriver.__init__(
+            self, firefox_profile=firefox_profile,
+            firefox_binary=firefox_binary, timeout=timeout,
+            capabilities=capabilities, proxy=proxy)
 
 
 class ChromeWebDriver(selenium.webdriver.chrome.webdriver.WebDriver):
     def __init__(self, executable_path="chromedriver", port=0,
                  desired_capabilities=DesiredCapabilities.CHROME,
-                 config=None):
+                 config=None, shared_service=True, service_sessions=None,
+                 headless=None, keep_alive=None):
         """ Creates a new instance of the chrome driver. Starts the service
             and then creates
             Attributes:
@@ -39,11 +230,25 @@ class ChromeWebDriver(selenium.webdriver.chrome.webdriver.WebDriver):
                     is used it assumes the executable is in the $PATH
                 port : port you would like the service to run, if left
                     as 0, a free port will be found
+                shared_service : share a long lived chromedriver with
+                    other browsers instead of starting a new one
+                service_sessions : maximum number of browsers per shared
+                    chromedriver, unlimited if None
+                headless : start Chrome in its built-in headless mode,
+                    defaults to config.headless
+                keep_alive : send commands over keep-alive connections
+                    shared with other browsers; True, or a dict of
+                    connection pool settings (size, timeout, idle_timeout)
 
         """
-        self.service = selenium.webdriver.chrome.service.Service(
-            executable_path, port=port)
-        self.service.start()
+        self.shared_service = shared_service
+        if shared_service:
+            self.service = chrome_services.acquire(
+                executable_path, port=port, max_sessions=service_sessions)
+        else:
+            self.service = selenium.webdriver.chrome.service.Service(
+                executable_path, port=port)
+            self.service.start()
 
         desired_capabilities = dict(desired_capabilities)
         default_prefs = {
@@ -59,20 +264,55 @@ class ChromeWebDriver(selenium.webdriver.chrome.webdriver.WebDriver):
         if 'chrome.binary' in desired_capabilities:
             options['binary'] = desired_capabilities['chrome.binary']
         desired_capabilities['chromeOptions'] = options
+        desired_capabilities = chrome_capabilities(
+            desired_capabilities, config=config, headless=headless)
 
-        selenium.webdriver.remote.webdriver.WebDriver.__init__(
-            self,
-            command_executor=self.service.service_url,
-            desired_capabilities=desired_capabilities)
+        command_executor = self.service.service_url
+        if keep_alive:
+            from schooltool.devtools.connection import pooled_connection
+            if keep_alive is True:
+                keep_alive = {}
+            command_executor = pooled_connection(command_executor,
+                                                 **keep_alive)
+
+        try:
+            selenium.webdriver.remote.webdriver.WebDriver.__init__(
+                self,
+                command_executor=command_executor,
+                desired_capabilities=desired_capabilities)
+        except:
+            self.stop_service()
+            raise
+
+    def stop_service(self):
+        if self.shared_service:
+            chrome_services.release(self.service)
+        else:
+            self.service.stop()
+
+    def quit(self):
+        try:
+            selenium.webdriver.remote.webdriver.WebDriver.quit(self)
+        except Exception:
+            pass
+        finally:
+            self.stop_service()
 
 
+# Imports are done when the first browser is spawned, so that test runs
+# without selenium tests do not pay for them.
 factory_config_script = '''
+def selenium_factory(config=None):
 %(imports)s
-schooltool.devtools.selenium_recipe.factories[%(name)r] =\\
-    lambda config=None: %(factory)s(%(args)s)
+    return %(factory)s(%(args)s)
+schooltool.devtools.selenium_recipe.factories[%(name)r] = selenium_factory
 '''
 
 
+def indent(code, prefix='    '):
+    return '\n'.join([prefix + line for line in code.splitlines()])
+
+
 class python_code(str):
     def __repr__(self):
         return str(self)
@@ -88,19 +328,57 @@ class ScriptFactory(object):
 
     template = factory_config_script
 
+    def page_load(self, driver, config):
+        """Capabilities for page_load_strategy and block_urls options.
+
+        block_urls are shell patterns (say, *.woff) matched against whole
+        URLs, given as a list or separated by whitespace.
+        """
+        capabilities = {}
+        strategy = config.get('page_load_strategy')
+        if strategy:
+            if strategy not in PAGE_LOAD_STRATEGIES:
+                raise BadOptions(
+                    '"page_load_strategy" for %r should be one of: %s.' % (
+                    driver, ', '.join(PAGE_LOAD_STRATEGIES)))
+            capabilities['pageLoadStrategy'] = strategy
+        patterns = config.get('block_urls')
+        if isinstance(patterns, str):
+            patterns = patterns.split()
+        if patterns:
+            capabilities['proxy'] = {
+                'proxyType': 'PAC',
+                'proxyAutoconfigUrl': pac_url(blocking_pac(patterns)),
+                }
+        return capabilities
+
+    def keep_alive(self, config):
+        """Connection pool settings, None if keep_alive is off."""
+        if not config.get('keep_alive'):
+            return None
+        settings = {}
+        if 'keep_alive_connections' in config:
+            settings['size'] = int(config['keep_alive_connections'])
+        if 'keep_alive_timeout' in config:
+            settings['timeout'] = float(config['keep_alive_timeout'])
+        if 'keep_alive_idle' in config:
+            settings['idle_timeout'] = float(config['keep_alive_idle'])
+        return settings
+
     def firefox(self, driver, config):
-        imps = 'import selenium.webdriver.firefox.webdriver'
-        factory = 'selenium.webdriver.firefox.webdriver.WebDriver'
+        imps = 'import schooltool.devtools.webdriver'
+        factory = 'schooltool.devtools.webdriver.FirefoxWebDriver'
         args = []
         kws = {}
 
         if 'timeout' in config:
             kws['timeout'] = int(config['timeout'])
+        if 'headless' in config:
+            kws['headless'] = bool(config['headless'])
 
         if 'profile' in config:
-            imps += ('\nfrom selenium.webdriver.firefox.firefox_profile' +
-                     ' import FirefoxProfile')
-            kws['firefox_profile'] = python_code('FirefoxProfile(%s)' % (
+            imps += '\nfrom schooltool.devtools.profiles import cached_profile'
+            kws['firefox_profile'] = python_code('cached_profile(%s)' % (
                 format_args(os.path.abspath(config['profile']))))
 
         if 'binary' in config:
@@ -109,9 +387,17 @@ class ScriptFactory(object):
             kws['firefox_binary'] = python_code('FirefoxBinary(%s)' % (
                 format_args(os.path.abspath(config['binary']))))
 
+        page_load = self.page_load(driver, config)
+        if page_load:
+            kws['capabilities'] = dict(DesiredCapabilities.FIREFOX)
+            kws['capabilities'].update(page_load)
+
+        arguments = format_args(*args, **kws)
+        arguments = ', '.join(filter(None, [arguments, 'config=config']))
+
         return self.template % {
-            'imports': imps, 'name': driver, 'factory': factory,
-            'args': format_args(*args, **kws)}
+            'imports': indent(imps), 'name': driver, 'factory': factory,
+            'args': arguments}
 
     def ie(self, driver, config):
         imps = 'import selenium.webdriver.ie.webdriver'
@@ -124,7 +410,7 @@ class ScriptFactory(object):
         if 'timeout' in config:
             kws['timeout'] = int(config['timeout'])
         return self.template % {
-            'imports': imps, 'name': driver, 'factory': factory,
+            'imports': indent(imps), 'name': driver, 'factory': factory,
             'args': format_args(*args, **kws)}
 
     def chrome(self, driver, config):
@@ -138,12 +424,26 @@ class ScriptFactory(object):
         if 'binary' in config:
             kws['executable_path'] = config['binary']
 
-        kws['desired_capabilities'] = dict(DesiredCapabilities.CHROME)
+        # Headless arguments are added when the browser is spawned.
+        imps += '\nimport schooltool.devtools.webdriver'
+        desired_capabilities = dict(DesiredCapabilities.CHROME)
+        desired_capabilities.update(self.page_load(driver, config))
+        capabilities = [repr(desired_capabilities), 'config=config']
+        options = ['config=config']
+        if 'headless' in config:
+            capabilities.append('headless=%r' % bool(config['headless']))
+            options.append('headless=%r' % bool(config['headless']))
+        kws['desired_capabilities'] = python_code(
+            'schooltool.devtools.webdriver.chrome_capabilities(%s)' % (
+                ', '.join(capabilities)))
+        kws['chrome_options'] = python_code(
+            'schooltool.devtools.webdriver.chrome_options(%s)' % (
+                ', '.join(options)))
 
         arguments = format_args(*args, **kws)
 
         return self.template % {
-            'imports': imps, 'name': driver, 'factory': factory,
+            'imports': indent(imps), 'name': driver, 'factory': factory,
             'args': arguments}
 
     def linux_chrome(self, driver, config):
@@ -156,6 +456,15 @@ class ScriptFactory(object):
             kws['port'] = int(config['port'])
         if 'binary' in config:
             kws['executable_path'] = config['binary']
+        if 'shared_service' in config:
+            kws['shared_service'] = bool(config['shared_service'])
+        if 'service_sessions' in config:
+            kws['service_sessions'] = int(config['service_sessions'])
+        if 'headless' in config:
+            kws['headless'] = bool(config['headless'])
+        keep_alive = self.keep_alive(config)
+        if keep_alive is not None:
+            kws['keep_alive'] = keep_alive or True
 
         if 'capabilities' in config:
             assert isinstance(config['capabilities'], dict)
@@ -169,11 +478,17 @@ class ScriptFactory(object):
             kws['desired_capabilities'] = dict(DesiredCapabilities.CHROME)
             kws['desired_capabilities'].update(caps)
 
+        page_load = self.page_load(driver, config)
+        if page_load:
+            kws.setdefault('desired_capabilities',
+                           dict(DesiredCapabilities.CHROME))
+            kws['desired_capabilities'].update(page_load)
+
         arguments = format_args(*args, **kws)
         arguments = ', '.join([arguments, 'config=config'])
 
         return self.template % {
-            'imports': imps, 'name': driver, 'factory': factory,
+            'imports': indent(imps), 'name': driver, 'factory': factory,
             'args': arguments}
 
     def remote(self, driver, config):
@@ -184,6 +499,14 @@ class ScriptFactory(object):
 
         if 'remote_hub' in config:
             kws['command_executor'] = config['remote_hub']
+        keep_alive = self.keep_alive(config)
+        if keep_alive is not None:
+            imps += '\nimport schooltool.devtools.connection'
+            kws['command_executor'] = python_code(
+                'schooltool.devtools.connection.pooled_connection(%s)' % (
+                    format_args(config.get('remote_hub',
+                                           'http://127.0.0.1:4444/wd/hub'),
+                                **keep_alive)))
 
         if 'capabilities' not in config:
             raise BadOptions(
@@ -204,16 +527,18 @@ class ScriptFactory(object):
             raise BadOptions(
                 '"capabilities" for %r must be a dic' % driver)
 
+        capabilities = dict(capabilities)
+        capabilities.update(self.page_load(driver, config))
         kws['desired_capabilities'] = capabilities
 
         if 'profile' in config:
-            imps += ('\nfrom selenium.webdriver.firefox.firefox_profile' +
-                     ' import FirefoxProfile')
-            kws['browser_profile'] = 'FirefoxProfile(%r)' % (
-                os.path.abspath(config['profile']))
+            imps += '\nfrom schooltool.devtools.profiles import cached_profile'
+            kws['browser_profile'] = python_code(
+                'cached_profile(%s)' % format_args(
+                    os.path.abspath(config['profile']), remote=True))
 
         return self.template % {
-            'imports': imps, 'name': driver, 'factory': factory,
+            'imports': indent(imps), 'name': driver, 'factory': factory,
             'args': format_args(*args, **kws)}
 
     def __call__(self, driver, config):